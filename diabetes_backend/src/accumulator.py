@@ -0,0 +1,99 @@
+"""
+Streaming accumulators of the glucose readings
+"""
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def trapezoid_sum(timestamps, glucose):
+    """
+    The integral of the glucose over the epoch seconds with the trapezoidal rule,
+    the seconds between each pair of readings times their midpoint
+    """
+    time_diff = np.diff(timestamps)
+    return float(np.dot(time_diff, glucose[1:] + glucose[:-1]) / 2)
+
+
+class TimeWeightedMean:
+    """
+    Time weighted mean of the readings, each pair of consecutive readings
+    weighted by the seconds between them (the trapezoidal integral over time).
+    The readings are consumed in time order, a chunk at a time, keeping only the
+    weighted sum, the seconds covered and the first and last (epoch seconds,
+    glucose) points. Accumulators of consecutive time ranges merge exactly
+    """
+
+    def __init__(self, weighted_sum=0.0, seconds=0.0, count=0, first=None, last=None):
+        self.weighted_sum = weighted_sum
+        self.seconds = seconds
+        self.count = count
+        self.first = first
+        self.last = last
+
+    @classmethod
+    def from_dict(cls, data):
+        first = last = None
+        if data["count"]:
+            first = (data["first_time"], data["first_glucose"])
+            last = (data["last_time"], data["last_glucose"])
+        return cls(data["weighted_sum"], data["seconds"], data["count"], first, last)
+
+    def to_dict(self):
+        first_time, first_glucose = self.first or (None, None)
+        last_time, last_glucose = self.last or (None, None)
+        return {
+            "weighted_sum": self.weighted_sum,
+            "seconds": self.seconds,
+            "count": self.count,
+            "first_time": first_time,
+            "first_glucose": first_glucose,
+            "last_time": last_time,
+            "last_glucose": last_glucose,
+        }
+
+    @property
+    def mean(self):
+        """The time weighted mean, None until the readings span any time"""
+        if not self.seconds:
+            return None
+        return self.weighted_sum / self.seconds
+
+    def update(self, timestamps, glucose):
+        """Consume the next readings, epoch seconds in time order, after the last"""
+        timestamps = np.asarray(timestamps)
+        glucose = np.asarray(glucose, dtype=np.float64)
+        if not len(timestamps):
+            return self
+        if self.last is None:
+            self.first = (float(timestamps[0]), float(glucose[0]))
+        else:
+            timestamps = np.concatenate(([self.last[0]], timestamps))
+            glucose = np.concatenate(([self.last[1]], glucose))
+        self.weighted_sum += trapezoid_sum(timestamps, glucose)
+        self.seconds += float(timestamps[-1] - timestamps[0])
+        self.count += len(timestamps) - 1 + (self.last is None)
+        self.last = (float(timestamps[-1]), float(glucose[-1]))
+        return self
+
+    def merge(self, other):
+        """A new accumulator of the readings of this and then the other one"""
+        merged = TimeWeightedMean(
+            self.weighted_sum, self.seconds, self.count, self.first, self.last
+        )
+        if other.count:
+            merged.update([other.first[0]], [other.first[1]])
+            merged.weighted_sum += other.weighted_sum
+            merged.seconds += other.seconds
+            merged.count += other.count - 1
+            merged.last = other.last
+        return merged
+
+
+def merge_time_weighted_means(accumulators):
+    """Merge the accumulators of consecutive time ranges, in time order"""
+    merged = TimeWeightedMean()
+    for accumulator in accumulators:
+        merged = merged.merge(accumulator)
+    return merged
@@ -18,24 +18,45 @@ import atexit
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # SqlAlchemy
-from sqlalchemy import create_engine
+from src.database.engine import (
+    PoolMonitor,
+    create_database_engine,
+    load_database_url_from_env,
+)
 
 
 from src.data import DataManager
 from src.strava import StravaManager
 from src.glucose import GlucoseManager
 from src.database_manager import DatabaseManager
+from src.events import ROWS_SAVED, EventBus
+from src.rollup import (
+    DailyMeanManager,
+    RollupManager,
+    aggregate_glucose_rollup_data,
+    glucose_quartile_rollup_data,
+    libre_extremes_in_rollup_buckets,
+    libre_hba1c_from_daily_means,
+)
 
 # Configuration settings
-from src.views.metric import Metric
+from src.views.metric import Metric, MetricCache
+from src.views.monitoring import Monitoring
+from src.views.stream import StreamRecords
 from src.views.home import Home
 from src.auth import AuthenticationManagement
-from src.crons import data_cron, libre_cron, strava_cron
+from src.crons import (
+    cron_counters,
+    data_cron,
+    libre_cron,
+    rollup_rebuild_cron,
+    strava_backfill_cron,
+    strava_cron,
+)
 
 from src.utils import (
     aggregate_glucose_data,
     glucose_quartile_data,
-    glucose_raw_data,
     group_glucose_data_by_day,
     libre_data_bucketed_day_overview,
     libre_extremes_in_buckets,
@@ -46,7 +67,12 @@ from src.utils import (
     strava_glucose_raw_data,
     strava_raw_data,
 )
-from src.schemas import TimeIntervalSchema, TimeIntervalWithBucketSchema
+from src.schemas import (
+    TimeIntervalApproximateSchema,
+    TimeIntervalSchema,
+    TimeIntervalWithBucketSchema,
+)
+from src.sketch import load_sketch_bin_width_from_env
 
 # SQL
 from src.database.tables import Base
@@ -60,7 +86,14 @@ load_dotenv(ENV_FILE)
 
 # Optional environment variables
 PORT = os.getenv("PORT", "5000")
+# Save the whole Strava activity history once on start up
+STRAVA_BACKFILL = os.getenv("STRAVA_BACKFILL", "false").lower() == "true"
+# Join the strava and glucose data in the database rather than in Python
+COMBINE_IN_DATABASE = os.getenv("COMBINE_IN_DATABASE", "true").lower() == "true"
 HOST = os.getenv("HOST", "localhost")
+# Results of the metrics cached per window, until rows are saved within it
+METRIC_CACHE_SIZE = int(os.getenv("METRIC_CACHE_SIZE", "256"))
+METRIC_CACHE_TTL = float(os.getenv("METRIC_CACHE_TTL", "300"))
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 LOG_FILE = os.getenv("LOG_FILE", "/logs/glucose.log")
 
@@ -82,39 +115,56 @@ app = Flask(__name__)
 CORS(app, origins=["http://localhost:5173"])
 
 # SQLAlchemy engine
-# TODO - protect env vars
-root = "diabetes_root:diabetes_root"
-host = os.environ["DB_HOST"]
-db_name = os.environ["DB_NAME"]
-url = f"postgresql+psycopg2://{root}@{host}:5432/{db_name}"
-engine = create_engine(url, echo=True)
+# Pool settings, SQL echo and slow query logging are configured via the environment
+engine = create_database_engine(load_database_url_from_env())
+pool_monitor = PoolMonitor(engine)
 
 
 # Create if not exists
 Base.metadata.create_all(engine)
+# create_all skips the indexes of tables that already exist
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
 
 
 # Instantiate the new database manager
 db_manager = DatabaseManager(engine)
+# Saved strava and glucose rows are combined as soon as they land
+event_bus = EventBus()
 # Instantiate the Strava class
-strava = StravaManager(*load_strava_credentials_from_env(), db_manager)
+strava = StravaManager(*load_strava_credentials_from_env(), db_manager, event_bus)
 # Instantiate the new glucose class
 glucose_manager = GlucoseManager(
-    *load_libre_credentials_from_env(), AuthenticationManagement, db_manager
+    *load_libre_credentials_from_env(), AuthenticationManagement, db_manager, event_bus
 )
 # Instantiate the Data class
-data_manager = DataManager(db_manager)
+data_manager = DataManager(db_manager, combine_in_database=COMBINE_IN_DATABASE)
+event_bus.subscribe(ROWS_SAVED, data_manager.on_rows_saved)
+# The 15 minute glucose rollups, updated as the readings are saved, their sketch
+# quantiles are within half of the bin width
+rollup_manager = RollupManager(db_manager, load_sketch_bin_width_from_env())
+event_bus.subscribe(ROWS_SAVED, rollup_manager.on_rows_saved)
+# The daily time weighted means of the readings, merged for the hBA1C
+daily_mean_manager = DailyMeanManager(db_manager)
+event_bus.subscribe(ROWS_SAVED, daily_mean_manager.on_rows_saved)
+# Subscribed after the combine and rollups so their rows are saved when invalidating
+# Only the aggregate metrics are cached, the raw exports would fill it with records
+metric_cache = MetricCache(maxsize=METRIC_CACHE_SIZE, ttl_seconds=METRIC_CACHE_TTL)
+event_bus.subscribe(ROWS_SAVED, metric_cache.on_rows_saved)
+
+# Columns needed by the glucose metrics which do not need the full records
+GLUCOSE_COLUMNS = ("timestamp", "glucose")
 
 # Add routing
 home = Home.as_view(
     "home",
 )
 app.add_url_rule("/", view_func=home)
-GlucoseRecords = Metric.as_view(
+GlucoseRecords = StreamRecords.as_view(
     "glucose",
     TimeIntervalSchema(),
     glucose_manager,
-    lambda x: glucose_raw_data(x),
 )
 StravaRecords = Metric.as_view(
     "strava",
@@ -133,42 +183,60 @@ Hba1c = Metric.as_view(
     TimeIntervalSchema(),
     glucose_manager,
     lambda x: libre_hba1c(x),
+    columns=GLUCOSE_COLUMNS,
+    cache=metric_cache,
+    rollup=(daily_mean_manager, libre_hba1c_from_daily_means),
 )
 LibrePercentage = Metric.as_view(
     "libre-percentage",
     TimeIntervalSchema(),
     glucose_manager,
     lambda x: libre_extremes_in_buckets(x),
+    cache=metric_cache,
+    rollup=(rollup_manager, libre_extremes_in_rollup_buckets),
 )
 LibrePercentageDayOverview = Metric.as_view(
     "libre-percentage-day-overview",
     TimeIntervalWithBucketSchema(),
     glucose_manager,
     lambda x, **kwargs: libre_data_bucketed_day_overview(x, **kwargs),
+    cache=metric_cache,
 )
 Aggregate15min = Metric.as_view(
     "test",
-    TimeIntervalSchema(),
+    TimeIntervalApproximateSchema(),
     glucose_manager,
     lambda x, **kwargs: aggregate_glucose_data(x, **kwargs),
+    cache=metric_cache,
+    # Without the raw values, so only on request
+    rollup=(rollup_manager, aggregate_glucose_rollup_data),
+    approximate_rollup=True,
 )
 StravaSummary = Metric.as_view(
     "strava-summary",
     TimeIntervalSchema(),
     strava,
     lambda x: run_sum_strava_data(x),
+    columns=("start_time", "activity_type", "distance"),
+    cache=metric_cache,
 )
 StravaLibreSummary = Metric.as_view(
     "strava-libre-summary",
     TimeIntervalSchema(),
     data_manager,
     lambda x: glucose_quartile_data(x),
+    cache=metric_cache,
 )
 LibreQuartileSummary = Metric.as_view(
     "libre-quartile-data",
-    TimeIntervalSchema(),
+    TimeIntervalApproximateSchema(),
     glucose_manager,
     lambda x: glucose_quartile_data(x),
+    columns=GLUCOSE_COLUMNS,
+    cache=metric_cache,
+    # The quartiles are read from the sketches, so only on request
+    rollup=(rollup_manager, glucose_quartile_rollup_data),
+    approximate_rollup=True,
 )
 GroupedLibreDayData = Metric.as_view(
     "libre-grouped-day-data",
@@ -187,6 +255,18 @@ app.add_url_rule("/glucose/percentage", view_func=LibrePercentage)
 app.add_url_rule("/glucose/percentage/day", view_func=LibrePercentageDayOverview)
 app.add_url_rule("/glucose/quartile", view_func=LibreQuartileSummary)
 app.add_url_rule("/glucose/days", view_func=GroupedLibreDayData)
+app.add_url_rule(
+    "/monitoring/database",
+    view_func=Monitoring.as_view("monitoring-database", pool_monitor.get_metrics),
+)
+app.add_url_rule(
+    "/monitoring/metric-cache",
+    view_func=Monitoring.as_view("monitoring-metric-cache", metric_cache.get_metrics),
+)
+app.add_url_rule(
+    "/monitoring/crons",
+    view_func=Monitoring.as_view("monitoring-crons", cron_counters.get_metrics),
+)
 
 # Move these Cron Jobs to AWS lambdas or Azure equivalents
 # TO disable
@@ -195,7 +275,19 @@ scheduler.add_job(
     func=libre_cron, args=[glucose_manager], trigger="interval", seconds=300
 )
 scheduler.add_job(func=strava_cron, args=[strava], trigger="interval", seconds=300)
-scheduler.add_job(func=data_cron, args=[data_manager], trigger="interval", seconds=30)
+if STRAVA_BACKFILL:
+    # Runs once, resuming from its checkpoint after a restart or, rescheduled by
+    # itself, after the daily rate limit resets
+    scheduler.add_job(
+        func=strava_backfill_cron, args=[strava], kwargs={"scheduler": scheduler}
+    )
+# Roll up the readings saved before the rollups and daily means were maintained,
+# resuming from the checkpoint of the previous rebuild, then the ones saved since
+scheduler.add_job(func=rollup_rebuild_cron, args=[rollup_manager])
+scheduler.add_job(func=rollup_rebuild_cron, args=[daily_mean_manager])
+# Combining is triggered by the saved rows, this only reconciles rows saved
+# outside of the app and is skipped when nothing new landed
+scheduler.add_job(func=data_cron, args=[data_manager], trigger="interval", seconds=900)
 
 
 with app.app_context():
@@ -1,11 +1,14 @@
 import logging
+from datetime import timedelta
+from src.events import ROWS_SAVED
 
 logger = logging.getLogger(__name__)
 
 
 class Base:
-    def __init__(self, db_manager):
+    def __init__(self, db_manager, event_bus=None):
         self.db_manager = db_manager
+        self.event_bus = event_bus
 
     @property
     def name(self):
@@ -15,6 +18,19 @@ class Base:
     def table(self):
         raise NotImplementedError("Not implemented db table")
 
+    @property
+    def columns(self):
+        """The columns, in order, of the rows passed to _save_data"""
+        raise NotImplementedError("Not implemented db columns")
+
+    @property
+    def invalidated_by(self):
+        """
+        The tables whose saved rows change the data, with how far outside
+        of their times, for invalidating the cached metrics
+        """
+        return {self.table: timedelta(0)}
+
     def get_records_between_timestamp(self, start_time, end_time):
         """
         Get the strava libre data between the end/start times
@@ -24,12 +40,52 @@ class Base:
             self.table, start_time, end_time
         )
 
+    def get_columns_between_timestamp(self, start_time, end_time, columns):
+        """
+        Get only the given columns of the data between the end/start times
+        """
+        logger.debug(
+            f"get_columns_between_timestamp({start_time}, {end_time}, {columns})"
+        )
+        return self.db_manager.get_columns_between_timestamp(
+            self.table, columns, start_time, end_time
+        )
+
+    def stream_records_between_timestamp(self, start_time, end_time, chunk_size=1000):
+        """
+        Stream the data between the end/start times in chunks
+        """
+        logger.debug(f"stream_records_between_timestamp({start_time}, {end_time})")
+        return self.db_manager.stream_records_between_timestamp(
+            self.table, start_time, end_time, chunk_size=chunk_size
+        )
+
     def _get_last_record(self):
         logger.debug(f"Getting last record from {self.name}")
         return self.db_manager.get_last_record(self.table)
 
+    def _publish_rows_saved(self, ids, times=()):
+        """Publish the range of ids and times saved to the subscribers, if any"""
+        if self.event_bus is not None:
+            self.event_bus.publish(
+                ROWS_SAVED,
+                table=self.table,
+                first_id=min(ids),
+                last_id=max(ids),
+                first_time=min(times, default=None),
+                last_time=max(times, default=None),
+            )
+
     def _save_data(self, records_to_save):
         logger.info(f"Saving {len(records_to_save)} to {self.name}")
         if records_to_save:
-            self.db_manager.save_data(records_to_save)
+            self.db_manager.bulk_insert(self.table, self.columns, records_to_save)
+            id_index = self.columns.index("id")
+            time_field = getattr(self.table, "__time_field__", None)
+            times = ()
+            if time_field in self.columns:
+                time_index = self.columns.index(time_field)
+                times = [row[time_index] for row in records_to_save]
+            self._publish_rows_saved([row[id_index] for row in records_to_save], times)
         logger.info(f"Successfully saved {len(records_to_save)} to {self.name}")
+        return len(records_to_save)
@@ -0,0 +1,149 @@
+"""
+Benchmark the metrics against their previous pandas implementations
+
+    python -m src.benchmark hba1c --days 90
+    python -m src.benchmark strava-summary --days 3650
+"""
+import argparse
+import logging
+import timeit
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+
+from src.database.tables import Strava
+from src.utils import get_glucose_columns, libre_hba1c, run_sum_strava_data
+
+logger = logging.getLogger(__name__)
+
+
+def libre_hba1c_pandas(data):
+    """
+    The previous pandas implementation of libre_hba1c, kept as its reference
+    """
+    if len(data) < 2:
+        return {"hBA1C": None}
+
+    timestamp_list, glucose_list = get_glucose_columns(data)
+    total_seconds = (timestamp_list[-1] - timestamp_list[0]).total_seconds()
+    if total_seconds < 60 * 60:
+        return {"hBA1C": None}
+
+    df = pd.DataFrame({"timestamp": timestamp_list, "glucose": glucose_list})
+    df["time_diff"] = df["timestamp"].diff()
+    df["time_diff"] = df["time_diff"].fillna(pd.Timedelta(seconds=0))
+    df["time_diff"] = list(map(lambda x: x.total_seconds(), df["time_diff"]))
+    df["glucose_diff"] = df["glucose"].rolling(2).mean()
+    df["rolling_mean"] = list(
+        map(
+            lambda x, y: 0 if x == 0 else abs(y) * (x / total_seconds),
+            df["time_diff"],
+            df["glucose_diff"],
+        )
+    )
+    return {"hBA1C": df["rolling_mean"].sum()}
+
+
+def run_sum_strava_data_pandas(data):
+    """
+    The previous pandas implementation of run_sum_strava_data, kept as its reference
+    """
+    ordered_data = sorted(data, key=lambda x: x.start_time)
+    activity_list = list(map(lambda x: x.activity_type, ordered_data))
+    df = pd.DataFrame(
+        {
+            "timestamp": list(map(lambda x: x.start_time, ordered_data)),
+            "activity": activity_list,
+            "distance": list(map(lambda x: x.distance, ordered_data)),
+        }
+    )
+    df = df.fillna(0)
+    df["total_distance"] = df[["activity", "distance"]].groupby(["activity"]).cumsum()
+    df["number_activities"] = (
+        df[["activity", "distance"]].groupby(["activity"]).cumcount() + 1
+    )
+    return {
+        key: {
+            "timestampData": [
+                {
+                    "timestamp": row["timestamp"].to_pydatetime(),
+                    "distance": row["distance"],
+                    "totalDistance": row["total_distance"],
+                }
+                for _idx, row in df.loc[df["activity"] == key].iterrows()
+            ],
+            "count": max(df.loc[df["activity"] == key]["number_activities"].to_list()),
+        }
+        for key in sorted(list(set(activity_list)))
+    }
+
+
+def generate_readings(days, interval=timedelta(minutes=1), seed=0):
+    """A DataFrame of the timestamp and glucose columns of days of readings"""
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    count = int(timedelta(days=days) / interval)
+    return pd.DataFrame(
+        {
+            "timestamp": pd.date_range(start, periods=count, freq=interval),
+            "glucose": np.round(np.random.default_rng(seed).uniform(3, 15, count), 1),
+        }
+    )
+
+
+def generate_activities(days, per_day=3, seed=0):
+    """Strava records of days of activities, in random order"""
+    rng = np.random.default_rng(seed)
+    start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+    count = days * per_day
+    offsets = rng.permutation(days * 24 * 60)[:count]
+    activity_types = rng.choice(["RUN", "RIDE", "WALK", "SWIM", "HIKE"], count)
+    distances = np.round(rng.uniform(1000, 40000, count), 1)
+    return [
+        Strava(
+            start_time=start + timedelta(minutes=int(offset)),
+            activity_type=str(activity_type),
+            distance=float(distance),
+        )
+        for offset, activity_type, distance in zip(offsets, activity_types, distances)
+    ]
+
+
+BENCHMARKS = {
+    "hba1c": (libre_hba1c, libre_hba1c_pandas, generate_readings),
+    "strava-summary": (
+        run_sum_strava_data,
+        run_sum_strava_data_pandas,
+        generate_activities,
+    ),
+}
+
+
+def run_benchmark(metric, reference, data, repeat=5):
+    """The best of repeat seconds of the metric and of its reference"""
+    return (
+        min(timeit.repeat(lambda: metric(data), number=1, repeat=repeat)),
+        min(timeit.repeat(lambda: reference(data), number=1, repeat=repeat)),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("metric", choices=BENCHMARKS)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s", level="INFO")
+
+    metric, reference, generate = BENCHMARKS[args.metric]
+    data = generate(args.days)
+    seconds, reference_seconds = run_benchmark(metric, reference, data, args.repeat)
+    logger.info(
+        f"{args.metric} of {len(data)} rows: {seconds * 1000:.1f}ms, "
+        f"previously {reference_seconds * 1000:.1f}ms "
+        f"({reference_seconds / seconds:.0f}x faster)"
+    )
+    return seconds, reference_seconds
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,102 @@
 import logging
+import threading
+
+from src.strava import StravaRateLimitError
 
 logger = logging.getLogger(__name__)
 
 
-def libre_cron(libre):
-    """Specific libre CRON as it requires a high frequency"""
+class CronCounters:
+    """
+    Count the executed and skipped runs of each cron job for monitoring
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, job, executed):
+        with self._lock:
+            counts = self.counts.setdefault(job, {"executed": 0, "skipped": 0})
+            counts["executed" if executed else "skipped"] += 1
+
+    def get_metrics(self):
+        with self._lock:
+            return {job: dict(counts) for job, counts in self.counts.items()}
+
+
+cron_counters = CronCounters()
+
+
+def libre_cron(libre, counters=cron_counters):
+    """
+    Specific libre CRON as it requires a high frequency.
+    The graphs of the patients with a new measurement are fetched concurrently
+    """
     try:
-        patient_ids = libre.get_patient_ids()
-        for patient_id in patient_ids:
-            libre.update_cgm_data(patient_id)
+        fetched = libre.update_all_cgm_data(libre.get_latest_measurement_times())
+        for new_data in fetched.values():
+            counters.record("libre", new_data)
     except Exception as e:
         logger.error(f"Failed getting Libre data with exception\n:{e}")
 
 
-def strava_cron(strava):
+def strava_cron(strava, counters=cron_counters):
     """
     Specific CRON for strava as only a set number of pulls are permitted per day
     """
     try:
         strava.update_data(records_per_page=100, page=1)
+        counters.record("strava", True)
     except Exception as e:
         logger.error(f"Failed getting Strava data with exception\n:{e}")
 
 
-def data_cron(data):
+def strava_backfill_cron(strava, counters=cron_counters, scheduler=None):
+    """
+    Save the whole Strava activity history, resuming from its checkpoint.
+    When the daily rate limit is reached it is rescheduled on the scheduler
+    for when the limit resets
+    """
+    try:
+        strava.update_data(records_per_page=100, backfill=True)
+        counters.record("strava_backfill", True)
+    except StravaRateLimitError as e:
+        counters.record("strava_backfill", False)
+        if scheduler is None:
+            logger.error(f"Stopped backfilling Strava data: {e}")
+            return
+        logger.warning(f"Resuming the Strava backfill at {e.reset_time}: {e}")
+        scheduler.add_job(
+            func=strava_backfill_cron,
+            args=[strava],
+            kwargs={"scheduler": scheduler},
+            trigger="date",
+            run_date=e.reset_time,
+        )
+    except Exception as e:
+        logger.error(f"Failed backfilling Strava data with exception\n:{e}")
+
+
+def rollup_rebuild_cron(rollup, counters=cron_counters):
+    """
+    Roll up all the glucose readings saved before the rollups were maintained,
+    of either the RollupManager or the DailyMeanManager
+    """
+    try:
+        rollup.rebuild()
+        counters.record("rollup_rebuild", True)
+    except Exception as e:
+        logger.error(f"Failed rebuilding the glucose rollups with exception\n:{e}")
+
+
+def data_cron(data, counters=cron_counters):
     """
-    Specific CRON for data to mutate the fetched data
+    Specific CRON for data to mutate the fetched data,
+    skipped when no strava or glucose rows landed since the last run
     """
     try:
-        data.combine_data()
+        counters.record("data", data.combine_new_data())
     except Exception as e:
         logger.error(
             f"Failed combining the strava data with libre ones, exception\n:{e}"
@@ -1,17 +1,31 @@
 from datetime import timedelta
 import logging
+import threading
+import pandas as pd
 
 from src.base import Base
 from src.database.tables import Glucose, GlucoseExercise, Strava
+from src.utils import assign_to_intervals, merge_intervals
 
 logger = logging.getLogger(__name__)
 
 
 class DataManager(Base):
     """
-    Class to mutate the Strava and Libre data and combine them
+    Class to mutate the Strava and Libre data and combine them.
+    With combine_in_database the join runs as a single INSERT ... SELECT
+    in the database instead of matching the records in Python.
     """
 
+    def __init__(self, db_manager, combine_in_database=False):
+        super().__init__(db_manager)
+        self.combine_in_database = combine_in_database
+        # The max strava and glucose ids at the last combine
+        self.watermark = None
+        # Combines may be triggered from the ingest threads and the cron at once,
+        # the database lock also serialises them with the importer's
+        self._lock = threading.RLock()
+
     @property
     def name(self):
         return "GlucoseExercise"
@@ -20,62 +34,146 @@ class DataManager(Base):
     def table(self):
         return GlucoseExercise
 
-    def _get_glucose_records_within_interval(self, start_time, end_time):
-        logger.debug(
-            f"Getting glucose records within interval {start_time} - {end_time} for Glucose"
+    @property
+    def invalidated_by(self):
+        # Glucose is combined up to an hour either side of the activities
+        return {
+            GlucoseExercise: timedelta(0),
+            Glucose: timedelta(0),
+            Strava: timedelta(seconds=3600),
+        }
+
+    @property
+    def columns(self):
+        return (
+            "id",
+            "strava_id",
+            "glucose_id",
+            "distance",
+            "timestamp",
+            "activity_start",
+            "activity_end",
+            "activity_type",
+            "seconds_since_start",
         )
-        return self.db_manager.get_records_between_timestamp(
-            Glucose, start_time, end_time
+
+    def _get_glucose_within_intervals(self, intervals):
+        logger.debug(f"Getting glucose within {len(intervals)} intervals for Glucose")
+        return self.db_manager.get_columns_within_intervals(
+            Glucose, ("id", "timestamp"), intervals
         )
 
+    def combine_new_data(self):
+        """
+        Combine the data only when strava or glucose rows landed since the last
+        combine, checked against the watermark with a single max(id) query.
+        Returns whether the data was combined
+        """
+        with self._lock:
+            watermark = self.db_manager.get_max_ids(Strava, Glucose)
+            if watermark == self.watermark:
+                logger.debug(f"No new data since watermark {watermark}, skipping")
+                return False
+            self.combine_data()
+            self.watermark = watermark
+            return True
+
+    def on_rows_saved(self, table, first_id, last_id, first_time=None, last_time=None):
+        """
+        Combine the activities affected by newly saved strava or glucose rows,
+        subscribed to the ROWS_SAVED events of the ingest managers.
+        In the database only the saved id range is joined, otherwise the new
+        activities are combined in Python, the saved times are not needed.
+        Returns the number of rows inserted
+        """
+        if table not in (Strava, Glucose):
+            return 0
+        logger.info(f"{table.__tablename__} rows {first_id}-{last_id} saved")
+        with self._lock:
+            if not self.combine_in_database:
+                return self.combine_data()
+            ids = {
+                "strava_ids" if table == Strava else "glucose_ids": (first_id, last_id)
+            }
+            count = self.db_manager.combine_glucose_exercise(**ids, window_seconds=3600)
+            logger.info(f"Combined {count} rows in the database to {self.name}")
+            return count
+
     def combine_data(self):
         """
         Retrieve the last record in the DB relating to this data
         Get all strava data after that date.
         (We do not get all missing strava data as there may not be any glucose data,
         so we dont want to needlessly check it again.)
-        Retrieve all the glucose data within those time ranges
+        Retrieve all the glucose data within those time ranges, with a single query
+        over the union of the activity windows, and match it to each activity
+
+        Returns the number of rows inserted
 
         # TODO: Need to omit overlapping exercises (run/walk that are less than 60 minutes apart)
         """
         logger.info("*" * 50 + "\n" + " " * 20 + "combine_data()" + " " * 20 + "*" * 50)
-        new_records = []
         # Get last record in the database
         last_record = self._get_last_record()
-        last_id = last_record.id
-        last_checked_strava_id = last_record.strava_id
-        new_entry_id = last_id + 1
+        if self.combine_in_database:
+            count = self.db_manager.combine_glucose_exercise(
+                strava_ids=(last_record.strava_id + 1, None), window_seconds=3600
+            )
+            logger.info(f"Combined {count} rows in the database to {self.name}")
+            return count
         unchecked_strava_records = self.db_manager.get_filtered_by_id_records(
-            Strava, last_checked_strava_id
+            Strava, last_record.strava_id
+        )
+        if not unchecked_strava_records:
+            logger.info("No new strava records to combine")
+            return 0
+        # ' Would be negative if activity_start_time instead of start time
+        # but we just presume for now offset is always 60mins. More robust to
+        # do -negatives from the start time though.'
+        window_starts = [
+            rec.start_time - timedelta(seconds=3600) for rec in unchecked_strava_records
+        ]
+        window_ends = [
+            rec.end_time + timedelta(seconds=3600) for rec in unchecked_strava_records
+        ]
+        glucose = self._get_glucose_within_intervals(
+            merge_intervals(zip(window_starts, window_ends))
+        )
+        return self._save_data(
+            self._match_glucose_to_activities(
+                last_record.id + 1,
+                unchecked_strava_records,
+                glucose,
+                window_starts,
+                window_ends,
+            )
         )
-        # Iterate through the unchecked records in the libre db to find them either side of a window
-        for unchecked_strava_record in unchecked_strava_records:
-            logger.debug(f"Processing {unchecked_strava_record}")
-            libre_records = self._get_glucose_records_within_interval(
-                unchecked_strava_record.start_time - timedelta(seconds=3600),
-                unchecked_strava_record.end_time + timedelta(seconds=3600),
+
+    def _match_glucose_to_activities(
+        self, first_id, strava_records, glucose, window_starts, window_ends
+    ):
+        """
+        Create a row for each glucose reading within each activity window
+        """
+        activity_index, glucose_index = assign_to_intervals(
+            glucose["timestamp"], window_starts, window_ends
+        )
+        activities = [strava_records[idx] for idx in activity_index.tolist()]
+        timestamps = glucose["timestamp"].array.take(glucose_index)
+        seconds_since_start = (
+            pd.to_datetime(timestamps, utc=True)
+            - pd.to_datetime([rec.start_time for rec in activities], utc=True)
+        ).total_seconds()
+        return list(
+            zip(
+                range(first_id, first_id + len(activities)),
+                [rec.id for rec in activities],
+                glucose["id"].to_numpy()[glucose_index].tolist(),
+                [rec.distance for rec in activities],
+                list(timestamps),
+                [rec.start_time for rec in activities],
+                [rec.end_time for rec in activities],
+                [rec.activity_type for rec in activities],
+                seconds_since_start.tolist(),
             )
-            for libre_record in libre_records:
-                # ' Would be negative if activity_start_time instead of start time
-                # but we just presume for now offset is always 60mins. More robust to
-                # do -negatives from the start time though.'
-                timestamp_since_start = (
-                    libre_record.timestamp - unchecked_strava_record.start_time
-                ).total_seconds()
-                new_records.append(
-                    GlucoseExercise(
-                        id=new_entry_id,
-                        strava_id=unchecked_strava_record.id,
-                        glucose_rec=libre_record,
-                        glucose_id=libre_record.id,
-                        distance=unchecked_strava_record.distance,
-                        timestamp=libre_record.timestamp,
-                        activity_start=unchecked_strava_record.start_time,
-                        activity_end=unchecked_strava_record.end_time,
-                        activity_type=unchecked_strava_record.activity_type,
-                        seconds_since_start=timestamp_since_start,
-                    )
-                )
-                # Increment index
-                new_entry_id += 1
-        self._save_data(new_records)
+        )
@@ -0,0 +1,176 @@
+"""
+SQLAlchemy engine configuration and monitoring
+"""
+import logging
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+
+def _env_bool(name, default):
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes")
+
+
+def load_engine_settings_from_env():
+    """
+    The engine and pool settings, optionally set via environment variables
+    """
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": _env_bool("DB_POOL_PRE_PING", True),
+        "echo": _env_bool("DB_ECHO", False),
+    }
+
+
+def load_database_url_from_env():
+    """The Postgres database url, from the DB_HOST and DB_NAME environment variables"""
+    # TODO - protect env vars
+    root = "diabetes_root:diabetes_root"
+    host = os.environ["DB_HOST"]
+    db_name = os.environ["DB_NAME"]
+    return f"postgresql+psycopg2://{root}@{host}:5432/{db_name}"
+
+
+def load_slow_query_threshold_from_env():
+    """Seconds a query may take before it is logged, 0 disables the logging"""
+    return float(os.getenv("DB_SLOW_QUERY_SECONDS", "0.5"))
+
+
+def create_database_engine(url, **kwargs):
+    """
+    Create the engine with the environment's pool settings, timing the waits
+    for a connection, and logging the queries slower than the configured threshold
+    """
+    settings = {
+        **load_engine_settings_from_env(),
+        "poolclass": TimedQueuePool,
+        **kwargs,
+    }
+    logger.info(
+        f"Creating engine with pool_size={settings['pool_size']}, "
+        f"max_overflow={settings['max_overflow']}, echo={settings['echo']}"
+    )
+    engine = create_engine(url, **settings)
+    register_slow_query_logger(engine, load_slow_query_threshold_from_env())
+    return engine
+
+
+def register_slow_query_logger(engine, threshold_seconds):
+    """
+    Log every statement that takes longer than threshold_seconds to execute
+    """
+    if threshold_seconds <= 0:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        if elapsed > threshold_seconds:
+            logger.warning(f"Slow query ({elapsed:.3f}s): {statement}")
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is None:
+            return
+        start_times = context.connection.info.get("query_start_time")
+        if start_times:
+            start_times.pop()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    A QueuePool timing each get of a connection, waiting for one to be checked in
+    or opening a new one, as the wait_seconds of the connection record's info
+    for the checkout listeners. The pool has no event before a checkout
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        connection_record = super()._do_get()
+        connection_record.info["wait_seconds"] = time.perf_counter() - start
+        return connection_record
+
+
+class PoolMonitor:
+    """
+    Track the connection pool checkouts of an engine for monitoring, the seconds
+    waited for a connection from a TimedQueuePool and the seconds it is then held
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.invalidations = 0
+        self.total_hold_seconds = 0.0
+        self.waits = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checkout_time"] = time.perf_counter()
+        wait_seconds = connection_record.info.pop("wait_seconds", None)
+        with self._lock:
+            if wait_seconds is not None:
+                self.waits += 1
+                self.total_wait_seconds += wait_seconds
+                self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        checkout_time = connection_record.info.pop("checkout_time", None)
+        if checkout_time is None:
+            return
+        with self._lock:
+            self.checked_out -= 1
+            self.total_hold_seconds += time.perf_counter() - checkout_time
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def get_metrics(self):
+        pool = self.engine.pool
+        with self._lock:
+            return {
+                "poolSize": pool.size(),
+                "overflow": pool.overflow(),
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkedOut": self.checked_out,
+                "peakCheckedOut": self.peak_checked_out,
+                "invalidations": self.invalidations,
+                # Waiting for a connection, rather than holding one
+                "meanWaitSeconds": (
+                    self.total_wait_seconds / self.waits if self.waits else 0
+                ),
+                "maxWaitSeconds": self.max_wait_seconds,
+                "meanHoldSeconds": (
+                    self.total_hold_seconds / self.checkouts if self.checkouts else 0
+                ),
+            }
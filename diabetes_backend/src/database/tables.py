@@ -2,9 +2,18 @@
 Base ORM class
 """
 import datetime
-from sqlalchemy import DateTime, Float, String, BigInteger, ForeignKey
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+)
 from sqlalchemy.orm import Mapped, relationship, DeclarativeBase, mapped_column
-from typing import List
+from typing import List, Optional
 
 
 class Base(DeclarativeBase):
@@ -15,7 +24,9 @@ class Base(DeclarativeBase):
 class Glucose(Base):
     __tablename__ = "glucose_level"
     id: Mapped[int] = mapped_column(primary_key=True)
-    timestamp: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    timestamp: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), index=True
+    )
     glucose: Mapped[float] = mapped_column(Float)
     glucose_exercise: Mapped["GlucoseExercise"] = relationship(
         back_populates="glucose_rec"
@@ -42,7 +53,9 @@ class Strava(Base):
     activity_type: Mapped[str] = mapped_column(String)
     moving_time: Mapped[float] = mapped_column(Float)
     elapsed_time: Mapped[float] = mapped_column(Float)
-    start_time: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    start_time: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), index=True
+    )
     end_time: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
 
     __time_field__ = "start_time"
@@ -63,11 +76,90 @@ class GlucoseExercise(Base):
     distance: Mapped[float] = mapped_column(Float)
     activity_type: Mapped[str] = mapped_column(String)
     seconds_since_start: Mapped[float] = mapped_column(Float)
-    timestamp: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    timestamp: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), index=True
+    )
     activity_start: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
     activity_end: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
 
     __time_field__ = "timestamp"
+    # Checked before combining an activity with a glucose reading
+    __table_args__ = (
+        Index("ix_glucose_exercise_strava_id_glucose_id", "strava_id", "glucose_id"),
+    )
 
     def __repr__(self) -> str:
         return f"GlucoseExercise(id={self.id!r}, timestamp={self.timestamp!r}, activity_type={self.activity_type!r}, distance={self.distance!r}, glucose_id={self.glucose_id!r}, glucose_id={self.strava_id!r})"
+
+
+class Checkpoint(Base):
+    __tablename__ = "checkpoint"
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    value: Mapped[int] = mapped_column(BigInteger)
+    updated_at: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+
+    def __repr__(self) -> str:
+        return f"Checkpoint(name={self.name!r}, value={self.value!r}, updated_at={self.updated_at!r})"
+
+
+class GlucoseRollup(Base):
+    """
+    The glucose readings rolled up into 15 minute buckets, maintained as they are
+    saved. The percentages are of the time in the bucket, interpolated between
+    the readings, first_time and last_time are the times of its first and last
+    readings and the sketch is a HistogramSketch of the readings
+    """
+
+    __tablename__ = "glucose_rollup_15min"
+
+    bucket_start: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), primary_key=True
+    )
+    count: Mapped[int] = mapped_column(Integer)
+    sum: Mapped[float] = mapped_column(Float)
+    sum_of_squares: Mapped[float] = mapped_column(Float)
+    min: Mapped[Optional[float]] = mapped_column(Float)
+    max: Mapped[Optional[float]] = mapped_column(Float)
+    first_time: Mapped[Optional[datetime.datetime]] = mapped_column(
+        DateTime(timezone=True)
+    )
+    last_time: Mapped[Optional[datetime.datetime]] = mapped_column(
+        DateTime(timezone=True)
+    )
+    percentage_high: Mapped[Optional[float]] = mapped_column(Float)
+    percentage_low: Mapped[Optional[float]] = mapped_column(Float)
+    percentage_in_range: Mapped[Optional[float]] = mapped_column(Float)
+    number_of_highs: Mapped[Optional[int]] = mapped_column(Integer)
+    number_of_lows: Mapped[Optional[int]] = mapped_column(Integer)
+    sketch: Mapped[dict] = mapped_column(JSON)
+
+    __time_field__ = "bucket_start"
+
+    def __repr__(self) -> str:
+        return f"GlucoseRollup(bucket_start={self.bucket_start!r}, count={self.count!r}, min={self.min!r}, max={self.max!r})"
+
+
+class GlucoseDailyMean(Base):
+    """
+    The TimeWeightedMean accumulators of each UTC day of glucose readings,
+    maintained as they are saved and merged for the hBA1C of long windows
+    """
+
+    __tablename__ = "glucose_daily_mean"
+
+    day: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), primary_key=True
+    )
+    weighted_sum: Mapped[float] = mapped_column(Float)
+    seconds: Mapped[float] = mapped_column(Float)
+    count: Mapped[int] = mapped_column(Integer)
+    first_time: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    first_glucose: Mapped[float] = mapped_column(Float)
+    last_time: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    last_glucose: Mapped[float] = mapped_column(Float)
+
+    __time_field__ = "day"
+
+    def __repr__(self) -> str:
+        return f"GlucoseDailyMean(day={self.day!r}, count={self.count!r}, seconds={self.seconds!r})"
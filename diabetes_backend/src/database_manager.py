@@ -1,11 +1,26 @@
+import csv
 import datetime
+import io
 import logging
+import time
+import pandas as pd
 from sqlalchemy.orm import Session
-from sqlalchemy import select, literal_column
-from src.database.tables import Glucose, Strava, GlucoseExercise
+from sqlalchemy import extract, insert, or_, select, func
+from sqlalchemy.dialects import postgresql, sqlite
+from src.database.tables import (
+    Checkpoint,
+    Glucose,
+    GlucoseExercise,
+    GlucoseDailyMean,
+    GlucoseRollup,
+    Strava,
+)
 
 logger = logging.getLogger(__name__)
 
+# The Postgres advisory lock serialising the combines of every process
+COMBINE_GLUCOSE_EXERCISE_LOCK = 7_147_301
+
 
 class DatabaseManager:
     def __init__(self, engine):
@@ -24,8 +39,227 @@ class DatabaseManager:
             session.add_all(data)
             session.commit()
 
+    def _log_throughput(self, table, count, start):
+        elapsed = time.perf_counter() - start
+        rate = count / elapsed if elapsed > 0 else float("inf")
+        logger.info(
+            f"Inserted {count} rows into {table.__tablename__} "
+            f"in {elapsed:.3f}s ({rate:.0f} rows/s)"
+        )
+
+    def _dialect_insert(self, table):
+        """The insert of the dialect, supporting ON CONFLICT clauses"""
+        dialect_insert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+        if self.engine.dialect.name not in dialect_insert:
+            raise ValueError(
+                f"Cannot handle conflicts with the {self.engine.dialect.name} dialect"
+            )
+        return dialect_insert[self.engine.dialect.name](table)
+
+    def _insert(self, table, ignore_conflicts):
+        if not ignore_conflicts:
+            return insert(table)
+        return self._dialect_insert(table).on_conflict_do_nothing()
+
+    def bulk_insert(self, table, columns, rows, ignore_conflicts=False):
+        """
+        Insert the rows, tuples of values in the order of the columns, into the
+        table with a single executemany, without building ORM objects.
+        With ignore_conflicts rows already present (ON CONFLICT DO NOTHING) are skipped.
+        Returns the number of rows inserted, without the skipped ones
+        """
+        logging.debug(f"bulk_insert({table}, {columns})")
+        self._validate_data_type(table)
+        rows = [dict(zip(columns, row)) for row in rows]
+        if not rows:
+            return 0
+        stmt = self._insert(table, ignore_conflicts)
+        if ignore_conflicts:
+            # The rowcount of an executemany is not reliable, so the primary keys
+            # of the inserted rows are returned instead
+            stmt = stmt.returning(*table.__table__.primary_key)
+        start = time.perf_counter()
+        with self.engine.begin() as connection:
+            result = connection.execute(stmt, rows)
+            inserted = len(result.all()) if ignore_conflicts else len(rows)
+        self._log_throughput(table, inserted, start)
+        return inserted
+
+    def upsert(self, table, columns, rows):
+        """
+        Insert the rows, tuples of values in the order of the columns, into the
+        table with a single executemany, updating the rows already present
+        (ON CONFLICT DO UPDATE of the primary key).
+        Returns the number of rows inserted or updated
+        """
+        logging.debug(f"upsert({table}, {columns})")
+        self._validate_data_type(table)
+        rows = [dict(zip(columns, row)) for row in rows]
+        if not rows:
+            return 0
+        stmt = self._dialect_insert(table)
+        primary_key = [column.name for column in table.__table__.primary_key]
+        stmt = stmt.on_conflict_do_update(
+            index_elements=primary_key,
+            set_={
+                column: stmt.excluded[column]
+                for column in columns
+                if column not in primary_key
+            },
+        )
+        start = time.perf_counter()
+        with self.engine.begin() as connection:
+            connection.execute(stmt, rows)
+        self._log_throughput(table, len(rows), start)
+        return len(rows)
+
+    def copy_rows(self, table, columns, rows):
+        """
+        Load the rows, tuples of values in the order of the columns, into the
+        table with PostgreSQL's COPY FROM STDIN, the fastest path for large loads.
+        Other databases fall back to bulk_insert.
+        Returns the number of rows loaded
+        """
+        logging.debug(f"copy_rows({table}, {columns})")
+        self._validate_data_type(table)
+        if self.engine.dialect.name != "postgresql":
+            return self.bulk_insert(table, columns, rows)
+        buffer = io.StringIO()
+        count = 0
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        if not count:
+            return 0
+        buffer.seek(0)
+        start = time.perf_counter()
+        connection = self.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY {table.__tablename__} ({', '.join(columns)}) "
+                    "FROM STDIN WITH (FORMAT csv)",
+                    buffer,
+                )
+            connection.commit()
+        finally:
+            connection.close()
+        self._log_throughput(table, count, start)
+        return count
+
+    def _filter_id_range(self, column, ids):
+        """Inclusive (first, last) id range conditions, None being unbounded"""
+        first, last = ids
+        conditions = []
+        if first is not None:
+            conditions.append(column >= first)
+        if last is not None:
+            conditions.append(column <= last)
+        return conditions
+
+    def combine_glucose_exercise(
+        self, strava_ids=(None, None), glucose_ids=(None, None), window_seconds=3600
+    ):
+        """
+        Materialise the missing glucose_exercise rows with a single
+        INSERT ... SELECT, joining the glucose readings within window_seconds
+        either side of each activity in the database so no rows are sent to the
+        application. Only the strava and glucose ids within the inclusive
+        (first, last) ranges are joined, and pairs already combined are skipped.
+        Ids continue from the max id in activity then glucose time order, the
+        combines of the app and the importer taking turns on an advisory lock
+        so they never continue from the same max id.
+        Returns the number of rows inserted
+        """
+        logging.debug(f"combine_glucose_exercise({strava_ids}, {glucose_ids})")
+        window = datetime.timedelta(seconds=window_seconds)
+        combined = (
+            select(GlucoseExercise.id)
+            .where(GlucoseExercise.strava_id == Strava.id)
+            .where(GlucoseExercise.glucose_id == Glucose.id)
+        )
+        stmt = insert(GlucoseExercise).from_select(
+            [
+                "id",
+                "strava_id",
+                "glucose_id",
+                "distance",
+                "timestamp",
+                "activity_start",
+                "activity_end",
+                "activity_type",
+                "seconds_since_start",
+            ],
+            select(
+                select(func.coalesce(func.max(GlucoseExercise.id), 0))
+                .scalar_subquery()
+                .correlate(None)
+                + func.row_number().over(
+                    order_by=(Strava.id, Glucose.timestamp, Glucose.id)
+                ),
+                Strava.id,
+                Glucose.id,
+                Strava.distance,
+                Glucose.timestamp,
+                Strava.start_time,
+                Strava.end_time,
+                Strava.activity_type,
+                extract("epoch", Glucose.timestamp - Strava.start_time),
+            )
+            .join(
+                Glucose,
+                Glucose.timestamp.between(
+                    Strava.start_time - window, Strava.end_time + window
+                ),
+            )
+            .where(
+                *self._filter_id_range(Strava.id, strava_ids),
+                *self._filter_id_range(Glucose.id, glucose_ids),
+                ~combined.exists(),
+            ),
+        )
+        start = time.perf_counter()
+        with self.engine.begin() as connection:
+            if self.engine.dialect.name == "postgresql":
+                # Held until the commit, so the max id is read after the
+                # rows of the previous combine are committed.
+                # SQLite already serialises the writing transactions
+                connection.execute(
+                    select(func.pg_advisory_xact_lock(COMBINE_GLUCOSE_EXERCISE_LOCK))
+                )
+            count = connection.execute(stmt).rowcount
+        self._log_throughput(GlucoseExercise, count, start)
+        return count
+
+    def get_checkpoint(self, name):
+        """Fetch the value of the checkpoint, 0 when it was never saved"""
+        logging.debug(f"get_checkpoint({name})")
+        with Session(self.engine) as session:
+            checkpoint = session.get(Checkpoint, name)
+            return checkpoint.value if checkpoint else 0
+
+    def save_checkpoint(self, name, value):
+        """Save the value of the checkpoint, replacing the previous one"""
+        logging.debug(f"save_checkpoint({name}, {value})")
+        with Session(self.engine) as session:
+            session.merge(
+                Checkpoint(
+                    name=name,
+                    value=value,
+                    updated_at=datetime.datetime.now(datetime.timezone.utc),
+                )
+            )
+            session.commit()
+
     def _validate_data_type(self, table):
-        if table not in (Glucose, Strava, GlucoseExercise):
+        if table not in (
+            Glucose,
+            Strava,
+            GlucoseExercise,
+            GlucoseRollup,
+            GlucoseDailyMean,
+        ):
             raise ValueError(f"Invalid data_type {table}")
 
     def _get_default_last_record(self, table):
@@ -61,6 +295,46 @@ class DatabaseManager:
             f"Cannot get default last record as {table} is not a valid table"
         )
 
+    def get_max_ids(self, *tables):
+        """
+        Fetch the max id of each table with a single query, 0 for empty tables
+        """
+        logging.debug(f"get_max_ids({tables})")
+        for table in tables:
+            self._validate_data_type(table)
+        stmt = select(
+            *(select(func.max(table.id)).scalar_subquery() for table in tables)
+        )
+        with self.engine.connect() as connection:
+            row = connection.execute(stmt).one()
+        return tuple(value or 0 for value in row)
+
+    def get_latest_timestamp(self, table):
+        """Fetch the latest value of the table's time field, None for empty tables"""
+        logging.debug(f"get_latest_timestamp({table})")
+        self._validate_data_type(table)
+        stmt = select(func.max(self._get_time_column(table)))
+        with self.engine.connect() as connection:
+            return connection.execute(stmt).scalar()
+
+    def get_earliest_timestamp(self, table):
+        """Fetch the earliest value of the table's time field, None for empty tables"""
+        logging.debug(f"get_earliest_timestamp({table})")
+        self._validate_data_type(table)
+        stmt = select(func.min(self._get_time_column(table)))
+        with self.engine.connect() as connection:
+            return connection.execute(stmt).scalar()
+
+    def get_existing_ids(self, table, ids):
+        """Fetch which of the ids are already in the table"""
+        logging.debug(f"get_existing_ids({table}, {len(ids)})")
+        self._validate_data_type(table)
+        if not ids:
+            return set()
+        stmt = select(table.id).where(table.id.in_(ids))
+        with self.engine.connect() as connection:
+            return set(connection.execute(stmt).scalars())
+
     def get_last_record(self, table):
         """Fetch the last record in the table"""
         logger.info(f"Getting last record of {table}")
@@ -71,19 +345,119 @@ class DatabaseManager:
             res = rec or self._get_default_last_record(table)
         return res
 
-    def get_records_between_timestamp(self, table, start, end, time_column="timestamp"):
-        """Fetch the records in the table for the given date range"""
-        logging.debug(f"get_records_between_timestamp({start},{end},{time_column})")
-        self._validate_data_type(table)
-        stmt = select(table).where(
-            (literal_column(time_column) <= end)
-            & (start <= literal_column(time_column))
+    def _get_time_column(self, table):
+        return getattr(table, table.__time_field__)
+
+    def _to_datetime(self, value):
+        """Bind timestamps as datetimes, parsing ISO formatted strings"""
+        if isinstance(value, str):
+            return datetime.datetime.fromisoformat(value)
+        return value
+
+    def _select_within_intervals(self, table, intervals, *entities):
+        time_column = self._get_time_column(table)
+        return (
+            select(*entities)
+            .where(
+                or_(
+                    *(
+                        time_column.between(
+                            self._to_datetime(start), self._to_datetime(end)
+                        )
+                        for start, end in intervals
+                    )
+                )
+            )
+            .order_by(time_column.asc())
         )
+
+    def _select_between_timestamp(self, table, start, end, *entities):
+        return self._select_within_intervals(table, [(start, end)], *entities)
+
+    def get_records_between_timestamp(self, table, start, end):
+        """
+        Fetch the records in the table for the given date range,
+        in time order of the table's time field
+        """
+        logging.debug(f"get_records_between_timestamp({table},{start},{end})")
+        self._validate_data_type(table)
+        stmt = self._select_between_timestamp(table, start, end, table)
         with Session(self.engine) as session:
             recs = session.execute(stmt)
             res = [rec[0] for rec in recs]
         return res or []
 
+    def get_columns_between_timestamp(self, table, columns, start, end):
+        """
+        Fetch only the given columns of the records in the table for the date range,
+        in time order, as a DataFrame built without any ORM objects
+        """
+        logging.debug(f"get_columns_between_timestamp({table},{columns},{start},{end})")
+        return self.get_columns_within_intervals(table, columns, [(start, end)])
+
+    def _get_columns_next_to_timestamp(self, table, columns, timestamp, before):
+        time_column = self._get_time_column(table)
+        timestamp = self._to_datetime(timestamp)
+        stmt = (
+            select(*(getattr(table, column) for column in columns))
+            .where(time_column < timestamp if before else time_column >= timestamp)
+            .order_by(time_column.desc() if before else time_column.asc())
+            .limit(1)
+        )
+        with self.engine.connect() as connection:
+            rows = connection.execute(stmt).fetchall()
+        return pd.DataFrame.from_records(rows, columns=list(columns))
+
+    def get_columns_before_timestamp(self, table, columns, timestamp):
+        """
+        Fetch only the given columns of the last record in the table strictly
+        before the timestamp, as a DataFrame of at most one row
+        """
+        logging.debug(f"get_columns_before_timestamp({table},{columns},{timestamp})")
+        self._validate_data_type(table)
+        return self._get_columns_next_to_timestamp(table, columns, timestamp, True)
+
+    def get_columns_from_timestamp(self, table, columns, timestamp):
+        """
+        Fetch only the given columns of the first record in the table at or
+        after the timestamp, as a DataFrame of at most one row
+        """
+        logging.debug(f"get_columns_from_timestamp({table},{columns},{timestamp})")
+        self._validate_data_type(table)
+        return self._get_columns_next_to_timestamp(table, columns, timestamp, False)
+
+    def get_columns_within_intervals(self, table, columns, intervals):
+        """
+        Fetch only the given columns of the records in the table within any of the
+        (start, end) intervals, in time order, as a DataFrame with a single query
+        """
+        logging.debug(f"get_columns_within_intervals({table},{columns},{intervals})")
+        self._validate_data_type(table)
+        if not intervals:
+            return pd.DataFrame(columns=list(columns))
+        stmt = self._select_within_intervals(
+            table, intervals, *(getattr(table, column) for column in columns)
+        )
+        with self.engine.connect() as connection:
+            rows = connection.execute(stmt).fetchall()
+        return pd.DataFrame.from_records(rows, columns=list(columns))
+
+    def stream_records_between_timestamp(self, table, start, end, chunk_size=1000):
+        """
+        Stream the records in the table for the date range, in time order,
+        as chunks of at most chunk_size column name to value dicts.
+        A server side cursor is used so only one chunk is held in memory at a time
+        """
+        logging.debug(f"stream_records_between_timestamp({table},{start},{end})")
+        self._validate_data_type(table)
+        stmt = self._select_between_timestamp(
+            table, start, end, *table.__table__.columns
+        )
+        with self.engine.connect() as connection:
+            result = connection.execution_options(yield_per=chunk_size).execute(stmt)
+            for partition in result.mappings().partitions():
+                yield [dict(row) for row in partition]
+
     def get_filtered_by_id_records(self, table, id):
         """Fetch the records greater than the given id"""
         logging.debug(f"get_filtered_by_id_records({table}, {id})")
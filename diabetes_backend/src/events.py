@@ -0,0 +1,37 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Published after rows are saved, with the table, the first/last ids saved
+# and the first/last times they span, None when unknown
+ROWS_SAVED = "rows_saved"
+
+
+class EventBus:
+    """
+    In-process event bus calling the subscribed handlers when an event is published.
+    Handlers run synchronously in the publisher's thread, a failing handler is
+    logged and does not affect the publisher or the other handlers
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.handlers = {}
+
+    def subscribe(self, event, handler):
+        logger.debug(f"Subscribing {handler} to {event}")
+        with self._lock:
+            self.handlers.setdefault(event, []).append(handler)
+
+    def publish(self, event, **payload):
+        """Call the handlers of the event, returning how many were called"""
+        logger.debug(f"Publishing {event}: {payload}")
+        with self._lock:
+            handlers = list(self.handlers.get(event, []))
+        for handler in handlers:
+            try:
+                handler(**payload)
+            except Exception as e:
+                logger.error(f"Handler of {event} failed with exception\n:{e}")
+        return len(handlers)
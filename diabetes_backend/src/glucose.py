@@ -1,6 +1,10 @@
 import requests
 import logging
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+from requests.adapters import HTTPAdapter
 from src.base import Base
 from src.database.tables import Glucose
 
@@ -15,12 +19,21 @@ class GlucoseManager(Base):
     Simple class to poll data from the LibreLinkUpApp
     """
 
-    def __init__(self, email, password, auth, db_manager):
-        super().__init__(db_manager)
+    def __init__(
+        self, email, password, auth, db_manager, event_bus=None, max_concurrency=4
+    ):
+        super().__init__(db_manager, event_bus)
         # Initialise auth
         self.auth_manager = auth(email, password)
         self.email = email
         self.password = password
+        # Keep-alive connections shared by all the requests, at most
+        # max_concurrency graphs are fetched at once
+        self.max_concurrency = max_concurrency
+        self.session = requests.Session()
+        self.session.mount(BASE_URL, HTTPAdapter(pool_maxsize=max_concurrency))
+        # The latest measurement time processed of each patient
+        self.measurement_watermarks = {}
 
     @property
     def name(self):
@@ -30,73 +43,163 @@ class GlucoseManager(Base):
     def table(self):
         return Glucose
 
+    @property
+    def columns(self):
+        return ("id", "timestamp", "glucose")
+
+    def _get_connections(self):
+        return self._get("/llu/connections").get("data", [])
+
+    def _get(self, endpoint, token=None):
+        token = token or self.auth_manager.get_token()
+        headers = {**HEADERS, "Authorization": f"Bearer {token}"}
+        response = self.session.get(BASE_URL + endpoint, headers=headers)
+        response.raise_for_status()
+        return response.json()
+
     def get_patient_ids(self):
         """
         Retrieve patient IDs from LibreLinkUp.
         """
         logger.info("Getting patient ids for email")
-        token = self.auth_manager.get_token()
-        endpoint = "/llu/connections"
-        headers = {**HEADERS, "Authorization": f"Bearer {token}"}
-        response = requests.get(BASE_URL + endpoint, headers=headers)
-        response.raise_for_status()
-        patient_data = response.json().get("data", [])
-        return [data.get("patientId") for data in patient_data]
+        return [data.get("patientId") for data in self._get_connections()]
 
-    def get_cgm_data(self, patient_id):
+    def get_latest_measurement_times(self):
+        """
+        Retrieve the timestamp of the latest measurement of each patient,
+        reported by the connections without fetching any graph data.
+        """
+        logger.info("Getting latest measurement times for email")
+        return {
+            data.get("patientId"): (data.get("glucoseMeasurement") or {}).get(
+                "Timestamp"
+            )
+            for data in self._get_connections()
+        }
+
+    def get_cgm_data(self, patient_id, token=None):
         """Retrieve CGM data for a specific patient from LibreLinkUp."""
         logger.info("Getting CGM data")
+        return self._get(f"/llu/connections/{patient_id}/graph", token)
+
+    def get_all_cgm_data(self, patient_ids):
+        """
+        Retrieve the CGM data of the patients concurrently, at most
+        max_concurrency at a time, with a single token.
+        Returns the data, or the exception raised, of each patient.
+        """
+        logger.info(f"Getting CGM data for {len(patient_ids)} patients")
+        if not patient_ids:
+            return {}
         token = self.auth_manager.get_token()
-        endpoint = f"/llu/connections/{patient_id}/graph"
-        headers = {**HEADERS, "Authorization": f"Bearer {token}"}
-        response = requests.get(BASE_URL + endpoint, headers=headers)
-        response.raise_for_status()
-        return response.json()
+        workers = min(self.max_concurrency, len(patient_ids))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                patient_id: executor.submit(self.get_cgm_data, patient_id, token)
+                for patient_id in patient_ids
+            }
+        return {
+            patient_id: future.exception() or future.result()
+            for patient_id, future in futures.items()
+        }
+
+    def _is_processed(self, patient_id, measurement_time):
+        return (
+            measurement_time is not None
+            and self.measurement_watermarks.get(patient_id) == measurement_time
+        )
 
-    def update_cgm_data(self, patient_id):
+    def update_cgm_data(self, patient_id, measurement_time=None):
+        """
+        Fetch and save the new CGM data of the patient.
+        It is skipped when measurement_time, the patient's latest measurement,
+        has already been processed. Returns whether the data was fetched.
+        """
         logger.info("update_cgm_data()")
-        data = self.get_cgm_data(patient_id)
+        if self._is_processed(patient_id, measurement_time):
+            logger.debug(f"No new measurement since {measurement_time}, skipping")
+            return False
+        self._save_cgm_data(patient_id, self.get_cgm_data(patient_id), measurement_time)
+        return True
+
+    def update_all_cgm_data(self, measurement_times):
+        """
+        Fetch the CGM data of the patients with a new measurement concurrently,
+        then save it one patient at a time. A failing patient is logged and
+        does not affect the others.
+        Returns whether the data of each patient was fetched, without the failed ones.
+        """
+        logger.info("update_all_cgm_data()")
+        fetched = {
+            patient_id: not self._is_processed(patient_id, measurement_time)
+            for patient_id, measurement_time in measurement_times.items()
+        }
+        all_data = self.get_all_cgm_data(
+            [patient_id for patient_id, new in fetched.items() if new]
+        )
+        for patient_id, data in all_data.items():
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                self._save_cgm_data(patient_id, data, measurement_times[patient_id])
+            except Exception as e:
+                logger.error(f"Failed updating patient {patient_id}, exception\n:{e}")
+                del fetched[patient_id]
+        return fetched
+
+    def _save_cgm_data(self, patient_id, data, measurement_time):
         last_record = self._get_last_record()
         logger.debug(f"Last record: {last_record}")
-        last_timestamp = last_record.timestamp
+        # Imported historic readings have later ids than newer readings
+        last_timestamp = (
+            self.db_manager.get_latest_timestamp(Glucose) or last_record.timestamp
+        )
         max_id = last_record.id
         self._save_data(
             self.format_cgm_data(
                 last_timestamp, max_id, data.get("data").get("graphData")
             )
         )
+        if measurement_time is not None:
+            self.measurement_watermarks[patient_id] = measurement_time
 
     @staticmethod
     def format_cgm_data(last_timestamp, max_id, data):
         """
-        Format the data
+        Format the data into (id, timestamp, glucose) rows of the records after
+        last_timestamp, in time order, with the timestamps as UTC datetimes
         """
         logging.debug(f"format_cgm_data({last_timestamp}, {max_id}, {len(data)})")
-        # Filter records the new ones must be at least one second apart
-        filtered_records = [
-            (record.get("Value"), record.get("Timestamp"))
-            for record in data
-            if (
-                datetime.strptime(record.get("Timestamp"), DATETIME_FORMAT).astimezone(
-                    timezone.utc
-                )
-                - last_timestamp
-            ).total_seconds()
-            > 0
-        ]
-        sorted_records = sorted(
-            filtered_records,
-            key=lambda x: datetime.strptime(x[1], DATETIME_FORMAT).astimezone(
-                timezone.utc
-            ),
+        if not data:
+            return []
+        timestamps = parse_local_timestamps(
+            [record.get("Timestamp") for record in data]
         )
-        records_to_add = [
-            Glucose(
-                id=idx + max_id + 1,
-                timestamp=sorted_records[idx][1],
-                glucose=sorted_records[idx][0],
+        # Filter records the new ones must be at least one second apart
+        new_records = np.flatnonzero(timestamps > last_timestamp)
+        new_records = new_records[np.argsort(timestamps[new_records], kind="stable")]
+        records_to_add = list(
+            zip(
+                range(max_id + 1, max_id + 1 + len(new_records)),
+                timestamps[new_records].to_pydatetime().tolist(),
+                [data[idx].get("Value") for idx in new_records.tolist()],
             )
-            for idx in range(len(sorted_records))
-        ]
+        )
         logging.debug(f"Adding records: {records_to_add}")
         return records_to_add
+
+
+def parse_local_timestamps(values):
+    """
+    Parse the LibreLinkUp timestamps, in the local time of the server, into UTC
+    all at once. The same as datetime.strptime(value, DATETIME_FORMAT).astimezone(utc),
+    including around daylight saving time transitions
+    """
+    timestamps = pd.DatetimeIndex(pd.to_datetime(values, format=DATETIME_FORMAT))
+    return timestamps.tz_localize(
+        tzlocal(),
+        # Like a naive datetime's fold=0, the first of repeated times
+        ambiguous=np.ones(len(timestamps), dtype=bool),
+        # and skipped times offset from before the transition
+        nonexistent=pd.Timedelta(hours=1),
+    ).tz_convert("UTC")
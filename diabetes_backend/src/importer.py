@@ -0,0 +1,159 @@
+"""
+Import historic LibreView glucose and Strava activity CSV exports
+
+    python -m src.importer glucose test_data/glucose.csv
+    python -m src.importer activities test_data/activities.csv --timezone Europe/London
+"""
+import argparse
+import logging
+import time
+import pandas as pd
+
+from src.constants import STRAVA_ACTIVITIES_COLUMNS
+from src.data import DataManager
+from src.database.engine import create_database_engine, load_database_url_from_env
+from src.database.tables import Glucose, Strava
+from src.database_manager import DatabaseManager
+from src.rollup import DailyMeanManager, RollupManager
+from src.sketch import load_sketch_bin_width_from_env
+
+logger = logging.getLogger(__name__)
+
+CSV_DATETIME = "%Y-%m-%d %H:%M:%S"
+GLUCOSE_COLUMNS = ("id", "timestamp", "glucose")
+# Rows parsed and loaded at a time, bounding the memory used by an import
+DEFAULT_CHUNKSIZE = 100_000
+
+
+def parse_csv_timestamps(values, timezone):
+    """Parse the naive CSV timestamps as times in the timezone, converted to UTC"""
+    timestamps = pd.to_datetime(values, format=CSV_DATETIME)
+    return timestamps.dt.tz_localize(timezone).dt.tz_convert("UTC")
+
+
+def read_csv_chunks(path, columns, chunksize):
+    """Stream the columns of the CSV in chunks with the pandas C parser"""
+    return pd.read_csv(path, usecols=list(columns), chunksize=chunksize, engine="c")
+
+
+def remove_existing_glucose(db_manager, chunk):
+    """Drop the readings whose timestamp is in the chunk or the database already"""
+    chunk = chunk.drop_duplicates("timestamp")
+    if chunk.empty:
+        return chunk
+    existing = db_manager.get_columns_between_timestamp(
+        Glucose, ("timestamp",), chunk["timestamp"].min(), chunk["timestamp"].max()
+    )
+    existing_timestamps = pd.to_datetime(existing["timestamp"], utc=True)
+    return chunk[~chunk["timestamp"].isin(existing_timestamps)]
+
+
+def remove_existing_activities(db_manager, chunk):
+    """Drop the activities whose id is in the chunk or the database already"""
+    chunk = chunk.drop_duplicates("id")
+    existing_ids = db_manager.get_existing_ids(Strava, chunk["id"].tolist())
+    return chunk[~chunk["id"].isin(existing_ids)]
+
+
+def _log_progress(name, read, loaded, start):
+    elapsed = time.perf_counter() - start
+    rate = read / elapsed if elapsed > 0 else float("inf")
+    logger.info(
+        f"Imported {loaded} of {read} {name} rows in {elapsed:.1f}s ({rate:.0f} rows/s)"
+    )
+
+
+def import_glucose(db_manager, path, chunksize=DEFAULT_CHUNKSIZE, timezone="UTC"):
+    """
+    Load the readings of a glucose export, id, glucose and timestamp columns,
+    skipping the timestamps already saved. Ids continue from the max glucose id.
+    Returns the number of rows read and loaded and the range of ids and
+    timestamps loaded
+    """
+    next_id = db_manager.get_max_ids(Glucose)[0] + 1
+    first_id = next_id
+    read = 0
+    times = []
+    start = time.perf_counter()
+    for chunk in read_csv_chunks(path, ("timestamp", "glucose"), chunksize):
+        read += len(chunk)
+        chunk["timestamp"] = parse_csv_timestamps(chunk["timestamp"], timezone)
+        chunk = remove_existing_glucose(db_manager, chunk)
+        if not chunk.empty:
+            times += [chunk["timestamp"].min(), chunk["timestamp"].max()]
+        ids = range(next_id, next_id + len(chunk))
+        next_id += db_manager.copy_rows(
+            Glucose,
+            GLUCOSE_COLUMNS,
+            zip(ids, chunk["timestamp"].tolist(), chunk["glucose"].tolist()),
+        )
+        _log_progress("glucose", read, next_id - first_id, start)
+    return {
+        "read": read,
+        "loaded": next_id - first_id,
+        "ids": (first_id, next_id - 1),
+        "times": (min(times), max(times)) if times else (None, None),
+    }
+
+
+def import_activities(db_manager, path, chunksize=DEFAULT_CHUNKSIZE, timezone="UTC"):
+    """
+    Load the activities of a Strava export with the STRAVA_ACTIVITIES_COLUMNS,
+    skipping the activity ids already saved.
+    Returns the number of rows read and loaded and the range of ids loaded
+    """
+    read = loaded = 0
+    ids = []
+    start = time.perf_counter()
+    for chunk in read_csv_chunks(path, STRAVA_ACTIVITIES_COLUMNS, chunksize):
+        read += len(chunk)
+        for column in ("start_time", "end_time"):
+            chunk[column] = parse_csv_timestamps(chunk[column], timezone)
+        chunk = remove_existing_activities(db_manager, chunk)
+        rows = chunk[list(STRAVA_ACTIVITIES_COLUMNS)].itertuples(index=False)
+        loaded += db_manager.copy_rows(Strava, STRAVA_ACTIVITIES_COLUMNS, rows)
+        if not chunk.empty:
+            ids += [chunk["id"].min(), chunk["id"].max()]
+        _log_progress("activities", read, loaded, start)
+    return {
+        "read": read,
+        "loaded": loaded,
+        "ids": (int(min(ids)), int(max(ids))) if ids else (0, -1),
+    }
+
+
+IMPORTERS = {
+    "glucose": (import_glucose, Glucose),
+    "activities": (import_activities, Strava),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("kind", choices=IMPORTERS)
+    parser.add_argument("path", help="CSV export to import")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument(
+        "--timezone", default="UTC", help="Timezone of the CSV timestamps"
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s", level="INFO")
+
+    importer, table = IMPORTERS[args.kind]
+    db_manager = DatabaseManager(create_database_engine(load_database_url_from_env()))
+    result = importer(db_manager, args.path, args.chunksize, args.timezone)
+    if result["loaded"]:
+        # Combine the imported rows with the existing ones
+        DataManager(db_manager, combine_in_database=True).on_rows_saved(
+            table, *result["ids"]
+        )
+        if table is Glucose:
+            RollupManager(db_manager, load_sketch_bin_width_from_env()).rebuild(
+                *result["times"]
+            )
+            DailyMeanManager(db_manager).rebuild(*result["times"])
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,629 @@
+from datetime import datetime, timedelta, timezone
+import logging
+import numpy as np
+import pandas as pd
+
+from src.accumulator import TimeWeightedMean, merge_time_weighted_means
+from src.base import Base
+from src.constants import STRAVA_DATETIME
+from src.database.tables import Glucose, GlucoseDailyMean, GlucoseRollup
+from src.sketch import DEFAULT_BIN_WIDTH, HistogramSketch, merge_sketches
+from src.utils import (
+    PERCENTILES,
+    compute_bucket_offsets,
+    compute_epoch_array,
+    compute_percentages_in_buckets,
+    compute_seconds_of_day,
+    format_aggregate_data,
+    format_quartile_data,
+    get_seconds_from_pandas_interval,
+    populate_glucose_data,
+    to_utc_timestamp,
+)
+
+logger = logging.getLogger(__name__)
+
+# The bucket of the rollups
+ROLLUP_BUCKET = timedelta(minutes=15)
+# The rollup columns of the compute_percentages_in_buckets results
+ROLLUP_PERCENTAGE_COLUMNS = {
+    "percentage_in_range": "percentageOfTimeInTarget",
+    "percentage_low": "percentageOfTimeLow",
+    "percentage_high": "percentageOfTimeHigh",
+    "number_of_highs": "numberOfHighs",
+    "number_of_lows": "numberOfLows",
+}
+DAY = timedelta(days=1)
+# The timestamps are saved to the microsecond
+RESOLUTION = timedelta(microseconds=1)
+READING_COLUMNS = ("timestamp", "glucose")
+
+
+def compute_glucose_rollup(
+    timestamps,
+    glucose,
+    high=10,
+    low=4,
+    bin_width=DEFAULT_BIN_WIDTH,
+):
+    """
+    Roll the time ordered readings up into ROLLUP_BUCKET buckets, for every bucket
+    between the first and last reading: the count, sum, sum of squares, min and
+    max of the readings, the times of the first and last of them, the
+    libre_extremes_in_buckets time in range and the sketch of the readings as a dict.
+    Returns a DataFrame of the rollups, with the bucket starts as epoch seconds
+    """
+    bucket_seconds = int(ROLLUP_BUCKET.total_seconds())
+    epoch_seconds = compute_epoch_array(timestamps)
+    glucose = np.asarray(glucose, dtype=np.float64)
+    if not len(epoch_seconds):
+        return pd.DataFrame(
+            columns=[
+                "bucket_start",
+                "count",
+                "sum",
+                "sum_of_squares",
+                "min",
+                "max",
+                "first_time",
+                "last_time",
+                *ROLLUP_PERCENTAGE_COLUMNS,
+                "sketch",
+            ]
+        )
+
+    # The time in range with the interpolated boundary points
+    populated_seconds, populated_glucose = epoch_seconds, glucose
+    if len(epoch_seconds) > 1:
+        populated_seconds, populated_glucose = populate_glucose_data(
+            timestamps, glucose, bucket_seconds // 60, as_array=True
+        )
+    bucket_starts, populated_offsets = compute_bucket_offsets(
+        populated_seconds, bucket_seconds
+    )
+    percentages = pd.DataFrame.from_records(
+        compute_percentages_in_buckets(
+            populated_seconds,
+            populated_glucose,
+            populated_offsets,
+            interval_length_seconds=bucket_seconds,
+            high=high,
+            low=low,
+        )
+    )
+
+    # The statistics of the readings alone
+    n_buckets = len(bucket_starts)
+    bucket_index = (epoch_seconds - bucket_starts[0]) // bucket_seconds
+    offsets = np.searchsorted(epoch_seconds, bucket_starts, side="left")
+    extremes = (
+        pd.Series(glucose)
+        .groupby(bucket_index)
+        .agg(["min", "max"])
+        .reindex(range(n_buckets))
+    )
+    times = (
+        pd.Series(pd.to_datetime(timestamps, utc=True))
+        .groupby(bucket_index)
+        .agg(["min", "max"])
+        .reindex(range(n_buckets))
+    )
+    return pd.DataFrame(
+        {
+            "bucket_start": bucket_starts,
+            "count": np.bincount(bucket_index, minlength=n_buckets),
+            "sum": np.bincount(bucket_index, weights=glucose, minlength=n_buckets),
+            "sum_of_squares": np.bincount(
+                bucket_index, weights=glucose**2, minlength=n_buckets
+            ),
+            "min": extremes["min"].to_numpy(),
+            "max": extremes["max"].to_numpy(),
+            "first_time": times["min"].array,
+            "last_time": times["max"].array,
+            **{
+                column: percentages[key].to_numpy()
+                for column, key in ROLLUP_PERCENTAGE_COLUMNS.items()
+            },
+            "sketch": [
+                HistogramSketch.from_values(values, bin_width).to_dict()
+                for values in np.split(glucose, offsets[1:])
+            ],
+        }
+    )
+
+
+def aggregate_time_of_day_rollups(rollups, bucket="15min"):
+    """
+    Aggregate the 15 minute rollups of every time of day bucket, the count, sum,
+    sum of squares, min and max of their readings along with the median and
+    percentiles of their merged sketches.
+    Buckets without data are 0 for the aggregations and NaN otherwise.
+    """
+    bucket_seconds = get_seconds_from_pandas_interval(bucket)
+    if bucket_seconds % ROLLUP_BUCKET.total_seconds():
+        raise ValueError(f"Cannot aggregate {ROLLUP_BUCKET} rollups into {bucket}")
+    rollups = rollups[rollups["count"] > 0]
+    time_of_day = (
+        compute_seconds_of_day(rollups["bucket_start"].array) // bucket_seconds
+    )
+    if not len(rollups):
+        buckets = pd.RangeIndex(0)
+    else:
+        buckets = pd.RangeIndex(time_of_day.min(), time_of_day.max() + 1)
+    df = (
+        rollups.groupby(time_of_day)
+        .agg(
+            count=("count", "sum"),
+            sum=("sum", "sum"),
+            sum_of_squares=("sum_of_squares", "sum"),
+            max=("max", "max"),
+            min=("min", "min"),
+        )
+        .reindex(buckets, fill_value=0)
+    )
+    percentiles = {"median": 0.5, **PERCENTILES}
+    sketches = rollups["sketch"].map(HistogramSketch.from_dict)
+    quantiles = np.full((len(buckets), len(percentiles)), np.nan)
+    for index, bucket_sketches in sketches.groupby(time_of_day):
+        quantiles[index - buckets.start] = merge_sketches(bucket_sketches).quantiles(
+            list(percentiles.values())
+        )
+    return df.assign(**dict(zip(percentiles, quantiles.T))), buckets
+
+
+def glucose_quartile_rollup_data(rollups):
+    """
+    glucose_quartile_data from the 15 minute rollups rather than the readings,
+    merging the sketches of each time of day bucket for its median and percentiles
+    """
+    logger.debug(f"glucose_quartile_rollup_data() of {len(rollups)} rollups")
+    df, buckets = aggregate_time_of_day_rollups(rollups)
+    return format_quartile_data(df, buckets)
+
+
+def aggregate_glucose_rollup_data(rollups, bucket="15min"):
+    """
+    Approximate aggregate_glucose_data from the 15 minute rollups rather than the
+    readings, for buckets of a multiple of 15 minutes. The mean and variance are
+    from the sums of the readings, the median and percentiles from the merged
+    sketches. The rollups do not keep the readings so the raw values are empty
+    """
+    logger.debug(f"aggregate_glucose_rollup_data() of {len(rollups)} rollups")
+    df, buckets = aggregate_time_of_day_rollups(rollups, bucket)
+    count = df["count"]
+    mean = (df["sum"] / count).where(count > 0)
+    var = (
+        ((df["sum_of_squares"] - df["sum"] * mean) / (count - 1))
+        .clip(lower=0)
+        .where(count > 1)
+    )
+    df = df.assign(mean=mean, var=var, std=np.sqrt(var))
+    return format_aggregate_data(df, buckets, [[] for _ in buckets], bucket)
+
+
+def libre_extremes_in_rollup_buckets(rollups):
+    """
+    libre_extremes_in_buckets, with the default targets and buckets, from the
+    15 minute rollups of the readings rather than the readings
+    """
+    logger.debug(f"libre_extremes_in_rollup_buckets() of {len(rollups)} rollups")
+    bucket_seconds = int(ROLLUP_BUCKET.total_seconds())
+    bucket_starts = compute_epoch_array(rollups["bucket_start"].array)
+    # The time between the first and last readings, as of the readings
+    first_time = pd.to_datetime(rollups["first_time"], utc=True).min()
+    last_time = pd.to_datetime(rollups["last_time"], utc=True).max()
+    if (
+        not len(bucket_starts)
+        or pd.isna(first_time)
+        or (last_time - first_time).total_seconds() < 60 * 60 * 12
+    ):
+        logger.debug("Not a long enough time window")
+        return {
+            "percentageOfTimeInTarget": None,
+            "percentageOfTimeLow": None,
+            "percentageOfTimeHigh": None,
+            "numberOfHighs": None,
+            "numberOfLows": None,
+        }
+    # Every bucket between the first and last, missing ones have no data
+    all_bucket_starts = np.arange(
+        bucket_starts[0], bucket_starts[-1] + 1, bucket_seconds
+    )
+    df = (
+        rollups.set_axis(bucket_starts)[list(ROLLUP_PERCENTAGE_COLUMNS)]
+        .reindex(all_bucket_starts)
+        .astype(object)
+    )
+    df = df.where(df.notna(), None)
+    time_intervals = pd.to_datetime(all_bucket_starts, unit="s").strftime(
+        STRAVA_DATETIME
+    )
+    return [
+        {
+            "timeInterval": time_interval,
+            "timeIntervalData": {
+                key: (value if value is None or "percentage" in key else int(value))
+                for key, value in zip(ROLLUP_PERCENTAGE_COLUMNS.values(), row)
+            },
+        }
+        for time_interval, row in zip(
+            time_intervals, df.itertuples(index=False, name=None)
+        )
+    ]
+
+
+def libre_hba1c_from_daily_means(daily_means):
+    """
+    Computing the HBA1C by merging the TimeWeightedMean accumulators,
+    a DataFrame of their columns in time order
+    """
+    logger.debug("libre_hba1c_from_daily_means()")
+    daily_means = daily_means.assign(
+        first_time=compute_epoch_array(daily_means["first_time"]),
+        last_time=compute_epoch_array(daily_means["last_time"]),
+    )
+    merged = merge_time_weighted_means(
+        TimeWeightedMean.from_dict(row) for row in daily_means.to_dict("records")
+    )
+    # Same as the readings, the time range must span an hour
+    if merged.count < 2 or merged.seconds < 60 * 60:
+        return {"hBA1C": None}
+    return {"hBA1C": merged.mean}
+
+
+def accumulate_time_weighted_mean(readings, accumulator=None):
+    """Consume a DataFrame of timestamp and glucose readings into the accumulator"""
+    accumulator = accumulator or TimeWeightedMean()
+    if readings.empty:
+        return accumulator
+    return accumulator.update(
+        compute_epoch_array(readings["timestamp"]), readings["glucose"]
+    )
+
+
+class BaseRollupManager(Base):
+    """
+    Maintain a table computed from the glucose readings as they are saved,
+    recomputing the rows affected by the saved readings with update_rollups
+    """
+
+    def update_rollups(self, first_time, last_time):
+        raise NotImplementedError("Not implemented rollup update")
+
+    def on_rows_saved(self, table, first_id, last_id, first_time=None, last_time=None):
+        """
+        Update the rollups of newly saved glucose rows,
+        subscribed to the ROWS_SAVED events of the ingest managers.
+        Returns the number of rollups updated
+        """
+        if table is not Glucose:
+            return 0
+        if first_time is None or last_time is None:
+            logger.warning(f"Cannot update the {self.name} of {first_id}-{last_id}")
+            return 0
+        return self.update_rollups(first_time, last_time)
+
+    @property
+    def rebuild_checkpoint(self):
+        """The checkpoint of the epoch seconds the readings are rebuilt up to"""
+        return f"{self.table.__tablename__}_rebuild"
+
+    def rebuild(self, first_time=None, last_time=None, chunk=timedelta(days=30)):
+        """
+        Recompute the rollups of the readings between first_time and last_time,
+        a chunk of readings at a time. Returns the number of rollups updated.
+        By default from where the previous rebuild got to, or the first reading,
+        up to the last reading, checkpointing each chunk so that an interrupted
+        rebuild resumes after it
+        """
+        checkpoint = None
+        if first_time is None and last_time is None:
+            checkpoint = self.db_manager.get_checkpoint(self.rebuild_checkpoint)
+            if checkpoint:
+                first_time = datetime.fromtimestamp(checkpoint, timezone.utc)
+        if first_time is None:
+            first_time = self.db_manager.get_earliest_timestamp(Glucose)
+        if last_time is None:
+            last_time = self.db_manager.get_latest_timestamp(Glucose)
+        if first_time is None or last_time is None:
+            logger.info("No glucose readings to roll up")
+            return 0
+        start, last_time = to_utc_timestamp(first_time), to_utc_timestamp(last_time)
+        logger.info(f"Rebuilding the {self.name} rollups {start}-{last_time}")
+        updated = 0
+        while start <= last_time:
+            end = min(start + chunk, last_time)
+            updated += self.update_rollups(start, end)
+            if checkpoint is not None:
+                self.db_manager.save_checkpoint(
+                    self.rebuild_checkpoint, int(end.timestamp())
+                )
+            start = start + chunk
+        return updated
+
+
+class RollupManager(BaseRollupManager):
+    """
+    Maintain the 15 minute glucose rollups as the readings are saved.
+    A bucket is interpolated from the last reading before it and the first one
+    after it, however far away, so the buckets between the saved readings and
+    their neighbouring readings are recomputed from the readings and upserted.
+    Readings saved in any order or more than once give the same rollups.
+    The sketches count the readings in bins of bin_width
+    """
+
+    def __init__(self, db_manager, bin_width=DEFAULT_BIN_WIDTH):
+        super().__init__(db_manager)
+        self.bin_width = bin_width
+
+    @property
+    def name(self):
+        return "GlucoseRollup15Min"
+
+    @property
+    def table(self):
+        return GlucoseRollup
+
+    @property
+    def columns(self):
+        return (
+            "bucket_start",
+            "count",
+            "sum",
+            "sum_of_squares",
+            "min",
+            "max",
+            "first_time",
+            "last_time",
+            "percentage_in_range",
+            "percentage_low",
+            "percentage_high",
+            "number_of_highs",
+            "number_of_lows",
+            "sketch",
+        )
+
+    @property
+    def invalidated_by(self):
+        # The buckets at the ends of a window are computed from its readings
+        return {GlucoseRollup: timedelta(0), Glucose: timedelta(0)}
+
+    def _get_reading_before(self, timestamp):
+        return self.db_manager.get_columns_before_timestamp(
+            Glucose, READING_COLUMNS, timestamp.to_pydatetime()
+        )
+
+    def _get_reading_from(self, timestamp):
+        return self.db_manager.get_columns_from_timestamp(
+            Glucose, READING_COLUMNS, timestamp.to_pydatetime()
+        )
+
+    def _get_readings(self, start, end):
+        """The readings between start and end, the end excluded"""
+        readings = self.db_manager.get_columns_between_timestamp(
+            Glucose, READING_COLUMNS, start.to_pydatetime(), end.to_pydatetime()
+        )
+        return readings[pd.to_datetime(readings["timestamp"], utc=True) < end]
+
+    def _compute_rollups(self, readings, first_bucket, last_bucket):
+        """
+        The rollups of the buckets from first_bucket to last_bucket, computed from
+        the time ordered readings, as a DataFrame of the columns
+        """
+        readings = pd.concat([frame for frame in readings if not frame.empty])
+        rollups = compute_glucose_rollup(
+            readings["timestamp"].array, readings["glucose"], bin_width=self.bin_width
+        )
+        bucket_starts = pd.to_datetime(rollups["bucket_start"], unit="s", utc=True)
+        rollups = rollups.assign(bucket_start=bucket_starts.dt.to_pydatetime())
+        for column in ("first_time", "last_time"):
+            rollups[column] = pd.to_datetime(rollups[column], utc=True)
+            rollups[column] = rollups[column].dt.to_pydatetime()
+        rollups = rollups[
+            (bucket_starts >= first_bucket) & (bucket_starts <= last_bucket)
+        ]
+        rollups = rollups[list(self.columns)].astype(object)
+        return rollups.where(rollups.notna(), None).reset_index(drop=True)
+
+    def update_rollups(self, first_time, last_time):
+        """
+        Recompute the rollups of the buckets affected by readings saved between
+        first_time and last_time, returning the number of rollups updated
+        """
+        first = to_utc_timestamp(first_time).floor(ROLLUP_BUCKET)
+        last = to_utc_timestamp(last_time).floor(ROLLUP_BUCKET)
+        # The buckets interpolated between the saved readings and their neighbours
+        previous = self._get_reading_before(first)
+        following = self._get_reading_from(last + ROLLUP_BUCKET)
+        start, end = first, last
+        if not previous.empty:
+            start = to_utc_timestamp(previous["timestamp"].iloc[0]).floor(ROLLUP_BUCKET)
+        if not following.empty:
+            end = to_utc_timestamp(following["timestamp"].iloc[0]).floor(ROLLUP_BUCKET)
+        readings = [
+            self._get_reading_before(start),
+            self._get_readings(start, end + ROLLUP_BUCKET),
+            self._get_reading_from(end + ROLLUP_BUCKET),
+        ]
+        if all(frame.empty for frame in readings):
+            rows = []
+        else:
+            rollups = self._compute_rollups(readings, start, end)
+            rows = list(rollups.itertuples(index=False, name=None))
+        logger.info(f"Updating {len(rows)} {self.name} rollups from {start} to {end}")
+        return self.db_manager.upsert(GlucoseRollup, self.columns, rows)
+
+    def get_columns_between_timestamp(self, start_time, end_time, columns):
+        """
+        The rollups of the readings between the start/end times, in time order,
+        as the readings alone would give them: the saved rollups of the whole
+        buckets within the readings and ones computed from the readings of the
+        partial buckets at either end
+        """
+        logger.debug(f"get_columns_between_timestamp({start_time}, {end_time})")
+        start, end = to_utc_timestamp(start_time), to_utc_timestamp(end_time)
+        first_reading = self._get_reading_from(start)
+        last_reading = self._get_reading_before(end + RESOLUTION)
+        if first_reading.empty or last_reading.empty:
+            return pd.DataFrame(columns=list(columns))
+        first = to_utc_timestamp(first_reading["timestamp"].iloc[0])
+        last = to_utc_timestamp(last_reading["timestamp"].iloc[0])
+        if first > last:
+            return pd.DataFrame(columns=list(columns))
+        first_bucket = first.floor(ROLLUP_BUCKET)
+        last_bucket = last.floor(ROLLUP_BUCKET)
+        if last_bucket - first_bucket <= ROLLUP_BUCKET:
+            rollups = self._compute_rollups(
+                [self._get_readings(first, last + RESOLUTION)],
+                first_bucket,
+                last_bucket,
+            )
+            return self._to_utc(rollups)[list(columns)]
+        interior_start = first_bucket + ROLLUP_BUCKET
+        # Nothing before the first reading nor after the last one interpolates them
+        head = self._compute_rollups(
+            [
+                self._get_readings(first, interior_start),
+                self._get_reading_from(interior_start),
+            ],
+            first_bucket,
+            first_bucket,
+        )
+        interior = self.db_manager.get_columns_between_timestamp(
+            GlucoseRollup,
+            self.columns,
+            interior_start.to_pydatetime(),
+            (last_bucket - ROLLUP_BUCKET).to_pydatetime(),
+        )
+        tail = self._compute_rollups(
+            [
+                self._get_reading_before(last_bucket),
+                self._get_readings(last_bucket, last + RESOLUTION),
+            ],
+            last_bucket,
+            last_bucket,
+        )
+        rollups = pd.concat(
+            [frame.astype(object) for frame in (head, interior, tail)],
+            ignore_index=True,
+        )
+        return self._to_utc(rollups)[list(columns)]
+
+    @staticmethod
+    def _to_utc(rollups):
+        """The rollups with their times as UTC timestamps, as read or computed"""
+        return rollups.assign(
+            **{
+                column: pd.to_datetime(rollups[column], utc=True)
+                for column in ("bucket_start", "first_time", "last_time")
+            }
+        )
+
+
+class DailyMeanManager(BaseRollupManager):
+    """
+    Maintain the TimeWeightedMean accumulators of each UTC day of readings as the
+    readings are saved, so the hBA1C of a window merges one accumulator a day
+    """
+
+    @property
+    def name(self):
+        return "GlucoseDailyMean"
+
+    @property
+    def table(self):
+        return GlucoseDailyMean
+
+    @property
+    def columns(self):
+        return (
+            "day",
+            "weighted_sum",
+            "seconds",
+            "count",
+            "first_time",
+            "first_glucose",
+            "last_time",
+            "last_glucose",
+        )
+
+    @property
+    def invalidated_by(self):
+        return {GlucoseDailyMean: timedelta(0), Glucose: timedelta(0)}
+
+    def _to_row(self, day, accumulator):
+        data = accumulator.to_dict()
+        for column in ("first_time", "last_time"):
+            data[column] = datetime.fromtimestamp(data[column], timezone.utc)
+        return (day.to_pydatetime(), *(data[column] for column in self.columns[1:]))
+
+    def update_rollups(self, first_time, last_time, chunk_size=10_000):
+        """
+        Recompute the accumulators of the days of the readings saved between
+        first_time and last_time, streaming the readings of the days in chunks.
+        Returns the number of days updated
+        """
+        first = to_utc_timestamp(first_time).floor(DAY)
+        last = to_utc_timestamp(last_time).floor(DAY)
+        accumulators = {}
+        chunks = self.db_manager.stream_records_between_timestamp(
+            Glucose, first.to_pydatetime(), (last + DAY).to_pydatetime(), chunk_size
+        )
+        for chunk in chunks:
+            readings = pd.DataFrame.from_records(
+                chunk, columns=["timestamp", "glucose"]
+            )
+            days = pd.to_datetime(readings["timestamp"], utc=True).dt.floor(DAY)
+            # The readings are in time order, so each day is consumed in order
+            for day, day_readings in readings.groupby(days, sort=False):
+                accumulate_time_weighted_mean(
+                    day_readings, accumulators.setdefault(day, TimeWeightedMean())
+                )
+        rows = [
+            self._to_row(day, accumulator)
+            for day, accumulator in accumulators.items()
+            if first <= day <= last
+        ]
+        logger.info(f"Updating {len(rows)} {self.name} days from {first} to {last}")
+        return self.db_manager.upsert(GlucoseDailyMean, self.columns, rows)
+
+    def _get_partial_day(self, start, end, before=None):
+        """The accumulator of the readings between start and end, and before before"""
+        readings = self.db_manager.get_columns_between_timestamp(
+            Glucose,
+            ("timestamp", "glucose"),
+            start.to_pydatetime(),
+            end.to_pydatetime(),
+        )
+        if before is not None:
+            readings = readings[
+                pd.to_datetime(readings["timestamp"], utc=True) < before
+            ]
+        accumulator = accumulate_time_weighted_mean(readings)
+        if not accumulator.count:
+            return []
+        return [self._to_row(start.floor(DAY), accumulator)]
+
+    def get_columns_between_timestamp(self, start_time, end_time, columns):
+        """
+        The accumulators covering the readings between the start/end times, in
+        time order: the saved ones of the whole days within the window and ones
+        of the readings of the partial days at either end
+        """
+        logger.debug(f"get_columns_between_timestamp({start_time}, {end_time})")
+        start, end = to_utc_timestamp(start_time), to_utc_timestamp(end_time)
+        first_day, last_day_end = start.ceil(DAY), end.floor(DAY)
+        if first_day >= last_day_end:
+            rows = self._get_partial_day(start, end)
+            return pd.DataFrame(rows, columns=self.columns)[list(columns)]
+        # The reading at midnight is the first of the saved day
+        head = self._get_partial_day(start, first_day, before=first_day)
+        days = self.db_manager.get_columns_between_timestamp(
+            GlucoseDailyMean,
+            self.columns,
+            first_day.to_pydatetime(),
+            (last_day_end - DAY).to_pydatetime(),
+        )
+        tail = self._get_partial_day(last_day_end, end)
+        rows = [*head, *days.itertuples(index=False, name=None), *tail]
+        return pd.DataFrame(rows, columns=self.columns)[list(columns)]
@@ -1,12 +1,30 @@
-from marshmallow import Schema, fields
+from datetime import datetime
+from marshmallow import Schema, ValidationError, fields
+
+
+def validate_timestamp(value):
+    """
+    The start and end are bound to the queries as parsed by datetime.fromisoformat,
+    so any other format is rejected up front
+    """
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ValidationError("Not an ISO 8601 timestamp.")
 
 
 class TimeIntervalSchema(Schema):
-    start = fields.Str(required=False)
-    end = fields.Str(required=False)
+    start = fields.Str(required=False, validate=validate_timestamp)
+    end = fields.Str(required=False, validate=validate_timestamp)
 
 
 class TimeIntervalWithBucketSchema(Schema):
-    start = fields.Str(required=False)
-    end = fields.Str(required=False)
+    start = fields.Str(required=False, validate=validate_timestamp)
+    end = fields.Str(required=False, validate=validate_timestamp)
     bucket = fields.Str(required=False)
+
+
+class TimeIntervalApproximateSchema(Schema):
+    start = fields.Str(required=False, validate=validate_timestamp)
+    end = fields.Str(required=False, validate=validate_timestamp)
+    approximate = fields.Bool(required=False)
@@ -0,0 +1,115 @@
+"""
+Mergeable quantile sketches of the glucose readings
+"""
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Libre readings are reported to 0.1 mmol/L, the sketches are exact at that width
+DEFAULT_BIN_WIDTH = 0.1
+
+
+def load_sketch_bin_width_from_env():
+    """
+    The bin width of the sketches, optionally set via the SKETCH_BIN_WIDTH
+    environment variable. The quantiles are within half of it
+    """
+    return float(os.getenv("SKETCH_BIN_WIDTH", str(DEFAULT_BIN_WIDTH)))
+
+
+class HistogramSketch:
+    """
+    Quantile sketch counting the values in bins of bin_width.
+    Sketches of the same bin width merge exactly by adding their counts, and the
+    quantiles are within half a bin width of the exact ones, exact for values
+    at the bin resolution. Quantiles interpolate linearly as numpy's do.
+    Sketches of different bin widths merge at the widest one
+    """
+
+    def __init__(self, bin_width=DEFAULT_BIN_WIDTH, bins=(), counts=()):
+        self.bin_width = bin_width
+        # Sorted bin indexes, the value of bin i is i * bin_width, and their counts
+        self.bins = np.asarray(bins, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    @classmethod
+    def from_values(cls, values, bin_width=DEFAULT_BIN_WIDTH):
+        values = np.asarray(values, dtype=np.float64)
+        bins, counts = np.unique(
+            np.round(values / bin_width).astype(np.int64), return_counts=True
+        )
+        return cls(bin_width, bins, counts)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["binWidth"], data["bins"], data["counts"])
+
+    def to_dict(self):
+        return {
+            "binWidth": self.bin_width,
+            "bins": self.bins.tolist(),
+            "counts": self.counts.tolist(),
+        }
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def coarsen(self, bin_width):
+        """The sketch with the values counted in bins of a wider bin_width"""
+        if bin_width == self.bin_width:
+            return self
+        if bin_width < self.bin_width:
+            raise ValueError(f"Cannot coarsen {self.bin_width} bins to {bin_width}")
+        values = self.bins / (1 / self.bin_width)
+        bins, index = np.unique(
+            np.round(values / bin_width).astype(np.int64), return_inverse=True
+        )
+        return HistogramSketch(
+            bin_width, bins, np.bincount(index, weights=self.counts).astype(np.int64)
+        )
+
+    def merge(self, *others):
+        """A new sketch of the values of this and the other sketches"""
+        return merge_sketches([self, *others])
+
+    def quantiles(self, percentiles):
+        """The value at each of the percentiles (0 to 1), NaN when empty"""
+        percentiles = np.asarray(percentiles, dtype=np.float64)
+        if not self.count:
+            return np.full(percentiles.shape, np.nan)
+        cumulative_counts = np.cumsum(self.counts)
+        # Dividing by the inverse keeps e.g. 53 * 0.1 at 5.3
+        values = self.bins / (1 / self.bin_width)
+
+        def value_at(rank):
+            return values[np.searchsorted(cumulative_counts, rank, side="right")]
+
+        virtual_index = (self.count - 1) * percentiles
+        previous_index = np.floor(virtual_index)
+        gamma = virtual_index - previous_index
+        below = value_at(previous_index)
+        above = value_at(np.minimum(previous_index + 1, self.count - 1))
+        return np.where(
+            gamma >= 0.5,
+            above - (above - below) * (1 - gamma),
+            below + (above - below) * gamma,
+        )
+
+
+def merge_sketches(sketches):
+    """Merge the sketches into a single one, of the widest of their bin widths"""
+    sketches = list(sketches)
+    if not sketches:
+        return HistogramSketch()
+    bin_width = max(sketch.bin_width for sketch in sketches)
+    sketches = [sketch.coarsen(bin_width) for sketch in sketches]
+    bins, index = np.unique(
+        np.concatenate([sketch.bins for sketch in sketches]), return_inverse=True
+    )
+    counts = np.bincount(
+        index, weights=np.concatenate([sketch.counts for sketch in sketches])
+    )
+    return HistogramSketch(bin_width, bins, counts.astype(np.int64))
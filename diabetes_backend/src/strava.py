@@ -1,20 +1,119 @@
 import requests
 import logging
-from datetime import timedelta
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 
 from src.database.tables import Strava
-from src.constants import STRAVA_BASE_URL, STRAVA_DATETIME
+from src.events import ROWS_SAVED
+from src.constants import STRAVA_ACTIVITIES_COLUMNS, STRAVA_BASE_URL, STRAVA_DATETIME
 from src.utils import compute_epoch, convert_str_to_ts, convert_ts_to_str
 
 
 logger = logging.getLogger(__name__)
 
+# Refresh the access token this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = 300
+# Checkpoint of the last activity page saved by the backfill
+BACKFILL_CHECKPOINT = "strava_backfill_page"
+# Strava's short rate limit window resets every 15 minutes
+RATE_LIMIT_WINDOW = 15 * 60
+START_TIME_INDEX = STRAVA_ACTIVITIES_COLUMNS.index("start_time")
+END_TIME_INDEX = STRAVA_ACTIVITIES_COLUMNS.index("end_time")
+
+
+class StravaRateLimitError(Exception):
+    """
+    Raised when the daily Strava rate limit is used up, until its reset_time,
+    the next UTC midnight
+    """
+
+    def __init__(self, message, reset_time):
+        super().__init__(message)
+        self.reset_time = reset_time
+
+
+class StravaRateLimiter:
+    """
+    Keep the requests within Strava's 15 minute and daily limits, as reported by
+    the X-RateLimit-Limit and X-RateLimit-Usage headers of the latest response
+    """
+
+    def __init__(self, sleep=time.sleep, clock=time.time):
+        self.sleep = sleep
+        self.clock = clock
+        self._lock = threading.Lock()
+        # (15 minute, daily) limits and usage, unknown until the first response
+        self.limits = None
+        self.usage = [0, 0]
+        # The 15 minute window of the usage
+        self.window = None
+
+    def update(self, headers):
+        limits = headers.get("X-RateLimit-Limit")
+        usage = headers.get("X-RateLimit-Usage")
+        if not (limits and usage):
+            return
+        with self._lock:
+            self.limits = [int(value) for value in limits.split(",")]
+            self.usage = [int(value) for value in usage.split(",")]
+            self.window = self.clock() // RATE_LIMIT_WINDOW
+
+    def acquire(self):
+        """
+        Count a request against the limits, waiting for the next 15 minute window
+        when the short limit is reached. Raises StravaRateLimitError when the daily
+        limit is reached
+        """
+        while True:
+            with self._lock:
+                wait = self._get_wait()
+                if not wait:
+                    self.usage = [self.usage[0] + 1, self.usage[1] + 1]
+                    return
+            # Outside of the lock so the other requests are not held up behind it
+            logger.warning(f"Strava rate limit reached, waiting {wait:.0f}s")
+            self.sleep(wait)
+
+    def _get_wait(self):
+        """The seconds to wait for the next 15 minute window, 0 within the limits"""
+        if self.limits is None:
+            return 0
+        short_limit, daily_limit = self.limits
+        now = self.clock()
+        if self.usage[1] >= daily_limit:
+            reset_time = datetime.fromtimestamp(now, timezone.utc).replace(
+                hour=0, minute=0, second=0, microsecond=0
+            ) + timedelta(days=1)
+            raise StravaRateLimitError(
+                f"Daily Strava rate limit of {daily_limit} requests reached",
+                reset_time,
+            )
+        window = now // RATE_LIMIT_WINDOW
+        if window != self.window:
+            # The short usage resets with each window
+            self.window = window
+            self.usage[0] = 0
+        if self.usage[0] < short_limit:
+            return 0
+        return RATE_LIMIT_WINDOW - now % RATE_LIMIT_WINDOW
+
 
 class StravaManager:
-    def __init__(self, client_id, client_secret, refresh_token, code, db_manager):
+    def __init__(
+        self, client_id, client_secret, refresh_token, code, db_manager, event_bus=None
+    ):
         self.client_id = client_id
         self.client_secret = client_secret
+        # Keep-alive connection shared by all the Strava calls
+        self.session = requests.Session()
+        # Access token cached until it is about to expire
+        self.token = None
+        self.token_expires_at = 0
+        self._token_lock = threading.Lock()
+        self.rate_limiter = StravaRateLimiter()
         if refresh_token is not None:
             logger.debug("Using provided refresh token via Environment")
             self.refresh_token = refresh_token
@@ -23,11 +122,17 @@ class StravaManager:
             self.code = code
             self.refresh_token = self.get_refresh_token()
         self.db_manager = db_manager
+        self.event_bus = event_bus
 
     @property
     def name(self):
         return "StravaManager"
 
+    @property
+    def invalidated_by(self):
+        """The tables whose saved rows change the data, for the cached metrics"""
+        return {Strava: timedelta(0)}
+
     @property
     def token(self):
         return self._token
@@ -52,14 +157,21 @@ class StravaManager:
             "code": self.code,
             "grant_type": "authorization_code",
         }
-        res = requests.post(f"{STRAVA_BASE_URL}/oauth/token", data=payload)
+        res = self.session.post(f"{STRAVA_BASE_URL}/oauth/token", data=payload)
         return res.json().get("refresh_token")
 
     def get_access_token(self):
         """
-        Get Strava Access token
+        Get Strava Access token, cached until it is about to expire
         """
         logger.debug("get_access_token()")
+        with self._token_lock:
+            if self.token and time.time() < self.token_expires_at - TOKEN_EXPIRY_MARGIN:
+                logger.debug("Using cached access token")
+                return self.token
+            return self._refresh_access_token()
+
+    def _refresh_access_token(self):
         logger.debug(self.refresh_token)
         payload = {
             "client_id": self.client_id,
@@ -68,16 +180,15 @@ class StravaManager:
             "grant_type": "refresh_token",
             "f": "json",
         }
-        res = requests.post(
-            f"{STRAVA_BASE_URL}/oauth/token", data=payload, verify=False
-        )
+        res = self.session.post(f"{STRAVA_BASE_URL}/oauth/token", data=payload)
         res_json = res.json()
         logger.debug(res_json)
         res.raise_for_status()
-        # Get access token and update refresh token
-        access_token = res_json.get("access_token")
+        # Cache access token and update refresh token
+        self.token = res_json.get("access_token")
+        self.token_expires_at = res_json.get("expires_at", 0)
         self.refresh_token = res_json.get("refresh_token")
-        return access_token
+        return self.token
 
     def get_activity_data(self, **kwargs):
         """
@@ -86,20 +197,47 @@ class StravaManager:
         Page is the page from the api to fetch.
         """
         headers = {"Authorization": f"Bearer {self.get_access_token()}"}
-        response: dict = requests.get(
+        self.rate_limiter.acquire()
+        response: dict = self.session.get(
             f"{STRAVA_BASE_URL}/api/v3/athlete/activities",
             headers=headers,
             params=kwargs,
         )
+        self.rate_limiter.update(response.headers)
         response.raise_for_status()
         activity_data = response.json()
         logger.debug(f"Retrieved {activity_data}")
         return activity_data
 
-    def _save_data(self, data):
-        logger.debug(f"Saving {len(data)} records into strava table")
-        self.db_manager.save_data(data)
-        logger.debug(f"Successfully saved {len(data)} records into strava table")
+    def _save_data(self, rows):
+        """
+        Bulk insert the activity rows, skipping the activities already saved
+        Returns the number of activities newly inserted
+        """
+        logger.debug(f"Saving {len(rows)} records into strava table")
+        saved = self.db_manager.bulk_insert(
+            Strava, STRAVA_ACTIVITIES_COLUMNS, rows, ignore_conflicts=True
+        )
+        logger.debug(f"Successfully saved {saved} records into strava table")
+        if rows:
+            self._publish_rows_saved(
+                [row[0] for row in rows],
+                [row[START_TIME_INDEX] for row in rows],
+                [row[END_TIME_INDEX] for row in rows],
+            )
+        return saved
+
+    def _publish_rows_saved(self, ids, start_times, end_times):
+        """Publish the ids saved and the times spanned by the activities"""
+        if self.event_bus is not None:
+            self.event_bus.publish(
+                ROWS_SAVED,
+                table=Strava,
+                first_id=min(ids),
+                last_id=max(ids),
+                first_time=min(start_times),
+                last_time=max(end_times),
+            )
 
     def _get_last_record(self):
         """
@@ -142,6 +280,12 @@ class StravaManager:
             end_longitude=end_longitude,
         )
 
+    @staticmethod
+    def format_activity_row(record):
+        """Format the activity into a row in the order of STRAVA_ACTIVITIES_COLUMNS"""
+        activity = StravaManager.format_activity_data(record)
+        return tuple(getattr(activity, column) for column in STRAVA_ACTIVITIES_COLUMNS)
+
     def get_records_between_timestamp(self, start_time, end_time):
         """
         Get the strava data between the end/start times
@@ -149,19 +293,33 @@ class StravaManager:
         logger.debug(f"get_records({start_time}, {end_time})")
         return self._get_records(start_time, end_time)
 
+    def get_columns_between_timestamp(self, start_time, end_time, columns):
+        """
+        Get only the given columns of the strava data between the end/start times
+        """
+        logger.debug(
+            f"get_columns_between_timestamp({start_time}, {end_time}, {columns})"
+        )
+        return self.db_manager.get_columns_between_timestamp(
+            Strava, columns, start_time, end_time
+        )
+
     def _get_records(self, start_time, end_time):
         logger.debug(f"_get_records({start_time}, {end_time})")
         return self.db_manager.get_records_between_timestamp(
-            Strava, start_time, end_time, time_column="start_time"
+            Strava, start_time, end_time
         )
 
-    def update_data(self, records_per_page=1, page=1):
+    def update_data(self, records_per_page=1, page=1, backfill=False):
         """
         Get the latest record stored in the database
         Get the latest data from the Strava API from that latest record
         Add any new records to the database
+        With backfill, all the pages of the activity history are saved instead
         """
         logger.debug("update_data()")
+        if backfill:
+            return self.backfill(records_per_page=records_per_page)
         last_record = self._get_last_record()
         data = self.get_activity_data(
             after=compute_epoch(last_record.start_time),
@@ -169,7 +327,38 @@ class StravaManager:
             page=page,
         )
         if data:
-            formatted_data = [self.format_activity_data(record) for record in data]
-            self._save_data(formatted_data)
+            self._save_data([self.format_activity_row(record) for record in data])
         else:
             logger.debug("No data to save into strava table")
+
+    def backfill(self, records_per_page=100, max_workers=4):
+        """
+        Save all the pages of the activity history, newest first, fetching up to
+        max_workers pages concurrently within the rate limits.
+        Each page is bulk inserted as soon as it is fetched, skipping the activities
+        already saved, and checkpointed so an interrupted backfill resumes after
+        the last page saved. It finishes at the first empty page.
+        Returns the number of activities newly inserted
+        """
+        page = self.db_manager.get_checkpoint(BACKFILL_CHECKPOINT) + 1
+        logger.info(f"Backfilling strava activities from page {page}")
+        # Fetch the token once rather than from each worker
+        self.get_access_token()
+        saved = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                pages = range(page, page + max_workers)
+                fetched = executor.map(
+                    lambda p: self.get_activity_data(page=p, per_page=records_per_page),
+                    pages,
+                )
+                # Saved in page order so the checkpoint never skips a page
+                for fetched_page, data in zip(pages, fetched):
+                    if not data:
+                        logger.info(f"Backfilled {saved} new strava activities")
+                        return saved
+                    saved += self._save_data(
+                        [self.format_activity_row(record) for record in data]
+                    )
+                    self.db_manager.save_checkpoint(BACKFILL_CHECKPOINT, fetched_page)
+                page += max_workers
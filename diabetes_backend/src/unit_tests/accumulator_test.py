@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+
+from src.accumulator import TimeWeightedMean, merge_time_weighted_means
+
+
+def time_weighted_mean(timestamps, glucose):
+    """The reference trapezoidal mean of all the readings at once"""
+    return np.trapezoid(glucose, timestamps) / (timestamps[-1] - timestamps[0])
+
+
+class TestTimeWeightedMean(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.timestamps = np.cumsum(rng.integers(0, 900, 500)).astype(np.float64)
+        self.glucose = np.round(rng.uniform(3, 15, 500), 1)
+
+    def test_update(self):
+        accumulator = TimeWeightedMean()
+        self.assertIsNone(accumulator.mean)
+        accumulator.update([], [])
+        self.assertEqual(accumulator.count, 0)
+
+        # Consumed in chunks
+        for i in range(0, 500, 64):
+            accumulator.update(self.timestamps[i : i + 64], self.glucose[i : i + 64])
+        self.assertEqual(accumulator.count, 500)
+        self.assertEqual(accumulator.seconds, self.timestamps[-1] - self.timestamps[0])
+        self.assertEqual(accumulator.first, (self.timestamps[0], self.glucose[0]))
+        self.assertEqual(accumulator.last, (self.timestamps[-1], self.glucose[-1]))
+        self.assertAlmostEqual(
+            accumulator.mean, time_weighted_mean(self.timestamps, self.glucose)
+        )
+
+        # A single reading spans no time
+        self.assertIsNone(TimeWeightedMean().update([0], [5]).mean)
+
+    def test_merge(self):
+        accumulators = [
+            TimeWeightedMean().update(self.timestamps[i:j], self.glucose[i:j])
+            for i, j in ((0, 1), (1, 200), (200, 200), (200, 500))
+        ]
+        merged = merge_time_weighted_means(accumulators)
+        self.assertEqual(merged.count, 500)
+        self.assertAlmostEqual(
+            merged.mean, time_weighted_mean(self.timestamps, self.glucose)
+        )
+        # Merging does not change the accumulators
+        self.assertEqual(accumulators[0].count, 1)
+        self.assertEqual(merge_time_weighted_means([]).count, 0)
+
+    def test_to_dict(self):
+        accumulator = TimeWeightedMean().update([0, 60, 180], [5, 7, 6])
+        self.assertEqual(
+            accumulator.to_dict(),
+            {
+                "weighted_sum": 60 * 6 + 120 * 6.5,
+                "seconds": 180,
+                "count": 3,
+                "first_time": 0,
+                "first_glucose": 5,
+                "last_time": 180,
+                "last_glucose": 6,
+            },
+        )
+        restored = TimeWeightedMean.from_dict(accumulator.to_dict())
+        self.assertEqual(restored.to_dict(), accumulator.to_dict())
+        self.assertEqual(
+            TimeWeightedMean.from_dict(TimeWeightedMean().to_dict()).to_dict(),
+            TimeWeightedMean().to_dict(),
+        )
@@ -1,7 +1,11 @@
 import unittest
-from unittest.mock import patch
+from datetime import datetime as dt
+from datetime import timedelta
+from unittest.mock import Mock, PropertyMock, patch
 from requests import HTTPError
 from src.base import Base
+from src.database.tables import Glucose
+from src.events import ROWS_SAVED, EventBus
 
 ERROR_MSG = "My test error"
 
@@ -19,6 +23,10 @@ class ExampleBase(Base):
     def table(self):
         return "test"
 
+    @property
+    def columns(self):
+        return ("id", "value")
+
 
 class MockRequest:
     def __init__(self, response, raise_error=False):
@@ -85,6 +93,36 @@ class TestBaseView(unittest.TestCase):
             [[1, 2, 3], [4, 5, 6]],
         )
 
+    @patch("src.database_manager.DatabaseManager")
+    def test_get_columns_between_timestamp(self, mock_database_manager):
+        mock_database_manager.get_columns_between_timestamp.return_value = [1, 2]
+        base_cls = ExampleBase(
+            mock_database_manager,
+        )
+        result = base_cls.get_columns_between_timestamp(
+            self.start_date, self.end_date, ("timestamp",)
+        )
+        self.assertEqual(result, [1, 2])
+        mock_database_manager.get_columns_between_timestamp.assert_called_once_with(
+            base_cls.table, ("timestamp",), self.start_date, self.end_date
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_stream_records_between_timestamp(self, mock_database_manager):
+        mock_database_manager.stream_records_between_timestamp.return_value = iter(
+            [[1, 2], [3]]
+        )
+        base_cls = ExampleBase(
+            mock_database_manager,
+        )
+        result = base_cls.stream_records_between_timestamp(
+            self.start_date, self.end_date, chunk_size=2
+        )
+        self.assertEqual(list(result), [[1, 2], [3]])
+        mock_database_manager.stream_records_between_timestamp.assert_called_once_with(
+            base_cls.table, self.start_date, self.end_date, chunk_size=2
+        )
+
     @patch("src.database_manager.DatabaseManager")
     def test_get_last_record(self, mock_database_manager):
         mock_database_manager.get_last_record.return_value = 123
@@ -101,7 +139,51 @@ class TestBaseView(unittest.TestCase):
         )
         # Nothing to save
         base_cls._save_data([])
-        mock_database_manager.save_data.assert_not_called()
-        # Nothing to save
-        base_cls._save_data([1, 2])
-        mock_database_manager.save_data.assert_called_once_with([1, 2])
+        mock_database_manager.bulk_insert.assert_not_called()
+        # Rows saved in bulk
+        self.assertEqual(base_cls._save_data([(1, 2), (2, 3)]), 2)
+        mock_database_manager.bulk_insert.assert_called_once_with(
+            "test", ("id", "value"), [(1, 2), (2, 3)]
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_save_data_publishes_rows_saved(self, mock_database_manager):
+        event_bus = EventBus()
+        handler = Mock()
+        event_bus.subscribe(ROWS_SAVED, handler)
+        base_cls = ExampleBase(mock_database_manager, event_bus)
+        base_cls._save_data([])
+        handler.assert_not_called()
+        base_cls._save_data([(3, 2), (5, 3), (4, 1)])
+        # The table has no time field
+        handler.assert_called_once_with(
+            table="test", first_id=3, last_id=5, first_time=None, last_time=None
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_save_data_publishes_rows_saved_times(self, mock_database_manager):
+        event_bus = EventBus()
+        handler = Mock()
+        event_bus.subscribe(ROWS_SAVED, handler)
+        base_cls = ExampleBase(mock_database_manager, event_bus)
+        with patch.object(
+            ExampleBase, "table", new_callable=PropertyMock, return_value=Glucose
+        ), patch.object(
+            ExampleBase,
+            "columns",
+            new_callable=PropertyMock,
+            return_value=("id", "timestamp", "glucose"),
+        ):
+            base_cls._save_data(
+                [(3, dt(2024, 1, 2), 5), (4, dt(2024, 1, 1), 6), (5, dt(2024, 1, 3), 7)]
+            )
+        handler.assert_called_once_with(
+            table=Glucose,
+            first_id=3,
+            last_id=5,
+            first_time=dt(2024, 1, 1),
+            last_time=dt(2024, 1, 3),
+        )
+
+    def test_invalidated_by(self):
+        self.assertEqual(ExampleBase(None).invalidated_by, {"test": timedelta(0)})
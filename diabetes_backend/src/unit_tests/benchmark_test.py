@@ -0,0 +1,23 @@
+import unittest
+from datetime import timedelta
+
+from src.benchmark import generate_activities, generate_readings, main
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_readings(self):
+        readings = generate_readings(1, interval=timedelta(minutes=5))
+        self.assertEqual(len(readings), 288)
+        self.assertEqual(list(readings.columns), ["timestamp", "glucose"])
+        self.assertTrue(readings["glucose"].between(3, 15).all())
+
+    def test_generate_activities(self):
+        activities = generate_activities(10, per_day=2)
+        self.assertEqual(len(activities), 20)
+        self.assertEqual(len({x.start_time for x in activities}), 20)
+
+    def test_main(self):
+        seconds, reference_seconds = main(["hba1c", "--days", "1", "--repeat", "1"])
+        self.assertGreater(seconds, 0)
+        self.assertGreater(reference_seconds, 0)
+        main(["strava-summary", "--days", "1", "--repeat", "1"])
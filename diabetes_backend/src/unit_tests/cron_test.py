@@ -1,59 +1,152 @@
 import unittest
-from unittest.mock import call, patch
+from datetime import datetime, timezone
+from unittest.mock import Mock, patch
 
-from src.crons import data_cron, strava_cron, libre_cron
+from src.crons import (
+    CronCounters,
+    data_cron,
+    strava_backfill_cron,
+    strava_cron,
+    libre_cron,
+    rollup_rebuild_cron,
+)
+from src.strava import StravaRateLimitError
 
 
 class TestCrons(unittest.TestCase):
+    def test_cron_counters(self):
+        counters = CronCounters()
+        self.assertEqual(counters.get_metrics(), {})
+        counters.record("data", True)
+        counters.record("data", False)
+        counters.record("data", False)
+        counters.record("libre", True)
+        self.assertEqual(
+            counters.get_metrics(),
+            {
+                "data": {"executed": 1, "skipped": 2},
+                "libre": {"executed": 1, "skipped": 0},
+            },
+        )
+
     @patch("src.glucose.Glucose")
     def test_cron_no_patients(self, mock_libre):
-        mock_libre.get_patient_ids.return_value = []
+        mock_libre.get_latest_measurement_times.return_value = {}
+        mock_libre.update_all_cgm_data.return_value = {}
+        counters = CronCounters()
 
-        libre_cron(mock_libre)
+        libre_cron(mock_libre, counters)
 
         # Check calls
-        mock_libre.get_patient_ids.assert_called_once_with()
-        mock_libre.update_cgm_data.assert_not_called()
+        mock_libre.get_latest_measurement_times.assert_called_once_with()
+        mock_libre.update_all_cgm_data.assert_called_once_with({})
+        self.assertEqual(counters.get_metrics(), {})
 
         # Exception
-        mock_libre.get_patient_ids.side_effect = Exception("error")
-        libre_cron(mock_libre)
-        mock_libre.update_cgm_data.assert_not_called()
+        mock_libre.get_latest_measurement_times.side_effect = Exception("error")
+        libre_cron(mock_libre, counters)
+        mock_libre.update_all_cgm_data.assert_called_once()
 
     @patch("src.glucose.Glucose")
     def test_cron_many_patients(self, mock_libre):
-        patient_ids = ["1", "2"]
-        mock_libre.get_patient_ids.return_value = patient_ids
+        measurement_times = {"1": "1/1/2024 1:00:00 PM", "2": "1/1/2024 1:05:00 PM"}
+        mock_libre.get_latest_measurement_times.return_value = measurement_times
+        # The second patient has no new measurement
+        mock_libre.update_all_cgm_data.return_value = {"1": True, "2": False}
+        counters = CronCounters()
 
-        libre_cron(mock_libre)
+        libre_cron(mock_libre, counters)
 
         # Check calls
-        mock_libre.get_patient_ids.assert_called_once_with()
-        calls = [call(patient_id) for patient_id in patient_ids]
-        mock_libre.update_cgm_data.assert_has_calls(calls)
+        mock_libre.get_latest_measurement_times.assert_called_once_with()
+        mock_libre.update_all_cgm_data.assert_called_once_with(measurement_times)
+        self.assertEqual(
+            counters.get_metrics(), {"libre": {"executed": 1, "skipped": 1}}
+        )
 
         # Exception
-        mock_libre.update_cgm_data.side_effect = Exception("error")
-        libre_cron(mock_libre)
-        self.assertEqual(mock_libre.update_cgm_data.call_count, 3)
+        mock_libre.update_all_cgm_data.side_effect = Exception("error")
+        libre_cron(mock_libre, counters)
+        self.assertEqual(mock_libre.update_all_cgm_data.call_count, 2)
+        self.assertEqual(
+            counters.get_metrics(), {"libre": {"executed": 1, "skipped": 1}}
+        )
 
     @patch("src.strava.Strava")
     def test_strava_cron(self, mock_strava):
-        strava_cron(mock_strava)
+        counters = CronCounters()
+        strava_cron(mock_strava, counters)
         mock_strava.update_data.assert_called_once_with(records_per_page=100, page=1)
+        self.assertEqual(
+            counters.get_metrics(), {"strava": {"executed": 1, "skipped": 0}}
+        )
 
         # Exception
         mock_strava.update_data.side_effect = Exception("error")
-        strava_cron(mock_strava)
+        strava_cron(mock_strava, counters)
         self.assertEqual(mock_strava.update_data.call_count, 2)
+        self.assertEqual(
+            counters.get_metrics(), {"strava": {"executed": 1, "skipped": 0}}
+        )
+
+    @patch("src.strava.Strava")
+    def test_strava_backfill_cron(self, mock_strava):
+        counters = CronCounters()
+        strava_backfill_cron(mock_strava, counters)
+        mock_strava.update_data.assert_called_once_with(
+            records_per_page=100, backfill=True
+        )
+
+        # Exception
+        mock_strava.update_data.side_effect = Exception("error")
+        strava_backfill_cron(mock_strava, counters)
+        self.assertEqual(
+            counters.get_metrics(), {"strava_backfill": {"executed": 1, "skipped": 0}}
+        )
+
+        # Rescheduled for when the daily rate limit resets
+        reset_time = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        mock_strava.update_data.side_effect = StravaRateLimitError("limit", reset_time)
+        strava_backfill_cron(mock_strava, counters)
+        scheduler = Mock()
+        strava_backfill_cron(mock_strava, counters, scheduler=scheduler)
+        scheduler.add_job.assert_called_once_with(
+            func=strava_backfill_cron,
+            args=[mock_strava],
+            kwargs={"scheduler": scheduler},
+            trigger="date",
+            run_date=reset_time,
+        )
+        self.assertEqual(
+            counters.get_metrics(), {"strava_backfill": {"executed": 1, "skipped": 2}}
+        )
+
+    @patch("src.rollup.RollupManager")
+    def test_rollup_rebuild_cron(self, mock_rollup):
+        counters = CronCounters()
+        rollup_rebuild_cron(mock_rollup, counters)
+        mock_rollup.rebuild.assert_called_once_with()
+
+        # Exception
+        mock_rollup.rebuild.side_effect = Exception("error")
+        rollup_rebuild_cron(mock_rollup, counters)
+        self.assertEqual(
+            counters.get_metrics(), {"rollup_rebuild": {"executed": 1, "skipped": 0}}
+        )
 
     @patch("src.data.DataManager")
     def test_data_cron(self, mock_data):
-        data_cron(mock_data)
-        mock_data.combine_data.assert_called_once()
-        mock_data.combine_data.assert_called_once_with()
+        mock_data.combine_new_data.side_effect = [True, False]
+        counters = CronCounters()
+        data_cron(mock_data, counters)
+        data_cron(mock_data, counters)
+        mock_data.combine_new_data.assert_called_with()
+        self.assertEqual(mock_data.combine_new_data.call_count, 2)
+        self.assertEqual(
+            counters.get_metrics(), {"data": {"executed": 1, "skipped": 1}}
+        )
 
         # Exception
-        mock_data.combine_data.side_effect = Exception("error")
-        data_cron(mock_data)
-        self.assertEqual(mock_data.combine_data.call_count, 2)
+        mock_data.combine_new_data.side_effect = Exception("error")
+        data_cron(mock_data, counters)
+        self.assertEqual(mock_data.combine_new_data.call_count, 3)
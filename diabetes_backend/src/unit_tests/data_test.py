@@ -1,6 +1,8 @@
 import unittest
 from unittest.mock import patch
 from datetime import datetime, timedelta
+
+import pandas as pd
 from requests import HTTPError
 from src.database.tables import Glucose, GlucoseExercise, Strava
 from src.data import DataManager
@@ -60,15 +62,12 @@ class TestData(unittest.TestCase):
         ]  # Id is bigger than 1 of last record strava id
 
     @patch("src.database_manager.DatabaseManager")
-    def test_get_glucose_records_within_interval(self, mock_database_manager):
+    def test_get_glucose_within_intervals(self, mock_database_manager):
         data = DataManager(mock_database_manager)
-        # Some data data
-        data._get_glucose_records_within_interval(
-            datetime(2000, 1, 1), datetime(2000, 2, 1)
-        )
-        mock_database_manager.get_records_between_timestamp.assert_called_once()
-        mock_database_manager.get_records_between_timestamp.assert_called_with(
-            Glucose, datetime(2000, 1, 1), datetime(2000, 2, 1)
+        intervals = [(datetime(2000, 1, 1), datetime(2000, 2, 1))]
+        data._get_glucose_within_intervals(intervals)
+        mock_database_manager.get_columns_within_intervals.assert_called_once_with(
+            Glucose, ("id", "timestamp"), intervals
         )
 
     @patch("src.database_manager.DatabaseManager")
@@ -81,7 +80,7 @@ class TestData(unittest.TestCase):
         )  # Mock get_filtered_by_id_records to be empty
         data = DataManager(mock_database_manager)
         # No data
-        data.combine_data()
+        self.assertEqual(data.combine_data(), 0)
         # Assert mocks
         mock_database_manager.get_last_record.assert_called_once()
         mock_database_manager.get_last_record.assert_called_with(GlucoseExercise)
@@ -89,8 +88,9 @@ class TestData(unittest.TestCase):
         mock_database_manager.get_filtered_by_id_records.assert_called_with(
             Strava, 12345
         )
-        # No data saved
-        self.assertEqual(mock_database_manager.save_data.call_count, 0)
+        # No glucose queried and no data saved
+        mock_database_manager.get_columns_within_intervals.assert_not_called()
+        mock_database_manager.bulk_insert.assert_not_called()
 
     @patch("src.database_manager.DatabaseManager")
     def test_combine_data_no_libre_data(self, mock_database_manager):
@@ -101,8 +101,8 @@ class TestData(unittest.TestCase):
         mock_database_manager.get_filtered_by_id_records.return_value = (
             self.mock_strava_data
         )
-        mock_database_manager.get_records_between_timestamp.return_value = (
-            []
+        mock_database_manager.get_columns_within_intervals.return_value = pd.DataFrame(
+            columns=["id", "timestamp"]
         )  # Mock glucose data to be empty
         data = DataManager(mock_database_manager)
         # No data
@@ -114,11 +114,19 @@ class TestData(unittest.TestCase):
         mock_database_manager.get_filtered_by_id_records.assert_called_with(
             Strava, 12345
         )
-        self.assertEqual(
-            mock_database_manager.get_records_between_timestamp.call_count, 2
+        # A single query over the merged activity windows
+        mock_database_manager.get_columns_within_intervals.assert_called_once_with(
+            Glucose,
+            ("id", "timestamp"),
+            [
+                (
+                    self.activity_start - timedelta(hours=1),
+                    self.activity_end + timedelta(hours=1),
+                )
+            ],
         )
         # No data saved
-        self.assertEqual(mock_database_manager.save_data.call_count, 0)
+        mock_database_manager.bulk_insert.assert_not_called()
 
     @patch("src.database_manager.DatabaseManager")
     def test_combine_data_success(self, mock_database_manager):
@@ -128,17 +136,17 @@ class TestData(unittest.TestCase):
         mock_database_manager.get_filtered_by_id_records.return_value = (
             self.mock_strava_data
         )
-        mock_database_manager.get_records_between_timestamp.return_value = [
-            Glucose(
-                id=1, glucose=2, timestamp=self.activity_start + timedelta(seconds=20)
-            ),
-            Glucose(
-                id=2, glucose=6, timestamp=self.activity_start + timedelta(seconds=40)
-            ),
-        ]  # Mock libre data, can be anything as long as its length 3
+        mock_database_manager.get_columns_within_intervals.return_value = pd.DataFrame(
+            {
+                "id": [1, 2],
+                "timestamp": [
+                    self.activity_start + timedelta(seconds=20),
+                    self.activity_start + timedelta(seconds=40),
+                ],
+            }
+        )
         data = DataManager(mock_database_manager)
-        # No data
-        data.combine_data()
+        self.assertEqual(data.combine_data(), 4)
         # Assert mocks
         mock_database_manager.get_last_record.assert_called_once()
         mock_database_manager.get_last_record.assert_called_with(GlucoseExercise)
@@ -146,62 +154,199 @@ class TestData(unittest.TestCase):
         mock_database_manager.get_filtered_by_id_records.assert_called_with(
             Strava, 12345
         )
-        self.assertEqual(
-            mock_database_manager.get_records_between_timestamp.call_count, 2
-        )
-        # Data saved
-        self.assertEqual(mock_database_manager.save_data.call_count, 1)
-
-        # TODO: Figure out why the calls don't match
-        # mock_database_manager.save_data.assert_called_with(
-        #     ([
-        #         GlucoseExercise(
-        #             id=6,
-        #             timestamp=self.activity_start + timedelta(seconds=20),
-        #             activity_type="RUN",
-        #             distance=5,
-        #             glucose=2,
-        #             strava_id=12346,
-        #             glucose_id=1,
-        #             seconds_since_start=20,
-        #             activity_start=self.activity_start,
-        #             activity_end=self.activity_end,
-        #         ),
-        #         GlucoseExercise(
-        #             id=7,
-        #             glucose=6,
-        #             glucose_id=2,
-        #             strava_id=12346,
-        #             timestamp=self.activity_start + timedelta(seconds=40),
-        #             activity_type="RUN",
-        #             distance=5,
-        #             activity_start=self.activity_start,
-        #             activity_end=self.activity_end,
-        #             seconds_since_start=40,
-        #         ),
-        #         GlucoseExercise(
-        #             id=8,
-        #             glucose_id=1,
-        #             glucose=2,
-        #             strava_id=12347,
-        #             timestamp=self.activity_start + timedelta(seconds=20),
-        #             activity_type="WALK",
-        #             distance=10,
-        #             activity_start=self.activity_start,
-        #             activity_end=self.activity_end,
-        #             seconds_since_start=20,
-        #         ),
-        #         GlucoseExercise(
-        #             id=9,
-        #             glucose=6,
-        #             glucose_id=2,
-        #             strava_id=12347,
-        #             timestamp=self.activity_start + timedelta(seconds=40),
-        #             activity_type="WALK",
-        #             distance=10,
-        #             activity_start=self.activity_start,
-        #             activity_end=self.activity_end,
-        #             seconds_since_start=40,
-        #         ),
-        #     ]),
-        # )
+        # A single query over the merged activity windows
+        mock_database_manager.get_columns_within_intervals.assert_called_once_with(
+            Glucose,
+            ("id", "timestamp"),
+            [
+                (
+                    self.activity_start - timedelta(hours=1),
+                    self.activity_end + timedelta(hours=1),
+                )
+            ],
+        )
+        # Data saved, a row for each glucose record in each activity window
+        mock_database_manager.bulk_insert.assert_called_once_with(
+            GlucoseExercise,
+            data.columns,
+            [
+                (
+                    6,
+                    12346,
+                    1,
+                    10,
+                    self.activity_start + timedelta(seconds=20),
+                    self.activity_start,
+                    self.activity_end,
+                    "WALK",
+                    20,
+                ),
+                (
+                    7,
+                    12346,
+                    2,
+                    10,
+                    self.activity_start + timedelta(seconds=40),
+                    self.activity_start,
+                    self.activity_end,
+                    "WALK",
+                    40,
+                ),
+                (
+                    8,
+                    12347,
+                    1,
+                    10,
+                    self.activity_start + timedelta(seconds=20),
+                    self.activity_start,
+                    self.activity_end,
+                    "WALK",
+                    20,
+                ),
+                (
+                    9,
+                    12347,
+                    2,
+                    10,
+                    self.activity_start + timedelta(seconds=40),
+                    self.activity_start,
+                    self.activity_end,
+                    "WALK",
+                    40,
+                ),
+            ],
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_combine_data_separate_windows(self, mock_database_manager):
+        mock_database_manager.get_last_record.return_value = (
+            self.mock_existing_glucose_exercise_record
+        )
+        second_start = self.activity_start + timedelta(hours=5)
+        mock_database_manager.get_filtered_by_id_records.return_value = [
+            self.mock_strava_data[0],
+            Strava(
+                id=12348,
+                distance=3,
+                activity_type="RUN",
+                start_time=second_start,
+                end_time=second_start + timedelta(minutes=30),
+            ),
+        ]
+        mock_database_manager.get_columns_within_intervals.return_value = pd.DataFrame(
+            {
+                "id": [1, 2, 3],
+                "timestamp": [
+                    self.activity_start - timedelta(minutes=61),
+                    self.activity_end + timedelta(minutes=60),
+                    second_start - timedelta(minutes=10),
+                ],
+            }
+        )
+        data = DataManager(mock_database_manager)
+        self.assertEqual(data.combine_data(), 2)
+        mock_database_manager.get_columns_within_intervals.assert_called_once_with(
+            Glucose,
+            ("id", "timestamp"),
+            [
+                (
+                    self.activity_start - timedelta(hours=1),
+                    self.activity_end + timedelta(hours=1),
+                ),
+                (
+                    second_start - timedelta(hours=1),
+                    second_start + timedelta(minutes=90),
+                ),
+            ],
+        )
+        # Readings outside of the activity windows are skipped
+        mock_database_manager.bulk_insert.assert_called_once_with(
+            GlucoseExercise,
+            data.columns,
+            [
+                (
+                    6,
+                    12346,
+                    2,
+                    10,
+                    self.activity_end + timedelta(minutes=60),
+                    self.activity_start,
+                    self.activity_end,
+                    "WALK",
+                    7200,
+                ),
+                (
+                    7,
+                    12348,
+                    3,
+                    3,
+                    second_start - timedelta(minutes=10),
+                    second_start,
+                    second_start + timedelta(minutes=30),
+                    "RUN",
+                    -600,
+                ),
+            ],
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_combine_data_in_database(self, mock_database_manager):
+        mock_database_manager.get_last_record.return_value = (
+            self.mock_existing_glucose_exercise_record
+        )
+        mock_database_manager.combine_glucose_exercise.return_value = 7
+        data = DataManager(mock_database_manager, combine_in_database=True)
+        self.assertEqual(data.combine_data(), 7)
+        mock_database_manager.combine_glucose_exercise.assert_called_once_with(
+            strava_ids=(12346, None), window_seconds=3600
+        )
+        # No rows travel through the application
+        mock_database_manager.get_filtered_by_id_records.assert_not_called()
+        mock_database_manager.get_columns_within_intervals.assert_not_called()
+        mock_database_manager.bulk_insert.assert_not_called()
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_combine_new_data(self, mock_database_manager):
+        mock_database_manager.get_max_ids.return_value = (12345, 10)
+        data = DataManager(mock_database_manager, combine_in_database=True)
+        with patch.object(data, "combine_data") as mock_combine_data:
+            self.assertTrue(data.combine_new_data())
+            # Nothing new since the last combine
+            self.assertFalse(data.combine_new_data())
+            mock_combine_data.assert_called_once_with()
+            # A new glucose reading
+            mock_database_manager.get_max_ids.return_value = (12345, 11)
+            self.assertTrue(data.combine_new_data())
+            self.assertEqual(mock_combine_data.call_count, 2)
+            # The watermark is kept when combining fails
+            mock_database_manager.get_max_ids.return_value = (12346, 11)
+            mock_combine_data.side_effect = Exception("error")
+            with self.assertRaises(Exception):
+                data.combine_new_data()
+            self.assertEqual(data.watermark, (12345, 11))
+        mock_database_manager.get_max_ids.assert_called_with(Strava, Glucose)
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_on_rows_saved_in_database(self, mock_database_manager):
+        mock_database_manager.combine_glucose_exercise.return_value = 3
+        data = DataManager(mock_database_manager, combine_in_database=True)
+        # Only the saved id ranges are combined
+        self.assertEqual(data.on_rows_saved(Strava, 10, 12), 3)
+        mock_database_manager.combine_glucose_exercise.assert_called_with(
+            strava_ids=(10, 12), window_seconds=3600
+        )
+        self.assertEqual(data.on_rows_saved(Glucose, 100, 150), 3)
+        mock_database_manager.combine_glucose_exercise.assert_called_with(
+            glucose_ids=(100, 150), window_seconds=3600
+        )
+        # Its own rows are ignored
+        self.assertEqual(data.on_rows_saved(GlucoseExercise, 1, 2), 0)
+        self.assertEqual(mock_database_manager.combine_glucose_exercise.call_count, 2)
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_on_rows_saved_in_python(self, mock_database_manager):
+        data = DataManager(mock_database_manager)
+        with patch.object(data, "combine_data", return_value=4) as mock_combine_data:
+            self.assertEqual(data.on_rows_saved(Glucose, 100, 150), 4)
+            mock_combine_data.assert_called_once_with()
+        mock_database_manager.combine_glucose_exercise.assert_not_called()
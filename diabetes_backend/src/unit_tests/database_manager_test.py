@@ -1,8 +1,16 @@
+import datetime
 import unittest
 from unittest import mock
 
-from src.database.tables import Glucose, GlucoseExercise, Strava
-from src.database_manager import DatabaseManager
+from sqlalchemy.dialects import postgresql
+from src.database.tables import (
+    Checkpoint,
+    Glucose,
+    GlucoseExercise,
+    GlucoseRollup,
+    Strava,
+)
+from src.database_manager import COMBINE_GLUCOSE_EXERCISE_LOCK, DatabaseManager
 
 
 class TestDatabaseManager(unittest.TestCase):
@@ -76,20 +84,391 @@ class TestDatabaseManager(unittest.TestCase):
         session_mock.execute.return_value = []
         mock_session.return_value.__enter__.return_value = session_mock
         res = database_manager.get_records_between_timestamp(
-            Glucose, "start", "end", "time_column"
+            Glucose, "2024-01-01 12:00:00", datetime.datetime(2024, 1, 2, 12)
         )
         session_mock.execute.assert_called_once()
         self.assertEqual(res, [])
+        # Filtered on and ordered by the time field, with datetime parameters
+        stmt = session_mock.execute.call_args[0][0]
+        self.assertIn(
+            "WHERE glucose_level.timestamp BETWEEN :timestamp_1 AND :timestamp_2 "
+            "ORDER BY glucose_level.timestamp ASC",
+            str(stmt),
+        )
+        self.assertEqual(
+            stmt.compile().params,
+            {
+                "timestamp_1": datetime.datetime(2024, 1, 1, 12),
+                "timestamp_2": datetime.datetime(2024, 1, 2, 12),
+            },
+        )
 
         #  Result Found
         # Do not care on the actual result type
         session_mock.execute.return_value = [(1,), (2,)]
         mock_session.return_value.__enter__.return_value = session_mock
         res = database_manager.get_records_between_timestamp(
-            Glucose, "start", "end", "time_column"
+            Strava, "2024-01-01 12:00:00", "2024-01-02 12:00:00"
         )
         self.assertEqual(session_mock.execute.call_count, 2)
         self.assertEqual(res, [1, 2])
+        self.assertIn(
+            "ORDER BY strava.start_time ASC", str(session_mock.execute.call_args[0][0])
+        )
+
+    def test_bulk_insert(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.begin.return_value.__enter__.return_value
+        database_manager = DatabaseManager(mock_engine)
+        # Nothing to insert
+        self.assertEqual(
+            database_manager.bulk_insert(Glucose, ("id", "glucose"), []), 0
+        )
+        mock_engine.begin.assert_not_called()
+
+        # A single executemany
+        self.assertEqual(
+            database_manager.bulk_insert(Glucose, ("id", "glucose"), [(1, 5), (2, 6)]),
+            2,
+        )
+        connection_mock.execute.assert_called_once()
+        stmt, rows = connection_mock.execute.call_args[0]
+        self.assertEqual(stmt.table.name, "glucose_level")
+        self.assertEqual(rows, [{"id": 1, "glucose": 5}, {"id": 2, "glucose": 6}])
+
+    def test_get_latest_timestamp(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.connect.return_value.__enter__.return_value
+        connection_mock.execute.return_value.scalar.return_value = 5
+        database_manager = DatabaseManager(mock_engine)
+        self.assertEqual(database_manager.get_latest_timestamp(Glucose), 5)
+        self.assertIn(
+            "SELECT max(glucose_level.timestamp)",
+            str(connection_mock.execute.call_args[0][0]),
+        )
+
+    def test_get_earliest_timestamp(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.connect.return_value.__enter__.return_value
+        connection_mock.execute.return_value.scalar.return_value = 5
+        database_manager = DatabaseManager(mock_engine)
+        self.assertEqual(database_manager.get_earliest_timestamp(GlucoseRollup), 5)
+        self.assertIn(
+            "SELECT min(glucose_rollup_15min.bucket_start)",
+            str(connection_mock.execute.call_args[0][0]),
+        )
+
+    def test_upsert(self):
+        mock_engine = mock.MagicMock()
+        mock_engine.dialect.name = "postgresql"
+        connection_mock = mock_engine.begin.return_value.__enter__.return_value
+        database_manager = DatabaseManager(mock_engine)
+        # Nothing to upsert
+        self.assertEqual(
+            database_manager.upsert(GlucoseRollup, ("bucket_start", "count"), []), 0
+        )
+        mock_engine.begin.assert_not_called()
+
+        bucket_start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(
+            database_manager.upsert(
+                GlucoseRollup, ("bucket_start", "count"), [(bucket_start, 3)]
+            ),
+            1,
+        )
+        stmt, rows = connection_mock.execute.call_args[0]
+        self.assertEqual(rows, [{"bucket_start": bucket_start, "count": 3}])
+        self.assertIn(
+            "ON CONFLICT (bucket_start) DO UPDATE SET count = excluded.count",
+            str(stmt.compile(dialect=postgresql.dialect())),
+        )
+
+        # Not supported by the dialect
+        mock_engine.dialect.name = "mssql"
+        with self.assertRaises(ValueError):
+            database_manager.upsert(
+                GlucoseRollup, ("bucket_start", "count"), [(bucket_start, 3)]
+            )
+
+    def test_get_existing_ids(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.connect.return_value.__enter__.return_value
+        connection_mock.execute.return_value.scalars.return_value = [2, 3]
+        database_manager = DatabaseManager(mock_engine)
+        self.assertEqual(database_manager.get_existing_ids(Strava, [1, 2, 3]), {2, 3})
+        self.assertIn(
+            "WHERE strava.id IN", str(connection_mock.execute.call_args[0][0])
+        )
+        # No ids, no query
+        self.assertEqual(database_manager.get_existing_ids(Strava, []), set())
+        connection_mock.execute.assert_called_once()
+
+    def test_get_max_ids(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.connect.return_value.__enter__.return_value
+        connection_mock.execute.return_value.one.return_value = (12, None)
+        database_manager = DatabaseManager(mock_engine)
+        self.assertEqual(database_manager.get_max_ids(Strava, Glucose), (12, 0))
+        # A single query
+        connection_mock.execute.assert_called_once()
+        sql = str(connection_mock.execute.call_args[0][0])
+        self.assertIn("SELECT max(strava.id)", sql)
+        self.assertIn("SELECT max(glucose_level.id)", sql)
+        with self.assertRaises(ValueError):
+            database_manager.get_max_ids("bad")
+
+    def test_combine_glucose_exercise(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.begin.return_value.__enter__.return_value
+        connection_mock.execute.return_value.rowcount = 4
+        database_manager = DatabaseManager(mock_engine)
+        self.assertEqual(
+            database_manager.combine_glucose_exercise(strava_ids=(10, None)), 4
+        )
+        connection_mock.execute.assert_called_once()
+        stmt = connection_mock.execute.call_args[0][0]
+        sql = str(stmt)
+        # A single INSERT ... SELECT joining within the activity windows
+        self.assertIn("INSERT INTO glucose_exercise", sql)
+        self.assertIn("SELECT coalesce(max(glucose_exercise.id), :coalesce_2)", sql)
+        self.assertIn(
+            "FROM strava JOIN glucose_level ON glucose_level.timestamp BETWEEN "
+            "strava.start_time - :start_time_1 AND strava.end_time + :end_time_1",
+            sql,
+        )
+        self.assertIn("WHERE strava.id >= :id_2 AND NOT (EXISTS", sql)
+        # Pairs already combined are skipped
+        self.assertIn(
+            "WHERE glucose_exercise.strava_id = strava.id "
+            "AND glucose_exercise.glucose_id = glucose_level.id",
+            sql,
+        )
+        self.assertIn(
+            "row_number() OVER (ORDER BY strava.id, glucose_level.timestamp, "
+            "glucose_level.id)",
+            sql,
+        )
+        params = stmt.compile().params
+        self.assertEqual(params["id_2"], 10)
+        self.assertEqual(params["start_time_1"], datetime.timedelta(hours=1))
+
+        # Only the saved glucose id range
+        database_manager.combine_glucose_exercise(glucose_ids=(3, 5))
+        stmt = connection_mock.execute.call_args[0][0]
+        self.assertIn(
+            "WHERE glucose_level.id >= :id_2 AND glucose_level.id <= :id_3 AND NOT",
+            str(stmt),
+        )
+        params = stmt.compile().params
+        self.assertEqual((params["id_2"], params["id_3"]), (3, 5))
+
+        # The combines of every process take turns on Postgres
+        mock_engine.dialect.name = "postgresql"
+        connection_mock.execute.reset_mock()
+        database_manager.combine_glucose_exercise()
+        lock, stmt = [c[0][0] for c in connection_mock.execute.call_args_list]
+        self.assertEqual(
+            str(lock.compile(compile_kwargs={"literal_binds": True})),
+            f"SELECT pg_advisory_xact_lock({COMBINE_GLUCOSE_EXERCISE_LOCK}) "
+            "AS pg_advisory_xact_lock_1",
+        )
+        self.assertIn("INSERT INTO glucose_exercise", str(stmt))
+
+    def test_bulk_insert_ignore_conflicts(self):
+        mock_engine = mock.MagicMock()
+        mock_engine.dialect.name = "postgresql"
+        connection_mock = mock_engine.begin.return_value.__enter__.return_value
+        # Only the first row is inserted, the second one is already present
+        connection_mock.execute.return_value.all.return_value = [(1,)]
+        database_manager = DatabaseManager(mock_engine)
+        self.assertEqual(
+            database_manager.bulk_insert(
+                Strava, ("id", "distance"), [(1, 5), (2, 6)], ignore_conflicts=True
+            ),
+            1,
+        )
+        stmt = str(
+            connection_mock.execute.call_args[0][0].compile(
+                dialect=postgresql.dialect()
+            )
+        )
+        self.assertIn("ON CONFLICT DO NOTHING RETURNING strava.id", stmt)
+
+        # Not supported by the dialect
+        mock_engine.dialect.name = "mssql"
+        with self.assertRaises(ValueError):
+            database_manager.bulk_insert(
+                Strava, ("id", "distance"), [(1, 5)], ignore_conflicts=True
+            )
+
+    @mock.patch("src.database_manager.Session")
+    def test_checkpoint(self, mock_session):
+        mock_engine = mock.MagicMock()
+        database_manager = DatabaseManager(mock_engine)
+        session_mock = mock_session.return_value.__enter__.return_value
+        # Never saved
+        session_mock.get.return_value = None
+        self.assertEqual(database_manager.get_checkpoint("backfill"), 0)
+        session_mock.get.assert_called_once_with(Checkpoint, "backfill")
+        session_mock.get.return_value = Checkpoint(name="backfill", value=3)
+        self.assertEqual(database_manager.get_checkpoint("backfill"), 3)
+
+        database_manager.save_checkpoint("backfill", 4)
+        checkpoint = session_mock.merge.call_args[0][0]
+        self.assertEqual((checkpoint.name, checkpoint.value), ("backfill", 4))
+        session_mock.commit.assert_called_once_with()
+
+    def test_copy_rows(self):
+        mock_engine = mock.MagicMock()
+        mock_engine.dialect.name = "postgresql"
+        raw_connection = mock_engine.raw_connection.return_value
+        cursor_mock = raw_connection.cursor.return_value.__enter__.return_value
+        copied = []
+        cursor_mock.copy_expert.side_effect = lambda sql, buffer: copied.append(
+            (sql, buffer.read())
+        )
+        database_manager = DatabaseManager(mock_engine)
+        res = database_manager.copy_rows(
+            Glucose,
+            ("id", "timestamp", "glucose"),
+            iter([(1, datetime.datetime(2024, 1, 1, 12), 5.5), (2, "2024-01-02", 6)]),
+        )
+        self.assertEqual(res, 2)
+        self.assertEqual(
+            copied,
+            [
+                (
+                    "COPY glucose_level (id, timestamp, glucose) "
+                    "FROM STDIN WITH (FORMAT csv)",
+                    "1,2024-01-01 12:00:00,5.5\r\n2,2024-01-02,6\r\n",
+                )
+            ],
+        )
+        raw_connection.commit.assert_called_once()
+        raw_connection.close.assert_called_once()
+
+        # Nothing to copy
+        self.assertEqual(database_manager.copy_rows(Glucose, ("id",), []), 0)
+        mock_engine.raw_connection.assert_called_once()
+
+        # Other databases insert in bulk
+        mock_engine.dialect.name = "sqlite"
+        with mock.patch.object(database_manager, "bulk_insert") as mock_bulk_insert:
+            mock_bulk_insert.return_value = 1
+            self.assertEqual(database_manager.copy_rows(Glucose, ("id",), [(1,)]), 1)
+            mock_bulk_insert.assert_called_once_with(Glucose, ("id",), [(1,)])
+
+    def test_get_columns_next_to_timestamp(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.connect.return_value.__enter__.return_value
+        connection_mock.execute.return_value.fetchall.return_value = [
+            (datetime.datetime(2024, 1, 1, 12), 5.5),
+        ]
+        database_manager = DatabaseManager(mock_engine)
+        for method, where in (
+            (database_manager.get_columns_before_timestamp, "<"),
+            (database_manager.get_columns_from_timestamp, ">="),
+        ):
+            res = method(Glucose, ("timestamp", "glucose"), "2024-01-01 12:05:00")
+            self.assertEqual(
+                res.to_dict("records"),
+                [{"timestamp": datetime.datetime(2024, 1, 1, 12), "glucose": 5.5}],
+            )
+            stmt = str(connection_mock.execute.call_args[0][0])
+            self.assertIn(f"WHERE glucose_level.timestamp {where} ", stmt)
+            self.assertIn("LIMIT", stmt)
+
+        connection_mock.execute.return_value.fetchall.return_value = []
+        res = database_manager.get_columns_before_timestamp(
+            Glucose, ("timestamp", "glucose"), "2024-01-01 12:05:00"
+        )
+        self.assertTrue(res.empty)
+        self.assertEqual(list(res.columns), ["timestamp", "glucose"])
+
+    def test_get_columns_between_timestamp(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.connect.return_value.__enter__.return_value
+        connection_mock.execute.return_value.fetchall.return_value = [
+            (datetime.datetime(2024, 1, 1, 12), 5.5),
+            (datetime.datetime(2024, 1, 1, 12, 5), 6.0),
+        ]
+        database_manager = DatabaseManager(mock_engine)
+        res = database_manager.get_columns_between_timestamp(
+            Glucose, ("timestamp", "glucose"), "2024-01-01 00:00:00", "2024-01-02"
+        )
+        self.assertEqual(list(res.columns), ["timestamp", "glucose"])
+        self.assertEqual(res["glucose"].to_list(), [5.5, 6.0])
+        self.assertEqual(
+            res["timestamp"].to_list(),
+            [datetime.datetime(2024, 1, 1, 12), datetime.datetime(2024, 1, 1, 12, 5)],
+        )
+        # Only the requested columns are selected
+        stmt = connection_mock.execute.call_args[0][0]
+        self.assertTrue(
+            str(stmt).startswith(
+                "SELECT glucose_level.timestamp, glucose_level.glucose \nFROM glucose_level"
+            )
+        )
+        self.assertIn("ORDER BY glucose_level.timestamp ASC", str(stmt))
+
+        # No data
+        connection_mock.execute.return_value.fetchall.return_value = []
+        res = database_manager.get_columns_between_timestamp(
+            Glucose, ("timestamp", "glucose"), "2024-01-01 00:00:00", "2024-01-02"
+        )
+        self.assertTrue(res.empty)
+        self.assertEqual(list(res.columns), ["timestamp", "glucose"])
+
+    def test_get_columns_within_intervals(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.connect.return_value.__enter__.return_value
+        connection_mock.execute.return_value.fetchall.return_value = [(1,), (2,)]
+        database_manager = DatabaseManager(mock_engine)
+        res = database_manager.get_columns_within_intervals(
+            Glucose,
+            ("id",),
+            [("2024-01-01", "2024-01-02"), ("2024-02-01", "2024-02-02")],
+        )
+        self.assertEqual(res["id"].to_list(), [1, 2])
+        # A single query over all the intervals
+        stmt = connection_mock.execute.call_args[0][0]
+        self.assertIn(
+            "WHERE glucose_level.timestamp BETWEEN :timestamp_1 AND :timestamp_2 "
+            "OR glucose_level.timestamp BETWEEN :timestamp_3 AND :timestamp_4 "
+            "ORDER BY glucose_level.timestamp ASC",
+            str(stmt),
+        )
+
+        # No intervals, no query
+        res = database_manager.get_columns_within_intervals(Glucose, ("id",), [])
+        self.assertTrue(res.empty)
+        self.assertEqual(list(res.columns), ["id"])
+        connection_mock.execute.assert_called_once()
+
+    def test_stream_records_between_timestamp(self):
+        mock_engine = mock.MagicMock()
+        connection_mock = mock_engine.connect.return_value.__enter__.return_value
+        execute_mock = connection_mock.execution_options.return_value.execute
+        execute_mock.return_value.mappings.return_value.partitions.return_value = [
+            [{"id": 1, "glucose": 5.5}, {"id": 2, "glucose": 6.0}],
+            [{"id": 3, "glucose": 6.5}],
+        ]
+        database_manager = DatabaseManager(mock_engine)
+        res = database_manager.stream_records_between_timestamp(
+            Glucose, "2024-01-01 00:00:00", "2024-01-02", chunk_size=2
+        )
+        # Nothing is queried until the records are consumed
+        mock_engine.connect.assert_not_called()
+        self.assertEqual(
+            list(res),
+            [
+                [{"id": 1, "glucose": 5.5}, {"id": 2, "glucose": 6.0}],
+                [{"id": 3, "glucose": 6.5}],
+            ],
+        )
+        connection_mock.execution_options.assert_called_once_with(yield_per=2)
+        stmt = execute_mock.call_args[0][0]
+        self.assertIn("ORDER BY glucose_level.timestamp ASC", str(stmt))
 
     @mock.patch("src.database_manager.Session")
     def test_get_filtered_by_id_records(self, mock_session):
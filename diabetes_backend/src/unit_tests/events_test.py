@@ -0,0 +1,34 @@
+import unittest
+from unittest.mock import Mock
+
+from src.events import ROWS_SAVED, EventBus
+
+
+class TestEventBus(unittest.TestCase):
+    def test_publish_no_handlers(self):
+        event_bus = EventBus()
+        self.assertEqual(event_bus.publish(ROWS_SAVED, table="t"), 0)
+
+    def test_publish(self):
+        event_bus = EventBus()
+        handler = Mock()
+        other_handler = Mock()
+        event_bus.subscribe(ROWS_SAVED, handler)
+        event_bus.subscribe(ROWS_SAVED, other_handler)
+        event_bus.subscribe("other", Mock())
+        self.assertEqual(
+            event_bus.publish(ROWS_SAVED, table="t", first_id=1, last_id=3), 2
+        )
+        handler.assert_called_once_with(table="t", first_id=1, last_id=3)
+        other_handler.assert_called_once_with(table="t", first_id=1, last_id=3)
+
+    def test_publish_failing_handler(self):
+        event_bus = EventBus()
+        failing_handler = Mock(side_effect=Exception("error"))
+        handler = Mock()
+        event_bus.subscribe(ROWS_SAVED, failing_handler)
+        event_bus.subscribe(ROWS_SAVED, handler)
+        # The error does not reach the publisher nor the other handlers
+        self.assertEqual(event_bus.publish(ROWS_SAVED, table="t"), 2)
+        failing_handler.assert_called_once_with(table="t")
+        handler.assert_called_once_with(table="t")
@@ -5,13 +5,17 @@ from datetime import datetime as dt
 from datetime import timezone
 from requests import HTTPError
 from src.unit_tests.base import TestBase
-from src.constants import HEADERS
-from src.glucose import GlucoseManager
+from src.constants import DATETIME_FORMAT, HEADERS
+from src.glucose import GlucoseManager, parse_local_timestamps
 from src.database.tables import Glucose
 
 ERROR_MSG = "My test error"
 
 
+def to_utc(timestamp):
+    return dt.strptime(timestamp, DATETIME_FORMAT).astimezone(timezone.utc)
+
+
 class MockRequest:
     def __init__(self, data, raise_error=False):
         self.data = data
@@ -75,7 +79,7 @@ class TestGlucose(TestBase):
             "isLow": False,
         }
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("src.auth.AuthenticationManagement", autospec=True)
     @patch("src.database_manager.DatabaseManager")
     def test_get_patient_ids_success(
@@ -102,7 +106,32 @@ class TestGlucose(TestBase):
         )
         self.assertEqual(mock_database_manager.call_count, 0)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
+    @patch("src.auth.AuthenticationManagement", autospec=True)
+    @patch("src.database_manager.DatabaseManager")
+    def test_get_latest_measurement_times(
+        self, mock_database_manager, mock_auth_manager, mock_requests
+    ):
+        mock_requests.return_value = MockRequest(
+            [
+                {
+                    "patientId": "123",
+                    "glucoseMeasurement": {"Timestamp": "1/1/2024 1:00:00 PM"},
+                },
+                {"patientId": "456", "glucoseMeasurement": None},
+            ]
+        )
+        glucose = GlucoseManager(
+            "email", "password", mock_auth_manager, mock_database_manager
+        )
+        self.assertEqual(
+            glucose.get_latest_measurement_times(),
+            {"123": "1/1/2024 1:00:00 PM", "456": None},
+        )
+        mock_requests.assert_called_once()
+        self.assertEqual(mock_database_manager.call_count, 0)
+
+    @patch("requests.Session.get")
     @patch("src.auth.AuthenticationManagement", autospec=True)
     @patch("src.database_manager.DatabaseManager")
     def test_get_patient_ids_failure(
@@ -121,7 +150,7 @@ class TestGlucose(TestBase):
         mock_requests.assert_called_once()
         self.assertEqual(mock_database_manager.call_count, 0)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("src.auth.AuthenticationManagement", autospec=True)
     @patch("src.database_manager.DatabaseManager")
     def test_get_cgm_data_success(
@@ -163,7 +192,7 @@ class TestGlucose(TestBase):
         )
         self.assertEqual(mock_database_manager.call_count, 0)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("src.auth.AuthenticationManagement", autospec=True)
     @patch("src.database_manager.DatabaseManager")
     def test_get_cgm_data_failure(
@@ -206,7 +235,7 @@ class TestGlucose(TestBase):
         )
         self.assertEqual(mock_database_manager.call_count, 0)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("src.auth.AuthenticationManagement", autospec=True)
     @patch("src.database_manager.DatabaseManager")
     def test_update_cgm_data_success(
@@ -222,13 +251,14 @@ class TestGlucose(TestBase):
             timestamp=dt(2020, 1, 1, 12, 0, 0).astimezone(timezone.utc),
             glucose=5,
         )
+        mock_database_manager.get_latest_timestamp.return_value = None
 
         glucose = GlucoseManager(
             "email", "password", mock_auth_manager, mock_database_manager
         )
         patient_id = "patient_id_123"
         result = glucose.update_cgm_data(patient_id)
-        self.assertIsNone(result)
+        self.assertTrue(result)
 
         # Check the mocks
         mock_auth_manager.return_value.get_token.assert_called_once()
@@ -239,7 +269,150 @@ class TestGlucose(TestBase):
         )
         mock_database_manager.get_last_record.assert_called_once()
         mock_database_manager.get_last_record.assert_called_once_with(Glucose)
-        mock_database_manager.save_data.assert_called_once()
+        mock_database_manager.get_latest_timestamp.assert_called_once_with(Glucose)
+        mock_database_manager.bulk_insert.assert_called_once_with(
+            Glucose,
+            ("id", "timestamp", "glucose"),
+            [
+                (
+                    2,
+                    to_utc(self.test_data_1.get("Timestamp")),
+                    self.test_data_1.get("Value"),
+                )
+            ],
+        )
+
+    @patch("requests.Session.get")
+    @patch("src.auth.AuthenticationManagement", autospec=True)
+    @patch("src.database_manager.DatabaseManager")
+    def test_update_cgm_data_skips_processed_measurement(
+        self, mock_database_manager, mock_auth_manager, mock_requests
+    ):
+        mock_requests.return_value = MockRequest({"graphData": [self.test_data_1]})
+        mock_database_manager.get_last_record.return_value = Glucose(
+            id=1,
+            timestamp=dt(2020, 1, 1, 12, 0, 0).astimezone(timezone.utc),
+            glucose=5,
+        )
+        mock_database_manager.get_latest_timestamp.return_value = None
+        glucose = GlucoseManager(
+            "email", "password", mock_auth_manager, mock_database_manager
+        )
+        measurement_time = self.test_data_1.get("Timestamp")
+        self.assertTrue(glucose.update_cgm_data("123", measurement_time))
+        # Same latest measurement, nothing fetched
+        self.assertFalse(glucose.update_cgm_data("123", measurement_time))
+        mock_requests.assert_called_once()
+        mock_database_manager.bulk_insert.assert_called_once()
+        # Another patient is still fetched
+        self.assertTrue(glucose.update_cgm_data("456", measurement_time))
+        self.assertEqual(mock_requests.call_count, 2)
+
+    @patch("src.auth.AuthenticationManagement", autospec=True)
+    @patch("src.database_manager.DatabaseManager")
+    def test_get_all_cgm_data(self, mock_database_manager, mock_auth_manager):
+        mock_auth_manager.return_value.get_token.return_value = "mock_token"
+        glucose = GlucoseManager(
+            "email", "password", mock_auth_manager, mock_database_manager
+        )
+        self.assertEqual(glucose.get_all_cgm_data([]), {})
+
+        def get(url, headers):
+            if "/bad/" in url:
+                return MockRequest([], raise_error=True)
+            return MockRequest({"graphData": [url]})
+
+        with patch.object(glucose.session, "get", side_effect=get) as mock_get:
+            result = glucose.get_all_cgm_data(["1", "bad", "2"])
+        self.assertEqual(
+            result["1"],
+            {
+                "data": {
+                    "graphData": ["https://api.libreview.io/llu/connections/1/graph"]
+                }
+            },
+        )
+        self.assertEqual(
+            result["2"],
+            {
+                "data": {
+                    "graphData": ["https://api.libreview.io/llu/connections/2/graph"]
+                }
+            },
+        )
+        self.assertIsInstance(result["bad"], HTTPError)
+        # A single token for all the patients
+        mock_auth_manager.return_value.get_token.assert_called_once_with()
+        self.assertEqual(mock_get.call_count, 3)
+        for call_args in mock_get.call_args_list:
+            self.assertEqual(
+                call_args.kwargs["headers"],
+                {**HEADERS, "Authorization": "Bearer mock_token"},
+            )
+
+    @patch("src.auth.AuthenticationManagement", autospec=True)
+    @patch("src.database_manager.DatabaseManager")
+    def test_update_all_cgm_data(self, mock_database_manager, mock_auth_manager):
+        mock_database_manager.get_last_record.return_value = Glucose(
+            id=1,
+            timestamp=dt(2020, 1, 1, 12, 0, 0).astimezone(timezone.utc),
+            glucose=5,
+        )
+        mock_database_manager.get_latest_timestamp.return_value = None
+        glucose = GlucoseManager(
+            "email", "password", mock_auth_manager, mock_database_manager
+        )
+        glucose.measurement_watermarks["3"] = "old"
+        with patch.object(
+            glucose,
+            "get_all_cgm_data",
+            return_value={
+                "1": {"data": {"graphData": [self.test_data_1]}},
+                "2": HTTPError(ERROR_MSG),
+            },
+        ) as mock_get_all:
+            result = glucose.update_all_cgm_data({"1": "new", "2": "new", "3": "old"})
+        # Only the patients with a new measurement are fetched
+        mock_get_all.assert_called_once_with(["1", "2"])
+        # The failed patient is left out and can be retried
+        self.assertEqual(result, {"1": True, "3": False})
+        self.assertEqual(glucose.measurement_watermarks, {"1": "new", "3": "old"})
+        mock_database_manager.bulk_insert.assert_called_once()
+
+    @patch("requests.Session.get")
+    @patch("src.auth.AuthenticationManagement", autospec=True)
+    @patch("src.database_manager.DatabaseManager")
+    def test_update_cgm_data_after_latest_timestamp(
+        self, mock_database_manager, mock_auth_manager, mock_requests
+    ):
+        mock_requests.return_value = MockRequest(
+            {"graphData": [self.test_data_1, self.test_data_2]}
+        )
+        # An imported historic reading has the max id
+        mock_database_manager.get_last_record.return_value = Glucose(
+            id=10,
+            timestamp=dt(2020, 1, 1, 12, 0, 0).astimezone(timezone.utc),
+            glucose=5,
+        )
+        mock_database_manager.get_latest_timestamp.return_value = dt.strptime(
+            self.test_data_1.get("Timestamp"), DATETIME_FORMAT
+        ).astimezone(timezone.utc)
+        glucose = GlucoseManager(
+            "email", "password", mock_auth_manager, mock_database_manager
+        )
+        glucose.update_cgm_data("123")
+        # Only the readings after the latest saved one, with ids after the max id
+        mock_database_manager.bulk_insert.assert_called_once_with(
+            Glucose,
+            ("id", "timestamp", "glucose"),
+            [
+                (
+                    11,
+                    to_utc(self.test_data_2.get("Timestamp")),
+                    self.test_data_2.get("Value"),
+                )
+            ],
+        )
 
     @patch("src.auth.AuthenticationManagement", autospec=True)
     @patch("src.database_manager.DatabaseManager")
@@ -256,9 +429,7 @@ class TestGlucose(TestBase):
         )
         results = glucose.format_cgm_data(last_timestamp, id, test_data)
 
-        self.assertResultRepresentations(
-            results, [Glucose(id=2, timestamp="12/31/2000 10:30:01 AM", glucose=5.4)]
-        )
+        self.assertEqual(results, [(2, to_utc("12/31/2000 10:30:01 AM"), 5.4)])
 
         # All records are returned
         results = glucose.format_cgm_data(
@@ -267,23 +438,45 @@ class TestGlucose(TestBase):
             [self.test_data_1, self.test_data_2, self.test_data_3],
         )
 
-        self.assertResultRepresentations(
+        self.assertEqual(
             results,
             [
-                Glucose(
-                    id=1,
-                    glucose=self.test_data_1.get("Value"),
-                    timestamp=self.test_data_1.get("Timestamp"),
+                (
+                    1,
+                    to_utc(self.test_data_1.get("Timestamp")),
+                    self.test_data_1.get("Value"),
+                ),
+                (
+                    2,
+                    to_utc(self.test_data_2.get("Timestamp")),
+                    self.test_data_2.get("Value"),
                 ),
-                Glucose(
-                    id=2,
-                    glucose=self.test_data_2.get("Value"),
-                    timestamp=self.test_data_2.get("Timestamp"),
+                (
+                    3,
+                    to_utc(self.test_data_3.get("Timestamp")),
+                    self.test_data_3.get("Value"),
+                ),
+            ],
+        )
+
+        # Unordered records are returned in time order
+        results = glucose.format_cgm_data(
+            dt(1000, 11, 7).astimezone(timezone.utc),
+            0,
+            [self.test_data_3, self.test_data_1],
+        )
+        self.assertEqual(
+            results,
+            [
+                (
+                    1,
+                    to_utc(self.test_data_1.get("Timestamp")),
+                    self.test_data_1.get("Value"),
                 ),
-                Glucose(
-                    id=3,
-                    glucose=self.test_data_3.get("Value"),
-                    timestamp=self.test_data_3.get("Timestamp"),
+                (
+                    2,
+                    to_utc(self.test_data_3.get("Timestamp")),
+                    self.test_data_3.get("Value"),
                 ),
             ],
         )
@@ -294,13 +487,27 @@ class TestGlucose(TestBase):
             2,
             [self.test_data_1, self.test_data_2, self.test_data_3],
         )
-        self.assertResultRepresentations(
+        self.assertEqual(
             results,
             [
-                Glucose(
-                    id=3,
-                    glucose=self.test_data_3.get("Value"),
-                    timestamp=self.test_data_3.get("Timestamp"),
+                (
+                    3,
+                    to_utc(self.test_data_3.get("Timestamp")),
+                    self.test_data_3.get("Value"),
                 )
             ],
         )
+
+    def test_parse_local_timestamps(self):
+        # Including the times around the daylight saving time transitions
+        timestamps = [
+            "3/31/2024 12:30:00 AM",
+            "3/31/2024 1:30:00 AM",
+            "3/31/2024 2:30:00 AM",
+            "10/27/2024 1:30:00 AM",
+            "10/27/2024 2:30:00 AM",
+        ]
+        self.assertEqual(
+            parse_local_timestamps(timestamps).to_pydatetime().tolist(),
+            [to_utc(timestamp) for timestamp in timestamps],
+        )
@@ -0,0 +1,171 @@
+import io
+import unittest
+from unittest.mock import patch
+
+import pandas as pd
+from src.constants import STRAVA_ACTIVITIES_COLUMNS
+from src.database.tables import Glucose, Strava
+from src.importer import import_activities, import_glucose, main, parse_csv_timestamps
+
+GLUCOSE_CSV = """id,glucose,timestamp
+1,7.7,2024-08-17 18:56:11
+2,7.4,2024-08-17 19:10:55
+3,7.4,2024-08-17 19:10:55
+4,6.9,2024-08-17 19:25:55
+5,6.2,2024-08-17 19:40:55
+"""
+
+ACTIVITIES_CSV = """id,distance,activity_type,moving_time,elapsed_time,start_time,end_time,start_latitude,end_latitude,start_longitude,end_longitude
+159827896,1731.7,Run,564,721,2014-06-17 07:38:31,2014-06-17 07:47:55,51.4,51.5,-2.6,-2.7
+161222566,7703.4,Run,2705,2726,2014-06-20 18:47:04,2014-06-20 19:32:09,51.4,51.5,-2.6,-2.7
+161629506,9180.0,Run,3052,3161,2014-06-21 18:07:16,2014-06-21 18:58:08,51.4,51.5,-2.6,-2.7
+"""
+
+
+class TestImporter(unittest.TestCase):
+    def test_parse_csv_timestamps(self):
+        result = parse_csv_timestamps(
+            pd.Series(["2024-08-17 18:56:11", "2024-01-17 18:56:11"]), "Europe/London"
+        )
+        self.assertEqual(
+            result.tolist(),
+            [
+                pd.Timestamp("2024-08-17 17:56:11", tz="UTC"),
+                pd.Timestamp("2024-01-17 18:56:11", tz="UTC"),
+            ],
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_import_glucose(self, mock_database_manager):
+        mock_database_manager.get_max_ids.return_value = (100,)
+        # The first reading is already saved
+        mock_database_manager.get_columns_between_timestamp.side_effect = [
+            pd.DataFrame({"timestamp": [pd.Timestamp("2024-08-17 18:56:11+00:00")]}),
+            pd.DataFrame({"timestamp": []}),
+        ]
+        loaded = []
+
+        def copy_rows(table, columns, rows):
+            rows = list(rows)
+            loaded.extend(rows)
+            return len(rows)
+
+        mock_database_manager.copy_rows.side_effect = copy_rows
+        result = import_glucose(
+            mock_database_manager, io.StringIO(GLUCOSE_CSV), chunksize=3
+        )
+        self.assertEqual(
+            result,
+            {
+                "read": 5,
+                "loaded": 3,
+                "ids": (101, 103),
+                "times": (
+                    pd.Timestamp("2024-08-17 19:10:55+00:00"),
+                    pd.Timestamp("2024-08-17 19:40:55+00:00"),
+                ),
+            },
+        )
+        # Chunks are checked against the saved readings within their range
+        mock_database_manager.get_columns_between_timestamp.assert_any_call(
+            Glucose,
+            ("timestamp",),
+            pd.Timestamp("2024-08-17 18:56:11+00:00"),
+            pd.Timestamp("2024-08-17 19:10:55+00:00"),
+        )
+        self.assertEqual(mock_database_manager.copy_rows.call_count, 2)
+        self.assertEqual(
+            mock_database_manager.copy_rows.call_args[0][:2],
+            (Glucose, ("id", "timestamp", "glucose")),
+        )
+        # Duplicated timestamps are loaded once
+        self.assertEqual(
+            loaded,
+            [
+                (101, pd.Timestamp("2024-08-17 19:10:55+00:00"), 7.4),
+                (102, pd.Timestamp("2024-08-17 19:25:55+00:00"), 6.9),
+                (103, pd.Timestamp("2024-08-17 19:40:55+00:00"), 6.2),
+            ],
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_import_activities(self, mock_database_manager):
+        mock_database_manager.get_existing_ids.return_value = {161222566}
+        loaded = []
+
+        def copy_rows(table, columns, rows):
+            rows = list(rows)
+            loaded.extend(rows)
+            return len(rows)
+
+        mock_database_manager.copy_rows.side_effect = copy_rows
+        result = import_activities(
+            mock_database_manager, io.StringIO(ACTIVITIES_CSV), chunksize=10
+        )
+        self.assertEqual(
+            result, {"read": 3, "loaded": 2, "ids": (159827896, 161629506)}
+        )
+        mock_database_manager.get_existing_ids.assert_called_once_with(
+            Strava, [159827896, 161222566, 161629506]
+        )
+        table, columns, _ = mock_database_manager.copy_rows.call_args[0]
+        self.assertEqual((table, columns), (Strava, STRAVA_ACTIVITIES_COLUMNS))
+        self.assertEqual([row[0] for row in loaded], [159827896, 161629506])
+        self.assertEqual(
+            loaded[0][STRAVA_ACTIVITIES_COLUMNS.index("start_time")],
+            pd.Timestamp("2014-06-17 07:38:31+00:00"),
+        )
+
+    @patch("src.importer.DailyMeanManager")
+    @patch("src.importer.RollupManager")
+    @patch("src.importer.DataManager")
+    @patch("src.importer.DatabaseManager")
+    @patch("src.importer.create_database_engine")
+    @patch("src.importer.load_database_url_from_env")
+    @patch("src.importer.import_glucose")
+    def test_main(
+        self,
+        mock_import_glucose,
+        mock_load_url,
+        mock_create_engine,
+        mock_database_manager,
+        mock_data_manager,
+        mock_rollup_manager,
+        mock_daily_mean_manager,
+    ):
+        times = (pd.Timestamp("2024-08-17 19:10:55+00:00"), pd.Timestamp("2024-08-18"))
+        mock_import_glucose.return_value = {
+            "read": 5,
+            "loaded": 3,
+            "ids": (1, 3),
+            "times": times,
+        }
+        with patch.dict(
+            "src.importer.IMPORTERS", {"glucose": (mock_import_glucose, Glucose)}
+        ):
+            main(["glucose", "glucose.csv", "--chunksize", "10"])
+        mock_import_glucose.assert_called_once_with(
+            mock_database_manager.return_value, "glucose.csv", 10, "UTC"
+        )
+        # The imported rows are combined
+        mock_data_manager.return_value.on_rows_saved.assert_called_once_with(
+            Glucose, 1, 3
+        )
+        # and rolled up
+        mock_rollup_manager.return_value.rebuild.assert_called_once_with(*times)
+        mock_daily_mean_manager.return_value.rebuild.assert_called_once_with(*times)
+
+        # Nothing imported, nothing combined
+        mock_import_glucose.return_value = {
+            "read": 5,
+            "loaded": 0,
+            "ids": (4, 3),
+            "times": (None, None),
+        }
+        with patch.dict(
+            "src.importer.IMPORTERS", {"glucose": (mock_import_glucose, Glucose)}
+        ):
+            main(["glucose", "glucose.csv"])
+        mock_data_manager.return_value.on_rows_saved.assert_called_once()
+        mock_rollup_manager.return_value.rebuild.assert_called_once()
+        mock_daily_mean_manager.return_value.rebuild.assert_called_once()
@@ -1,14 +1,24 @@
+import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch
 from datetime import datetime as dt
 
 import flask
-from src.views.metric import Metric
+from datetime import timedelta
+from src.views.metric import Metric, MetricCache
 from marshmallow import Schema, fields
+from sqlalchemy import create_engine
 from werkzeug import exceptions
-from src.constants import STRAVA_DATETIME
+from src.constants import STRAVA_ACTIVITIES_COLUMNS, STRAVA_DATETIME
+from src.database.tables import Base as TableBase, Strava
+from src.database_manager import DatabaseManager
+from src.schemas import TimeIntervalApproximateSchema, TimeIntervalSchema
+from src.strava import StravaManager
 from src.utils import (
     convert_ts_to_str,
+    run_sum_strava_data,
 )
 
 
@@ -91,3 +101,307 @@ class TestUtils(unittest.TestCase):
                 str(e.exception),
                 "400 Bad Request: {'end': ['Missing data for required field.']}",
             )
+
+    @patch("src.glucose.GlucoseManager")
+    def test_get_glucose_invalid_timestamp(self, mock_glucose):
+        """Timestamps the queries cannot bind are rejected rather than failing"""
+        flask_app = flask.Flask("test_flask_app")
+        metric = Metric(TimeIntervalSchema(), mock_glucose, lambda x: test_func(x, 0))
+        for args in ({"start": "2024/08/17"}, {"end": "yesterday"}):
+            with flask_app.test_request_context() as mock_context:
+                mock_context.request.args = args
+                with self.assertRaises(exceptions.BadRequest) as e:
+                    metric.get()
+                self.assertIn("Not an ISO 8601 timestamp.", str(e.exception))
+        mock_glucose.get_records_between_timestamp.assert_not_called()
+
+        # The formats of the app and its clients
+        mock_glucose.get_records_between_timestamp.return_value = [[1]]
+        for start in ("2024-08-17", "2024-08-17 12:00:00", "2024-08-17T12:00:00Z"):
+            with flask_app.test_request_context() as mock_context:
+                mock_context.request.args = {"start": start}
+                self.assertEqual(metric.get(), ([2], 200))
+
+    @patch("src.glucose.GlucoseManager")
+    def test_get_glucose_columns(self, mock_glucose):
+        """The columnar fetch is used when the view is given columns"""
+        flask_app = flask.Flask("test_flask_app")
+        with flask_app.test_request_context() as mock_context:
+            mock_context.request.args = {
+                "start": convert_ts_to_str(dt(2000, 1, 1), STRAVA_DATETIME),
+                "end": convert_ts_to_str(dt(2001, 1, 1), STRAVA_DATETIME),
+            }
+            mock_glucose.get_columns_between_timestamp.return_value = [[1], [2]]
+            metric = Metric(
+                TestSchema(),
+                mock_glucose,
+                lambda x: test_func(x, 0),
+                columns=("timestamp", "glucose"),
+            )
+            result = metric.get()
+            self.assertEqual(result, ([2, 3], 200))
+            mock_glucose.get_columns_between_timestamp.assert_called_once_with(
+                "2000-01-01 00:00:00", "2001-01-01 00:00:00", ("timestamp", "glucose")
+            )
+            mock_glucose.get_records_between_timestamp.assert_not_called()
+
+    @patch("src.glucose.GlucoseManager")
+    def test_get_glucose_cached(self, mock_glucose):
+        """The results are cached per endpoint, window and parameters"""
+        flask_app = flask.Flask("test_flask_app")
+        mock_glucose.get_records_between_timestamp.return_value = [[1, 2], [2, 2]]
+        mock_glucose.invalidated_by = {"glucose": timedelta(0)}
+        cache = MetricCache()
+        metric = Metric(
+            TestSchemaAdditionalKwargs(),
+            mock_glucose,
+            lambda x, **kwargs: test_func(x, 0, **kwargs),
+            cache=cache,
+        )
+        args = {"start": "2000-01-01 00:00:00", "end": "2001-01-01 00:00:00"}
+        for request_args in (args, args, {**args, "additional_value": 0.5}, args):
+            with flask_app.test_request_context() as mock_context:
+                mock_context.request.args = request_args
+                metric.get()
+        self.assertEqual(mock_glucose.get_records_between_timestamp.call_count, 2)
+        self.assertEqual(
+            cache.get_metrics(),
+            {"size": 2, "hits": 2, "misses": 2, "invalidations": 0},
+        )
+
+        # Rows saved within the window are recomputed
+        cache.on_rows_saved(
+            "glucose", 1, 2, "2000-06-01 00:00:00", "2000-06-01 01:00:00"
+        )
+        with flask_app.test_request_context() as mock_context:
+            mock_context.request.args = args
+            self.assertEqual(metric.get(), ([2, 3], 200))
+        self.assertEqual(mock_glucose.get_records_between_timestamp.call_count, 3)
+
+    @patch("src.rollup.RollupManager")
+    @patch("src.glucose.GlucoseManager")
+    def test_get_glucose_rollup(self, mock_glucose, mock_rollup):
+        """Windows longer than a day are computed from the rollups"""
+        flask_app = flask.Flask("test_flask_app")
+        mock_glucose.get_columns_between_timestamp.return_value = [[1], [2]]
+        mock_rollup.get_columns_between_timestamp.return_value = [[10], [20]]
+        mock_rollup.columns = ("bucket_start", "count")
+        metric = Metric(
+            TestSchema(),
+            mock_glucose,
+            lambda x: test_func(x, 0),
+            columns=("timestamp", "glucose"),
+            rollup=(mock_rollup, lambda x: test_func(x, 0, additional_value=1)),
+        )
+        for start, end, expected in (
+            ("2000-01-01 00:00:00", "2000-01-02 00:00:00", [2, 3]),
+            ("2000-01-01 00:00:00", "2000-01-02 00:00:01", [12, 22]),
+        ):
+            with flask_app.test_request_context() as mock_context:
+                mock_context.request.args = {"start": start, "end": end}
+                self.assertEqual(metric.get(), (expected, 200))
+        mock_glucose.get_columns_between_timestamp.assert_called_once_with(
+            "2000-01-01 00:00:00", "2000-01-02 00:00:00", ("timestamp", "glucose")
+        )
+        mock_rollup.get_columns_between_timestamp.assert_called_once_with(
+            "2000-01-01 00:00:00", "2000-01-02 00:00:01", ("bucket_start", "count")
+        )
+
+    @patch("src.rollup.RollupManager")
+    @patch("src.glucose.GlucoseManager")
+    def test_get_glucose_approximate_rollup(self, mock_glucose, mock_rollup):
+        """Approximate rollups are only used when the request asks for them"""
+        flask_app = flask.Flask("test_flask_app")
+        mock_glucose.get_columns_between_timestamp.return_value = [[1], [2]]
+        mock_rollup.get_columns_between_timestamp.return_value = [[10], [20]]
+        mock_rollup.columns = ("bucket_start", "count")
+        metric = Metric(
+            TimeIntervalApproximateSchema(),
+            mock_glucose,
+            lambda x: test_func(x, 0),
+            columns=("timestamp", "glucose"),
+            rollup=(mock_rollup, lambda x: test_func(x, 0, additional_value=1)),
+            approximate_rollup=True,
+        )
+        args = {"start": "2000-01-01 00:00:00", "end": "2000-01-03 00:00:00"}
+        for approximate, expected in (
+            (None, [2, 3]),
+            ("false", [2, 3]),
+            ("true", [12, 22]),
+            ("1", [12, 22]),
+            ("yes", [12, 22]),
+        ):
+            with flask_app.test_request_context() as mock_context:
+                mock_context.request.args = (
+                    args
+                    if approximate is None
+                    else {**args, "approximate": approximate}
+                )
+                self.assertEqual(metric.get(), (expected, 200))
+        self.assertEqual(mock_glucose.get_columns_between_timestamp.call_count, 2)
+        self.assertEqual(mock_rollup.get_columns_between_timestamp.call_count, 3)
+
+
+class TestStravaSummary(unittest.TestCase):
+    """The strava summary of the columns read from a SQLite database"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        engine = create_engine(f"sqlite:///{os.path.join(self.directory, 'test.db')}")
+        TableBase.metadata.create_all(engine)
+        self.db_manager = DatabaseManager(engine)
+        self.strava = StravaManager("id", "secret", "token", None, self.db_manager)
+
+    def tearDown(self):
+        self.db_manager.engine.dispose()
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def test_get_strava_summary(self):
+        day = dt(2024, 1, 2, 9)
+        activities = [
+            (day, "Run", 5.0),
+            (day - timedelta(days=1), "Run", 3.0),
+            (day - timedelta(hours=15), "Ride", 20.0),
+            (day + timedelta(days=30), "Run", 1.0),
+        ]
+        rows = [
+            {
+                "id": str(idx),
+                "distance": distance,
+                "activity_type": activity_type,
+                "start_time": start_time,
+                "end_time": start_time + timedelta(hours=1),
+            }
+            for idx, (start_time, activity_type, distance) in enumerate(activities)
+        ]
+        self.db_manager.bulk_insert(
+            Strava,
+            STRAVA_ACTIVITIES_COLUMNS,
+            [
+                tuple(row.get(column, 0) for column in STRAVA_ACTIVITIES_COLUMNS)
+                for row in rows
+            ],
+        )
+        flask_app = flask.Flask("test_flask_app")
+        flask_app.add_url_rule(
+            "/strava/summary",
+            view_func=Metric.as_view(
+                "strava-summary",
+                TimeIntervalSchema(),
+                self.strava,
+                lambda x: run_sum_strava_data(x),
+                columns=("start_time", "activity_type", "distance"),
+            ),
+        )
+        response = flask_app.test_client().get(
+            "/strava/summary",
+            query_string={"start": "2024-01-01 00:00:00", "end": "2024-01-31 00:00:00"},
+        )
+        self.assertEqual(response.status_code, 200)
+        summary = response.get_json()
+        self.assertEqual(
+            {key: value["count"] for key, value in summary.items()},
+            {"Ride": 1, "Run": 2},
+        )
+        self.assertEqual(
+            [row["totalDistance"] for row in summary["Run"]["timestampData"]],
+            [3.0, 8.0],
+        )
+
+
+class TestMetricCache(unittest.TestCase):
+    def test_get_or_compute(self):
+        now = [0]
+        cache = MetricCache(maxsize=2, ttl_seconds=10, clock=lambda: now[0])
+        dependencies = {"glucose": timedelta(0)}
+        self.assertEqual(
+            cache.get_or_compute("a", (None, None), dependencies, lambda: 1), 1
+        )
+        self.assertEqual(
+            cache.get_or_compute("a", (None, None), dependencies, lambda: 2), 1
+        )
+        cache.get_or_compute("b", (None, None), dependencies, lambda: 3)
+        # The least recently used is evicted
+        cache.get_or_compute("c", (None, None), dependencies, lambda: 4)
+        self.assertEqual(list(cache.entries), ["b", "c"])
+        self.assertEqual(
+            cache.get_or_compute("a", (None, None), dependencies, lambda: 5), 5
+        )
+        # Expired
+        now[0] = 11
+        self.assertEqual(
+            cache.get_or_compute("a", (None, None), dependencies, lambda: 6), 6
+        )
+        self.assertEqual(
+            cache.get_metrics(),
+            {"size": 2, "hits": 1, "misses": 5, "invalidations": 0},
+        )
+
+    def test_invalidated_while_computing(self):
+        cache = MetricCache()
+
+        def compute():
+            cache.on_rows_saved("glucose", 1, 1)
+            return 1
+
+        cache.get_or_compute("a", (None, None), {"glucose": timedelta(0)}, compute)
+        # The result may be stale, so it is not cached
+        self.assertEqual(cache.entries, {})
+
+    def test_on_rows_saved(self):
+        cache = MetricCache()
+        cache.get_or_compute(
+            "january",
+            ("2024-01-01 00:00:00", "2024-02-01 00:00:00"),
+            {"glucose": timedelta(0), "strava": timedelta(hours=1)},
+            lambda: 1,
+        )
+        cache.get_or_compute(
+            "since february",
+            ("2024-02-01 00:00:00", None),
+            {"glucose": timedelta(0)},
+            lambda: 2,
+        )
+        # Other table
+        self.assertEqual(cache.on_rows_saved("other", 1, 1), 0)
+        # Outside of the windows
+        self.assertEqual(
+            cache.on_rows_saved(
+                "glucose", 1, 1, "2023-12-01 00:00:00", "2023-12-31 23:00:00"
+            ),
+            0,
+        )
+        self.assertEqual(
+            cache.on_rows_saved(
+                "strava", 1, 1, "2024-02-01T01:30:00Z", "2024-02-01 02:00:00"
+            ),
+            0,
+        )
+        # Within the margin of the window
+        self.assertEqual(
+            cache.on_rows_saved(
+                "strava", 1, 1, "2024-02-01T00:30:00Z", "2024-02-01 01:00:00"
+            ),
+            1,
+        )
+        self.assertEqual(list(cache.entries), ["since february"])
+        # Open ended window
+        self.assertEqual(
+            cache.on_rows_saved(
+                "glucose", 1, 1, "2030-01-01 00:00:00", "2030-01-01 00:00:00"
+            ),
+            1,
+        )
+        self.assertEqual(cache.get_metrics()["invalidations"], 2)
+
+    def test_on_rows_saved_unknown_times(self):
+        cache = MetricCache()
+        cache.get_or_compute(
+            "a",
+            ("2024-01-01 00:00:00", "2024-02-01 00:00:00"),
+            {"glucose": timedelta(0)},
+            lambda: 1,
+        )
+        self.assertEqual(cache.on_rows_saved("glucose", 1, 1), 1)
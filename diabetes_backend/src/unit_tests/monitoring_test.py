@@ -0,0 +1,12 @@
+import unittest
+
+import flask
+from src.views.monitoring import Monitoring
+
+
+class TestMonitoring(unittest.TestCase):
+    def test_get(self):
+        flask_app = flask.Flask("test_flask_app")
+        with flask_app.test_request_context():
+            monitoring = Monitoring(lambda: {"checkouts": 3})
+            self.assertEqual(monitoring.get(), ({"checkouts": 3}, 200))
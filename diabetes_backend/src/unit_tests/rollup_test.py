@@ -0,0 +1,539 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime as dt
+from datetime import timedelta, timezone
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.database.tables import Glucose, GlucoseDailyMean, GlucoseRollup, Strava
+from src.database.tables import Base as TableBase
+from src.database_manager import DatabaseManager
+from src.rollup import (
+    DailyMeanManager,
+    RollupManager,
+    accumulate_time_weighted_mean,
+    aggregate_glucose_rollup_data,
+    compute_glucose_rollup,
+    glucose_quartile_rollup_data,
+    libre_extremes_in_rollup_buckets,
+    libre_hba1c_from_daily_means,
+)
+from src.utils import (
+    aggregate_glucose_data,
+    compute_epoch_array,
+    glucose_quartile_data,
+    libre_extremes_in_buckets,
+    libre_hba1c,
+)
+
+
+def readings(start, count, minutes=5):
+    return pd.DataFrame(
+        {
+            "timestamp": [start + timedelta(minutes=minutes * i) for i in range(count)],
+            "glucose": [5.0 + (i % 3) for i in range(count)],
+        }
+    )
+
+
+def rollup_frame(data):
+    """The rollups of the Glucose records as read from the database"""
+    rollups = compute_glucose_rollup(
+        [rec.timestamp for rec in data], [rec.glucose for rec in data]
+    )
+    return rollups.assign(
+        bucket_start=pd.to_datetime(rollups["bucket_start"], unit="s", utc=True)
+    )
+
+
+def mock_reading_queries(mock_database_manager, frame):
+    """Answer the reading queries of the database manager from the frame"""
+    timestamps = pd.to_datetime(frame["timestamp"], utc=True)
+    mock_database_manager.get_columns_between_timestamp.side_effect = (
+        lambda table, columns, start, end: frame[
+            (timestamps >= start) & (timestamps <= end)
+        ]
+    )
+    mock_database_manager.get_columns_before_timestamp.side_effect = (
+        lambda table, columns, timestamp: frame[timestamps < timestamp].tail(1)
+    )
+    mock_database_manager.get_columns_from_timestamp.side_effect = (
+        lambda table, columns, timestamp: frame[timestamps >= timestamp].head(1)
+    )
+
+
+class TestRollupMetrics(unittest.TestCase):
+    def test_libre_extremes_in_rollup_buckets(self):
+        start = dt(2024, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+        # Not a long enough time window
+        data = [
+            Glucose(timestamp=start, glucose=6),
+            Glucose(timestamp=start + timedelta(hours=11), glucose=6),
+        ]
+        self.assertEqual(
+            libre_extremes_in_rollup_buckets(rollup_frame(data)),
+            libre_extremes_in_buckets(data),
+        )
+        self.assertEqual(
+            libre_extremes_in_rollup_buckets(rollup_frame([]))["numberOfHighs"], None
+        )
+
+        # Same as from the readings
+        data = [
+            Glucose(timestamp=start + timedelta(minutes=minutes), glucose=glucose)
+            for minutes, glucose in [
+                (0, 6),
+                (20, 12),
+                (95, 3.5),
+                (12 * 60 + 5, 12),
+                (13 * 60, 7),
+            ]
+        ]
+        self.assertEqual(
+            libre_extremes_in_rollup_buckets(rollup_frame(data)),
+            libre_extremes_in_buckets(data),
+        )
+
+        # A missing rollup has no data
+        rollups = rollup_frame(data).drop(index=10)
+        records = libre_extremes_in_rollup_buckets(rollups)
+        self.assertEqual(records[10]["timeInterval"], "2024-01-01 14:30:00")
+        self.assertEqual(
+            set(records[10]["timeIntervalData"].values()),
+            {None},
+        )
+
+    def test_compute_glucose_rollup(self):
+        start = dt(2024, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+        data = [
+            (start, 6),
+            (start + timedelta(minutes=5), 12),
+            (start + timedelta(minutes=10), 8),
+            # No readings from 12:15 to 12:30
+            (start + timedelta(minutes=35), 3),
+        ]
+        rollups = compute_glucose_rollup(*zip(*data))
+        self.assertEqual(
+            rollups["bucket_start"].tolist(),
+            compute_epoch_array(
+                [start + timedelta(minutes=15 * i) for i in range(3)]
+            ).tolist(),
+        )
+        self.assertEqual(rollups["count"].tolist(), [3, 0, 1])
+        self.assertEqual(rollups["sum"].tolist(), [26, 0, 3])
+        self.assertEqual(rollups["sum_of_squares"].tolist(), [244, 0, 9])
+        self.assertEqual(rollups["min"].tolist()[::2], [6, 3])
+        self.assertEqual(rollups["max"].tolist()[::2], [12, 3])
+        self.assertTrue(np.isnan(rollups["min"][1]))
+        self.assertEqual(
+            [sketch["counts"] for sketch in rollups["sketch"]], [[1, 1, 1], [], [1]]
+        )
+        # The bucket without readings is interpolated
+        self.assertEqual(rollups["number_of_lows"].tolist(), [0, 1, 1])
+        # High from 12:03:20 to 12:07:30
+        self.assertEqual(rollups["percentage_high"][0], 27.78)
+        self.assertEqual(rollups["percentage_in_range"][0], 72.22)
+
+        self.assertTrue(compute_glucose_rollup([], []).empty)
+
+    def test_libre_hba1c_from_daily_means(self):
+        start = dt(2000, 1, 1, 22, 0, 0, tzinfo=timezone.utc)
+        data = [
+            Glucose(glucose=glucose, timestamp=start + timedelta(minutes=minutes))
+            for minutes, glucose in [(0, 6), (50, 8), (120, 12), (125, 2), (1800, 4)]
+        ]
+        daily_means = DailyMeanManager(None)
+        rows = [
+            daily_means._to_row(
+                pd.Timestamp(day, tz="UTC"),
+                accumulate_time_weighted_mean(
+                    pd.DataFrame(
+                        {
+                            "timestamp": [rec.timestamp for rec in day_data],
+                            "glucose": [rec.glucose for rec in day_data],
+                        }
+                    )
+                ),
+            )
+            for day, day_data in (
+                ("2000-01-01", data[:2]),
+                ("2000-01-02", data[2:4]),
+                ("2000-01-03", data[4:]),
+            )
+        ]
+        frame = pd.DataFrame(rows, columns=daily_means.columns)
+        self.assertAlmostEqual(
+            libre_hba1c_from_daily_means(frame)["hBA1C"], libre_hba1c(data)["hBA1C"]
+        )
+        # Too short a time range
+        self.assertEqual(libre_hba1c_from_daily_means(frame[:1]), {"hBA1C": None})
+        self.assertEqual(libre_hba1c_from_daily_means(frame[:0]), {"hBA1C": None})
+
+    def test_glucose_quartile_rollup_data(self):
+        start = dt(2000, 1, 1, 12, 1, 0, tzinfo=timezone.utc)
+        data = [
+            Glucose(
+                timestamp=start + timedelta(days=day, minutes=minutes), glucose=glucose
+            )
+            for day, minutes, glucose in [
+                (0, 0, 6),
+                (0, 9, 7.2),
+                (0, 13, 8.1),
+                (0, 19, 8),
+                (0, 34, 6),
+                (0, 43, 5.5),
+                (1, 0, 12),
+                (1, 9, 14.3),
+                (1, 13, 15),
+                (1, 34, 5),
+                (1, 39, 3),
+                (2, 35, 4),
+            ]
+        ]
+        self.assertEqual(
+            glucose_quartile_rollup_data(rollup_frame(data)),
+            glucose_quartile_data(data),
+        )
+        self.assertEqual(
+            glucose_quartile_rollup_data(rollup_frame([])),
+            glucose_quartile_data([]),
+        )
+
+    def test_aggregate_glucose_rollup_data(self):
+        start = dt(2000, 1, 1, 13, 1, 0, tzinfo=timezone.utc)
+        data = [
+            Glucose(timestamp=start + timedelta(days=day, minutes=minutes), glucose=g)
+            for day, minutes, g in [(0, 0, 5), (0, 5, 5.5), (0, 16, 5.2), (1, 2, 6.1)]
+        ]
+        expected = aggregate_glucose_data(data)
+        result = aggregate_glucose_rollup_data(rollup_frame(data))
+        self.assertEqual(result["intervals"], expected["intervals"])
+        self.assertEqual(result["raw"], [[] for _ in expected["raw"]])
+        for key in expected.keys() - {"intervals", "raw"}:
+            np.testing.assert_allclose(result[key], expected[key], err_msg=key)
+        self.assertDictEqual(
+            aggregate_glucose_rollup_data(rollup_frame([])), aggregate_glucose_data([])
+        )
+        with self.assertRaises(ValueError):
+            aggregate_glucose_rollup_data(rollup_frame(data), bucket="10min")
+
+
+class TestRollupManager(unittest.TestCase):
+    @patch("src.database_manager.DatabaseManager")
+    def test_on_rows_saved(self, mock_database_manager):
+        rollup = RollupManager(mock_database_manager)
+        # Other tables and missing times are ignored
+        self.assertEqual(rollup.on_rows_saved(Strava, 1, 2, dt.now(), dt.now()), 0)
+        self.assertEqual(rollup.on_rows_saved(Glucose, 1, 2), 0)
+        mock_database_manager.upsert.assert_not_called()
+
+        with patch.object(rollup, "update_rollups", return_value=3) as mock_update:
+            self.assertEqual(
+                rollup.on_rows_saved(
+                    Glucose, 1, 2, dt(2024, 1, 1, 12), dt(2024, 1, 1, 13)
+                ),
+                3,
+            )
+        mock_update.assert_called_once_with(dt(2024, 1, 1, 12), dt(2024, 1, 1, 13))
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_update_rollups(self, mock_database_manager):
+        start = dt(2024, 1, 1, 9, tzinfo=timezone.utc)
+        # 6 hours of readings every 5 minutes, with a 3 hour gap from 10:00 to 13:00
+        frame = readings(start, 72)
+        frame = frame[
+            (frame["timestamp"] <= start + timedelta(hours=1))
+            | (frame["timestamp"] >= start + timedelta(hours=4))
+        ].reset_index(drop=True)
+        mock_reading_queries(mock_database_manager, frame)
+        mock_database_manager.upsert.side_effect = lambda table, columns, rows: len(
+            rows
+        )
+        rollup = RollupManager(mock_database_manager)
+        self.assertEqual(
+            rollup.update_rollups(
+                dt(2024, 1, 1, 13, 7, tzinfo=timezone.utc),
+                dt(2024, 1, 1, 13, 20, tzinfo=timezone.utc),
+            ),
+            # From the reading before the gap at 10:00 to the one after at 13:30
+            15,
+        )
+        # The readings of the buckets and the ones either side of them
+        mock_database_manager.get_columns_between_timestamp.assert_called_once_with(
+            Glucose,
+            ("timestamp", "glucose"),
+            dt(2024, 1, 1, 10, tzinfo=timezone.utc),
+            dt(2024, 1, 1, 13, 45, tzinfo=timezone.utc),
+        )
+        table, columns, rows = mock_database_manager.upsert.call_args[0]
+        self.assertEqual((table, columns), (GlucoseRollup, rollup.columns))
+        first = dict(zip(columns, rows[0]))
+        self.assertEqual(first["bucket_start"], dt(2024, 1, 1, 10, tzinfo=timezone.utc))
+        self.assertEqual(first["count"], 1)
+        self.assertEqual(first["first_time"], dt(2024, 1, 1, 10, tzinfo=timezone.utc))
+        self.assertEqual(first["percentage_in_range"], 100.0)
+        self.assertEqual(first["sketch"]["counts"], [1])
+        # The buckets of the gap are interpolated across it
+        gap = dict(zip(columns, rows[1]))
+        self.assertEqual(gap["count"], 0)
+        self.assertIsNone(gap["first_time"])
+        self.assertEqual(gap["percentage_in_range"], 100.0)
+        self.assertEqual(rows[-1][0], dt(2024, 1, 1, 13, 30, tzinfo=timezone.utc))
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_update_rollups_no_readings(self, mock_database_manager):
+        mock_reading_queries(
+            mock_database_manager, pd.DataFrame(columns=["timestamp", "glucose"])
+        )
+        mock_database_manager.upsert.return_value = 0
+        rollup = RollupManager(mock_database_manager)
+        self.assertEqual(rollup.update_rollups(dt(2024, 1, 1), dt(2024, 1, 2)), 0)
+        mock_database_manager.upsert.assert_called_once_with(
+            GlucoseRollup, rollup.columns, []
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_rebuild(self, mock_database_manager):
+        rollup = RollupManager(mock_database_manager)
+        mock_database_manager.get_checkpoint.return_value = 0
+        mock_database_manager.get_earliest_timestamp.return_value = None
+        mock_database_manager.get_latest_timestamp.return_value = None
+        self.assertEqual(rollup.rebuild(), 0)
+
+        mock_database_manager.get_earliest_timestamp.return_value = dt(2024, 1, 1)
+        mock_database_manager.get_latest_timestamp.return_value = dt(2024, 3, 1)
+        with patch.object(rollup, "update_rollups", return_value=2) as mock_update:
+            self.assertEqual(rollup.rebuild(), 6)
+        self.assertEqual(
+            [c[0] for c in mock_update.call_args_list],
+            [
+                (
+                    pd.Timestamp("2024-01-01", tz="UTC"),
+                    pd.Timestamp("2024-01-31", tz="UTC"),
+                ),
+                (
+                    pd.Timestamp("2024-01-31", tz="UTC"),
+                    pd.Timestamp("2024-03-01", tz="UTC"),
+                ),
+                (
+                    pd.Timestamp("2024-03-01", tz="UTC"),
+                    pd.Timestamp("2024-03-01", tz="UTC"),
+                ),
+            ],
+        )
+        # Checkpointed after each chunk
+        mock_database_manager.get_checkpoint.assert_called_with(
+            "glucose_rollup_15min_rebuild"
+        )
+        self.assertEqual(
+            [c[0] for c in mock_database_manager.save_checkpoint.call_args_list],
+            [
+                (
+                    "glucose_rollup_15min_rebuild",
+                    int(dt(2024, 1, 31, tzinfo=timezone.utc).timestamp()),
+                ),
+                (
+                    "glucose_rollup_15min_rebuild",
+                    int(dt(2024, 3, 1, tzinfo=timezone.utc).timestamp()),
+                ),
+                (
+                    "glucose_rollup_15min_rebuild",
+                    int(dt(2024, 3, 1, tzinfo=timezone.utc).timestamp()),
+                ),
+            ],
+        )
+
+        # Resumed from the checkpoint
+        mock_database_manager.get_checkpoint.return_value = int(
+            dt(2024, 2, 20, tzinfo=timezone.utc).timestamp()
+        )
+        with patch.object(rollup, "update_rollups", return_value=2) as mock_update:
+            self.assertEqual(rollup.rebuild(), 2)
+        mock_update.assert_called_once_with(
+            pd.Timestamp("2024-02-20", tz="UTC"), pd.Timestamp("2024-03-01", tz="UTC")
+        )
+
+        # A range of readings is not checkpointed
+        mock_database_manager.reset_mock()
+        with patch.object(rollup, "update_rollups", return_value=2) as mock_update:
+            self.assertEqual(rollup.rebuild(dt(2024, 1, 1), dt(2024, 1, 2)), 2)
+        mock_database_manager.get_checkpoint.assert_not_called()
+        mock_database_manager.save_checkpoint.assert_not_called()
+
+
+class TestRollupReadings(unittest.TestCase):
+    """The metrics of the rollups are those of the readings of the window"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        engine = create_engine(f"sqlite:///{os.path.join(self.directory, 'test.db')}")
+        TableBase.metadata.create_all(engine)
+        self.db_manager = DatabaseManager(engine)
+        self.rollup = RollupManager(self.db_manager)
+        # Three days of readings every 4 minutes and 17 seconds, with a 3 hour gap
+        start = dt(2024, 8, 17, 0, 2, 11, tzinfo=timezone.utc)
+        timestamps = [start + timedelta(seconds=257 * i) for i in range(1008)]
+        timestamps = timestamps[:300] + timestamps[342:]
+        glucose = [round(8 + 5 * np.sin(i / 20), 1) for i in range(len(timestamps))]
+        rows = list(zip(range(1, len(timestamps) + 1), timestamps, glucose))
+        # Saved out of order, the rollups updated as they are
+        for batch in (rows[500:], rows[:200], rows[200:500]):
+            self.db_manager.bulk_insert(Glucose, ("id", "timestamp", "glucose"), batch)
+            self.rollup.on_rows_saved(Glucose, 1, 1, batch[0][1], batch[-1][1])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def test_rollups_match_readings(self):
+        for start, end in (
+            # Aligned to the buckets
+            (dt(2024, 8, 18), dt(2024, 8, 20)),
+            # Unaligned, across the gap
+            (dt(2024, 8, 17, 3, 7, 11), dt(2024, 8, 19, 17, 52, 40)),
+        ):
+            start, end = start.replace(tzinfo=timezone.utc), end.replace(
+                tzinfo=timezone.utc
+            )
+            with self.subTest(start=start, end=end):
+                readings = self.db_manager.get_columns_between_timestamp(
+                    Glucose, ("timestamp", "glucose"), start, end
+                )
+                rollups = self.rollup.get_columns_between_timestamp(
+                    start, end, self.rollup.columns
+                )
+                expected = glucose_quartile_data(readings)
+                quartiles = glucose_quartile_rollup_data(rollups)
+                self.assertEqual(quartiles["intervals"], expected["intervals"])
+                self.assertEqual(quartiles["count"], expected["count"])
+                for key in expected.keys() - {"intervals", "count"}:
+                    np.testing.assert_allclose(quartiles[key], expected[key])
+                self.assertEqual(
+                    libre_extremes_in_rollup_buckets(rollups),
+                    libre_extremes_in_buckets(readings),
+                )
+
+
+class TestDailyMeanManager(unittest.TestCase):
+    @patch("src.database_manager.DatabaseManager")
+    def test_update_rollups(self, mock_database_manager):
+        start = dt(2024, 1, 1, 22, tzinfo=timezone.utc)
+        # 4 hours of readings every 5 minutes, streamed in chunks across midnight
+        records = readings(start, 48).to_dict("records")
+        mock_database_manager.stream_records_between_timestamp.return_value = iter(
+            [records[:30], records[30:]]
+        )
+        mock_database_manager.upsert.side_effect = lambda table, columns, rows: len(
+            rows
+        )
+        daily_means = DailyMeanManager(mock_database_manager)
+        self.assertEqual(
+            daily_means.update_rollups(
+                dt(2024, 1, 1, 23, tzinfo=timezone.utc),
+                dt(2024, 1, 2, 1, tzinfo=timezone.utc),
+            ),
+            2,
+        )
+        mock_database_manager.stream_records_between_timestamp.assert_called_once_with(
+            Glucose,
+            dt(2024, 1, 1, tzinfo=timezone.utc),
+            dt(2024, 1, 3, tzinfo=timezone.utc),
+            10_000,
+        )
+        table, columns, rows = mock_database_manager.upsert.call_args[0]
+        self.assertEqual((table, columns), (GlucoseDailyMean, daily_means.columns))
+        first, second = (dict(zip(columns, row)) for row in rows)
+        self.assertEqual(first["day"], dt(2024, 1, 1, tzinfo=timezone.utc))
+        self.assertEqual(first["count"], 24)
+        self.assertEqual(first["seconds"], 23 * 5 * 60)
+        self.assertEqual(first["first_time"], start)
+        self.assertEqual(
+            first["last_time"], dt(2024, 1, 1, 23, 55, tzinfo=timezone.utc)
+        )
+        self.assertEqual(second["day"], dt(2024, 1, 2, tzinfo=timezone.utc))
+        self.assertEqual(second["count"], 24)
+        self.assertEqual(second["first_glucose"], 5.0 + 24 % 3)
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_rebuild(self, mock_database_manager):
+        daily_means = DailyMeanManager(mock_database_manager)
+        mock_database_manager.get_checkpoint.return_value = int(
+            dt(2024, 1, 3, tzinfo=timezone.utc).timestamp()
+        )
+        mock_database_manager.get_latest_timestamp.return_value = dt(2024, 1, 5)
+        with patch.object(daily_means, "update_rollups", return_value=3) as mock_update:
+            self.assertEqual(daily_means.rebuild(), 3)
+        # Resumed from its own checkpoint
+        mock_database_manager.get_checkpoint.assert_called_once_with(
+            "glucose_daily_mean_rebuild"
+        )
+        mock_update.assert_called_once_with(
+            pd.Timestamp("2024-01-03", tz="UTC"), pd.Timestamp("2024-01-05", tz="UTC")
+        )
+        mock_database_manager.save_checkpoint.assert_called_once_with(
+            "glucose_daily_mean_rebuild",
+            int(dt(2024, 1, 5, tzinfo=timezone.utc).timestamp()),
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_get_columns_between_timestamp(self, mock_database_manager):
+        start = dt(2024, 1, 1, 22, tzinfo=timezone.utc)
+        day = (
+            dt(2024, 1, 2, tzinfo=timezone.utc),
+            100.0,
+            20.0,
+            3,
+            dt(2024, 1, 2, 1, tzinfo=timezone.utc),
+            6.0,
+            dt(2024, 1, 2, 23, tzinfo=timezone.utc),
+            7.0,
+        )
+        daily_means = DailyMeanManager(mock_database_manager)
+        mock_database_manager.get_columns_between_timestamp.side_effect = [
+            # The readings before the saved days, including the one at midnight
+            readings(start, 25),
+            pd.DataFrame([day], columns=daily_means.columns),
+            readings(dt(2024, 1, 3, 12, tzinfo=timezone.utc), 0),
+        ]
+        partials = daily_means.get_columns_between_timestamp(
+            "2024-01-01 22:00:00", "2024-01-03 12:00:00", daily_means.columns
+        )
+        self.assertEqual(
+            partials["day"].tolist(),
+            [dt(2024, 1, 1, tzinfo=timezone.utc), dt(2024, 1, 2, tzinfo=timezone.utc)],
+        )
+        self.assertEqual(partials["count"].tolist(), [24, 3])
+        self.assertEqual(
+            [
+                c[0][2:]
+                for c in mock_database_manager.get_columns_between_timestamp.call_args_list
+            ],
+            [
+                (start, dt(2024, 1, 2, tzinfo=timezone.utc)),
+                (
+                    dt(2024, 1, 2, tzinfo=timezone.utc),
+                    dt(2024, 1, 2, tzinfo=timezone.utc),
+                ),
+                (
+                    dt(2024, 1, 3, tzinfo=timezone.utc),
+                    dt(2024, 1, 3, 12, tzinfo=timezone.utc),
+                ),
+            ],
+        )
+
+        # Windows within a day are only read from the readings
+        mock_database_manager.get_columns_between_timestamp.reset_mock()
+        mock_database_manager.get_columns_between_timestamp.side_effect = [
+            readings(start, 3)
+        ]
+        partials = daily_means.get_columns_between_timestamp(
+            "2024-01-01 22:00:00", "2024-01-01 23:00:00", ("count", "seconds")
+        )
+        self.assertEqual(partials.to_dict("records"), [{"count": 3, "seconds": 600.0}])
+        mock_database_manager.get_columns_between_timestamp.assert_called_once()
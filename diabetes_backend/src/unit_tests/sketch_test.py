@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+
+from src.sketch import HistogramSketch, merge_sketches
+
+PERCENTILES = [0, 0.1, 0.25, 0.5, 0.75, 0.9, 1]
+
+
+class TestSketch(unittest.TestCase):
+    def test_quantiles(self):
+        values = [5.3, 7.1, 4.0, 12.2, 5.3, 6.8, 9.9]
+        sketch = HistogramSketch.from_values(values)
+        self.assertEqual(sketch.count, 7)
+        self.assertEqual(sketch.bins.tolist(), [40, 53, 68, 71, 99, 122])
+        self.assertEqual(sketch.counts.tolist(), [1, 2, 1, 1, 1, 1])
+        # Exact for values at the bin resolution
+        np.testing.assert_allclose(
+            sketch.quantiles(PERCENTILES), np.quantile(values, PERCENTILES)
+        )
+
+    def test_quantiles_within_bin_width(self):
+        values = np.random.default_rng(0).uniform(2, 20, 1000)
+        sketch = HistogramSketch.from_values(values, bin_width=0.5)
+        self.assertLessEqual(
+            np.abs(
+                sketch.quantiles(PERCENTILES) - np.quantile(values, PERCENTILES)
+            ).max(),
+            0.25,
+        )
+
+    def test_quantiles_empty(self):
+        self.assertTrue(np.isnan(HistogramSketch().quantiles([0.5])).all())
+
+    def test_merge(self):
+        values = np.round(np.random.default_rng(1).uniform(2, 20, 500), 1)
+        sketches = [
+            HistogramSketch.from_values(part)
+            for part in (values[:10], values[10:300], values[300:])
+        ]
+        merged = merge_sketches(sketches)
+        self.assertEqual(merged.count, 500)
+        np.testing.assert_allclose(
+            merged.quantiles(PERCENTILES), np.quantile(values, PERCENTILES)
+        )
+        self.assertEqual(sketches[0].merge(*sketches[1:]).to_dict(), merged.to_dict())
+        self.assertEqual(merge_sketches([]).count, 0)
+
+        # Different bin widths merge at the widest
+        coarse = merge_sketches([sketches[0], HistogramSketch.from_values([5.3], 0.5)])
+        self.assertEqual(coarse.bin_width, 0.5)
+        self.assertEqual(coarse.count, 11)
+        np.testing.assert_allclose(
+            coarse.quantiles(PERCENTILES),
+            np.quantile(np.append(values[:10], 5.3), PERCENTILES),
+            atol=0.25,
+        )
+
+    def test_coarsen(self):
+        sketch = HistogramSketch.from_values([5.3, 5.4, 6.0])
+        self.assertEqual(
+            sketch.coarsen(0.5).to_dict(),
+            {"binWidth": 0.5, "bins": [11, 12], "counts": [2, 1]},
+        )
+        self.assertIs(sketch.coarsen(0.1), sketch)
+        with self.assertRaises(ValueError):
+            sketch.coarsen(0.05)
+
+    def test_to_dict(self):
+        sketch = HistogramSketch.from_values([5.3, 5.3, 6.0])
+        self.assertEqual(
+            sketch.to_dict(), {"binWidth": 0.1, "bins": [53, 60], "counts": [2, 1]}
+        )
+        self.assertEqual(
+            HistogramSketch.from_dict(sketch.to_dict()).to_dict(), sketch.to_dict()
+        )
@@ -1,19 +1,27 @@
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 from requests import HTTPError
-from datetime import datetime
+from datetime import datetime, timezone
 from src.unit_tests.base import TestBase
 from src.database.tables import Strava
 from src.utils import compute_epoch
 from src.constants import STRAVA_BASE_URL
-from src.strava import StravaManager
+from src.strava import (
+    BACKFILL_CHECKPOINT,
+    STRAVA_ACTIVITIES_COLUMNS,
+    StravaManager,
+    StravaRateLimiter,
+    StravaRateLimitError,
+)
+from src.events import ROWS_SAVED, EventBus
 
 ERROR_MSG = "My test error"
 
 
 class MockRequest:
-    def __init__(self, response, raise_error=False):
+    def __init__(self, response, raise_error=False, headers=None):
         self.response = response
         self.raise_error = raise_error
+        self.headers = headers or {}
 
     def json(self):
         return self.response
@@ -60,7 +68,7 @@ class TestStrava(TestBase):
             "end_longitude": 7.1,
         }
 
-    @patch("requests.post")
+    @patch("requests.Session.post")
     @patch("src.database_manager.DatabaseManager")
     def test_get_access_token_success(self, mock_database_manager, mock_requests):
         payload = {
@@ -85,11 +93,45 @@ class TestStrava(TestBase):
         # Check the mocks
         mock_requests.assert_called_once()
         mock_requests.assert_called_once_with(
-            f"{STRAVA_BASE_URL}/oauth/token", data=payload, verify=False
+            f"{STRAVA_BASE_URL}/oauth/token", data=payload
         )
         self.assertEqual(mock_database_manager.call_count, 0)
 
-    @patch("requests.post")
+    @patch("time.time")
+    @patch("requests.Session.post")
+    @patch("src.database_manager.DatabaseManager")
+    def test_get_access_token_cached(
+        self, mock_database_manager, mock_requests, mock_time
+    ):
+        mock_requests.side_effect = [
+            MockRequest(
+                {"access_token": "token", "refresh_token": "r1", "expires_at": 10000}
+            ),
+            MockRequest(
+                {"access_token": "token2", "refresh_token": "r2", "expires_at": 20000}
+            ),
+        ]
+        strava_cls = StravaManager(
+            self.client_id,
+            self.client_secret,
+            self.refresh_token,
+            self.code,
+            mock_database_manager,
+        )
+        mock_time.return_value = 1000
+        self.assertEqual(strava_cls.get_access_token(), "token")
+        # Reused until shortly before it expires
+        mock_time.return_value = 9000
+        self.assertEqual(strava_cls.get_access_token(), "token")
+        mock_requests.assert_called_once()
+        mock_time.return_value = 9800
+        self.assertEqual(strava_cls.get_access_token(), "token2")
+        self.assertEqual(mock_requests.call_count, 2)
+        # Refreshed with the rotated refresh token
+        self.assertEqual(mock_requests.call_args.kwargs["data"]["refresh_token"], "r1")
+        self.assertEqual(strava_cls.refresh_token, "r2")
+
+    @patch("requests.Session.post")
     @patch("src.database_manager.DatabaseManager")
     def test_get_access_token_failure(self, mock_database_manager, mock_requests):
         payload = {
@@ -117,12 +159,12 @@ class TestStrava(TestBase):
         # Check the mocks
         mock_requests.assert_called_once()
         mock_requests.assert_called_once_with(
-            f"{STRAVA_BASE_URL}/oauth/token", data=payload, verify=False
+            f"{STRAVA_BASE_URL}/oauth/token", data=payload
         )
         self.assertEqual(mock_database_manager.call_count, 0)
 
-    @patch("requests.get")
-    @patch("requests.post")
+    @patch("requests.Session.get")
+    @patch("requests.Session.post")
     @patch("src.database_manager.DatabaseManager")
     def test_get_activity_data_success(
         self, mock_database_manager, mock_requests_post, mock_requests_get
@@ -149,7 +191,7 @@ class TestStrava(TestBase):
         # Check the mocks
         mock_requests_post.assert_called_once()
         mock_requests_post.assert_called_once_with(
-            f"{STRAVA_BASE_URL}/oauth/token", data=payload, verify=False
+            f"{STRAVA_BASE_URL}/oauth/token", data=payload
         )
         mock_requests_get.assert_called_once()
         mock_requests_get.assert_called_once_with(
@@ -159,8 +201,8 @@ class TestStrava(TestBase):
         )
         self.assertEqual(mock_database_manager.call_count, 0)
 
-    @patch("requests.get")
-    @patch("requests.post")
+    @patch("requests.Session.get")
+    @patch("requests.Session.post")
     @patch("src.database_manager.DatabaseManager")
     def test_get_activity_data_failure(
         self, mock_database_manager, mock_requests_post, mock_requests_get
@@ -191,7 +233,7 @@ class TestStrava(TestBase):
         # Check the mocks
         mock_requests_post.assert_called_once()
         mock_requests_post.assert_called_once_with(
-            f"{STRAVA_BASE_URL}/oauth/token", data=payload, verify=False
+            f"{STRAVA_BASE_URL}/oauth/token", data=payload
         )
         mock_requests_get.assert_called_once()
         mock_requests_get.assert_called_once_with(
@@ -237,8 +279,8 @@ class TestStrava(TestBase):
             ),
         )
 
-    @patch("requests.get")
-    @patch("requests.post")
+    @patch("requests.Session.get")
+    @patch("requests.Session.post")
     @patch("src.database_manager.DatabaseManager")
     def test_update_data_records_found(
         self, mock_database_manager, mock_requests_post, mock_requests_get
@@ -268,7 +310,7 @@ class TestStrava(TestBase):
         # Check the mocks
         mock_requests_post.assert_called_once()
         mock_requests_post.assert_called_once_with(
-            f"{STRAVA_BASE_URL}/oauth/token", data=payload, verify=False
+            f"{STRAVA_BASE_URL}/oauth/token", data=payload
         )
         mock_requests_get.assert_called_once()
         mock_requests_get.assert_called_once_with(
@@ -277,10 +319,48 @@ class TestStrava(TestBase):
             params={"page": 1, "records_per_page": 1, "after": compute_epoch(mock_dt)},
         )
         mock_database_manager.get_last_record.assert_called_once_with(Strava)
-        self.assertEqual(mock_database_manager.save_data.call_count, 1)
+        mock_database_manager.bulk_insert.assert_called_once_with(
+            Strava,
+            STRAVA_ACTIVITIES_COLUMNS,
+            [StravaManager.format_activity_row(self.test_data_1)],
+            ignore_conflicts=True,
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_save_data_publishes_rows_saved(self, mock_database_manager):
+        event_bus = EventBus()
+        handler = Mock()
+        event_bus.subscribe(ROWS_SAVED, handler)
+        strava_cls = StravaManager(
+            self.client_id,
+            self.client_secret,
+            self.refresh_token,
+            self.code,
+            mock_database_manager,
+            event_bus,
+        )
+        rows = [
+            StravaManager.format_activity_row(
+                {**self.test_data_1, "id": "7", "start_date": "2024-07-12T08:00:00Z"}
+            ),
+            StravaManager.format_activity_row(
+                {**self.test_data_1, "id": "5", "start_date": "2024-07-11T08:00:00Z"}
+            ),
+        ]
+        strava_cls._save_data(rows)
+        mock_database_manager.bulk_insert.assert_called_once_with(
+            Strava, STRAVA_ACTIVITIES_COLUMNS, rows, ignore_conflicts=True
+        )
+        handler.assert_called_once_with(
+            table=Strava,
+            first_id="1235",
+            last_id="1237",
+            first_time="2024-07-11T08:00:00Z",
+            last_time="2024-07-12 08:00:08",
+        )
 
-    @patch("requests.get")
-    @patch("requests.post")
+    @patch("requests.Session.get")
+    @patch("requests.Session.post")
     @patch("src.database_manager.DatabaseManager")
     def test_update_data_records_non_found(
         self, mock_database_manager, mock_requests_post, mock_requests_get
@@ -310,7 +390,7 @@ class TestStrava(TestBase):
         # Check the mocks
         mock_requests_post.assert_called_once()
         mock_requests_post.assert_called_once_with(
-            f"{STRAVA_BASE_URL}/oauth/token", data=payload, verify=False
+            f"{STRAVA_BASE_URL}/oauth/token", data=payload
         )
         mock_requests_get.assert_called_once()
         mock_requests_get.assert_called_once_with(
@@ -319,4 +399,161 @@ class TestStrava(TestBase):
             params={"page": 1, "records_per_page": 1, "after": compute_epoch(mock_dt)},
         )
         mock_database_manager.get_last_record.assert_called_once_with(Strava)
-        self.assertEqual(mock_database_manager.save_data.call_count, 0)
+        mock_database_manager.bulk_insert.assert_not_called()
+
+    @patch("requests.Session.get")
+    @patch("requests.Session.post")
+    @patch("src.database_manager.DatabaseManager")
+    def test_get_activity_data_updates_rate_limits(
+        self, mock_database_manager, mock_requests_post, mock_requests_get
+    ):
+        mock_requests_post.return_value = MockRequest({"access_token": "token"})
+        mock_requests_get.return_value = MockRequest(
+            [],
+            headers={"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "7,250"},
+        )
+        strava_cls = StravaManager(
+            self.client_id,
+            self.client_secret,
+            self.refresh_token,
+            self.code,
+            mock_database_manager,
+        )
+        strava_cls.get_activity_data()
+        self.assertEqual(strava_cls.rate_limiter.limits, [100, 1000])
+        self.assertEqual(strava_cls.rate_limiter.usage, [7, 250])
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_backfill(self, mock_database_manager):
+        mock_database_manager.get_checkpoint.return_value = 2
+        mock_database_manager.bulk_insert.side_effect = (
+            lambda table, cols, rows, **_: len(rows)
+        )
+        pages = {
+            3: [self.test_data_1, {**self.test_data_1, "id": "2"}],
+            4: [{**self.test_data_1, "id": "3"}],
+            5: [{**self.test_data_1, "id": "4"}],
+        }
+        event_bus = EventBus()
+        handler = Mock()
+        event_bus.subscribe(ROWS_SAVED, handler)
+        strava_cls = StravaManager(
+            self.client_id,
+            self.client_secret,
+            self.refresh_token,
+            self.code,
+            mock_database_manager,
+            event_bus,
+        )
+        with patch.object(strava_cls, "get_access_token"), patch.object(
+            strava_cls,
+            "get_activity_data",
+            side_effect=lambda page, per_page: pages.get(page, []),
+        ) as mock_get_activity_data:
+            self.assertEqual(
+                strava_cls.update_data(records_per_page=50, backfill=True), 4
+            )
+        # Resumed after the checkpoint until the first empty page
+        mock_database_manager.get_checkpoint.assert_called_once_with(
+            BACKFILL_CHECKPOINT
+        )
+        mock_get_activity_data.assert_any_call(page=3, per_page=50)
+        mock_get_activity_data.assert_any_call(page=6, per_page=50)
+        # Each page bulk inserted and checkpointed in order
+        self.assertEqual(mock_database_manager.bulk_insert.call_count, 3)
+        table, columns, rows = mock_database_manager.bulk_insert.call_args_list[0][0]
+        self.assertEqual(table, Strava)
+        self.assertEqual(columns[0], "id")
+        self.assertEqual([row[0] for row in rows], ["1231", "1232"])
+        self.assertEqual(
+            mock_database_manager.bulk_insert.call_args_list[0][1],
+            {"ignore_conflicts": True},
+        )
+        self.assertEqual(
+            [c[0] for c in mock_database_manager.save_checkpoint.call_args_list],
+            [
+                (BACKFILL_CHECKPOINT, 3),
+                (BACKFILL_CHECKPOINT, 4),
+                (BACKFILL_CHECKPOINT, 5),
+            ],
+        )
+        activity = StravaManager.format_activity_data(self.test_data_1)
+        handler.assert_any_call(
+            table=Strava,
+            first_id="1231",
+            last_id="1232",
+            first_time=activity.start_time,
+            last_time=activity.end_time,
+        )
+
+    @patch("src.database_manager.DatabaseManager")
+    def test_backfill_interrupted(self, mock_database_manager):
+        mock_database_manager.get_checkpoint.return_value = 0
+        strava_cls = StravaManager(
+            self.client_id,
+            self.client_secret,
+            self.refresh_token,
+            self.code,
+            mock_database_manager,
+        )
+
+        def get_activity_data(page, per_page):
+            if page == 2:
+                raise StravaRateLimitError("limit", datetime(2024, 1, 2))
+            return [{**self.test_data_1, "id": str(page)}]
+
+        with patch.object(strava_cls, "get_access_token"), patch.object(
+            strava_cls, "get_activity_data", side_effect=get_activity_data
+        ):
+            with self.assertRaises(StravaRateLimitError):
+                strava_cls.backfill(max_workers=3)
+        # Only the pages before the failed one are checkpointed
+        mock_database_manager.save_checkpoint.assert_called_once_with(
+            BACKFILL_CHECKPOINT, 1
+        )
+
+    def test_rate_limiter(self):
+        now = [900 * 10 + 300]
+        # The time moves on while waiting
+        sleep = Mock(side_effect=lambda seconds: now.__setitem__(0, now[0] + seconds))
+        rate_limiter = StravaRateLimiter(sleep=sleep, clock=lambda: now[0])
+        # Unknown limits
+        rate_limiter.acquire()
+        sleep.assert_not_called()
+        # Missing headers are ignored
+        rate_limiter.update({})
+        self.assertIsNone(rate_limiter.limits)
+
+        rate_limiter.update(
+            {"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "98,500"}
+        )
+        rate_limiter.acquire()
+        rate_limiter.acquire()
+        sleep.assert_not_called()
+        self.assertEqual(rate_limiter.usage, [100, 502])
+        # Waits for the next 15 minute window, without holding the lock
+        sleep.side_effect = lambda seconds: (
+            self.assertFalse(rate_limiter._lock.locked()),
+            now.__setitem__(0, now[0] + seconds),
+        )
+        rate_limiter.acquire()
+        sleep.assert_called_once_with(600)
+        self.assertEqual(rate_limiter.usage, [1, 503])
+        # The short usage resets with the window
+        rate_limiter.update(
+            {"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "100,600"}
+        )
+        now[0] += 900
+        rate_limiter.acquire()
+        sleep.assert_called_once()
+        self.assertEqual(rate_limiter.usage, [1, 601])
+
+        # Daily limit, until the next UTC midnight
+        rate_limiter.update(
+            {"X-RateLimit-Limit": "100,1000", "X-RateLimit-Usage": "10,1000"}
+        )
+        with self.assertRaises(StravaRateLimitError) as context:
+            rate_limiter.acquire()
+        self.assertEqual(
+            context.exception.reset_time, datetime(1970, 1, 2, tzinfo=timezone.utc)
+        )
@@ -0,0 +1,77 @@
+import json
+import unittest
+from unittest.mock import patch
+from datetime import datetime as dt
+
+import flask
+from marshmallow import Schema, fields
+from werkzeug import exceptions
+from src.views.stream import StreamRecords, generate_json_array
+
+
+class TestSchema(Schema):
+    start = fields.Str(required=False)
+    end = fields.Str(required=True)
+
+
+class TestStreamRecords(unittest.TestCase):
+    def setUp(self):
+        self.flask_app = flask.Flask("test_flask_app")
+
+    def test_generate_json_array(self):
+        with self.flask_app.app_context():
+            for chunks, expected in (
+                ([], []),
+                ([[]], []),
+                ([[{"id": 1}]], [{"id": 1}]),
+                (
+                    [[{"id": 1}, {"id": 2}], [], [{"id": 3}]],
+                    [{"id": 1}, {"id": 2}, {"id": 3}],
+                ),
+            ):
+                with self.subTest(chunks=chunks):
+                    res = "".join(generate_json_array(iter(chunks)))
+                    self.assertEqual(json.loads(res), expected)
+
+    @patch("src.glucose.GlucoseManager")
+    def test_get(self, mock_glucose):
+        mock_glucose.stream_records_between_timestamp.return_value = iter(
+            [
+                [{"id": 1, "glucose": 5.5, "timestamp": dt(2000, 1, 1, 12)}],
+                [{"id": 2, "glucose": 6.0, "timestamp": dt(2000, 1, 1, 12, 5)}],
+            ]
+        )
+        self.flask_app.add_url_rule(
+            "/glucose/",
+            view_func=StreamRecords.as_view(
+                "glucose", TestSchema(), mock_glucose, chunk_size=10
+            ),
+        )
+        client = self.flask_app.test_client()
+        response = client.get(
+            "/glucose/", query_string={"start": "2000-01-01", "end": "2001-01-01"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(
+            response.get_json(),
+            [
+                {"id": 1, "glucose": 5.5, "timestamp": "Sat, 01 Jan 2000 12:00:00 GMT"},
+                {"id": 2, "glucose": 6.0, "timestamp": "Sat, 01 Jan 2000 12:05:00 GMT"},
+            ],
+        )
+        mock_glucose.stream_records_between_timestamp.assert_called_once_with(
+            "2000-01-01", "2001-01-01", chunk_size=10
+        )
+
+    @patch("src.glucose.GlucoseManager")
+    def test_get_fail_schema(self, mock_glucose):
+        with self.flask_app.test_request_context() as mock_context:
+            mock_context.request.args = {"start": "2000-01-01"}
+            with self.assertRaises(exceptions.BadRequest) as e:
+                StreamRecords(TestSchema(), mock_glucose).get()
+            self.assertEqual(
+                str(e.exception),
+                "400 Bad Request: {'end': ['Missing data for required field.']}",
+            )
+        mock_glucose.stream_records_between_timestamp.assert_not_called()
@@ -2,29 +2,48 @@ import os
 import unittest
 from unittest.mock import patch
 from datetime import datetime as dt
-from datetime import timezone
+from datetime import timedelta, timezone
 
+import numpy as np
+import pandas as pd
+
+from src.benchmark import (
+    generate_activities,
+    generate_readings,
+    libre_hba1c_pandas,
+    run_sum_strava_data_pandas,
+)
 from src.database.tables import Glucose, GlucoseExercise, Strava
 from src.constants import DATABASE_DATETIME, DATETIME_FORMAT, STRAVA_DATETIME
 from src.utils import (
     aggregate_glucose_data,
     aggregate_strava_data,
+    assign_to_intervals,
+    compute_bucket_offsets,
+    compute_epoch_array,
+    compute_grouped_quantiles,
     compute_percentages,
+    compute_percentages_in_buckets,
+    compute_seconds_of_day,
     compute_x_time_value,
     compute_y_value_with_x_time,
     convert_str_to_ts,
     convert_ts_to_str,
+    format_time_of_day_buckets,
     get_seconds_from_pandas_interval,
     glucose_quartile_data,
     glucose_raw_data,
     group_glucose_data_by_day,
+    libre_extremes_in_buckets,
     libre_hba1c,
     load_libre_credentials_from_env,
     load_strava_credentials_from_env,
+    merge_intervals,
     populate_glucose_data,
     run_sum_strava_data,
     strava_glucose_raw_data,
     strava_raw_data,
+    to_utc_timestamp,
 )
 
 
@@ -131,6 +150,9 @@ class TestUtils(unittest.TestCase):
         self.assertDictEqual(
             aggregate_glucose_data(self.test_glucose_data), expected_data
         )
+        self.assertDictEqual(
+            aggregate_glucose_data([]), {key: [] for key in expected_data}
+        )
 
     def test_aggregate_strava_data(self):
         strava_data = [
@@ -350,6 +372,230 @@ class TestUtils(unittest.TestCase):
             },
         )
 
+    def test_compute_epoch_array(self):
+        # Aware timestamps are converted to UTC
+        self.assertEqual(
+            compute_epoch_array(
+                [
+                    dt(1970, 1, 1, 0, 1, 0, tzinfo=timezone.utc),
+                    dt(2024, 1, 1, 12, 0, 0, tzinfo=timezone(timedelta(hours=1))),
+                ]
+            ).tolist(),
+            [60, 1704106800],
+        )
+        # Naive timestamps are taken as UTC
+        self.assertEqual(
+            compute_epoch_array([dt(2024, 1, 1, 11, 0, 0)]).tolist(), [1704106800]
+        )
+        self.assertEqual(compute_epoch_array([]).tolist(), [])
+
+    def test_compute_seconds_of_day(self):
+        # Aware timestamps keep their wall clock time
+        self.assertEqual(
+            compute_seconds_of_day(
+                [
+                    dt(2024, 1, 1, 0, 1, 30, tzinfo=timezone(timedelta(hours=2))),
+                    dt(2024, 1, 2, 0, 1, 30, tzinfo=timezone(timedelta(hours=2))),
+                ]
+            ).tolist(),
+            [90, 90],
+        )
+        self.assertEqual(
+            compute_seconds_of_day(
+                [dt(2020, 5, 2, 23, 59, 59), dt(2024, 1, 1, 12, 0, 0, 500)]
+            ).tolist(),
+            [86399, 43200],
+        )
+        # Mixed offsets, either side of daylight saving
+        self.assertEqual(
+            compute_seconds_of_day(
+                [
+                    dt(2024, 3, 30, 23, 0, 0, tzinfo=timezone(timedelta(hours=0))),
+                    dt(2024, 4, 1, 23, 0, 0, tzinfo=timezone(timedelta(hours=1))),
+                ]
+            ).tolist(),
+            [82800, 82800],
+        )
+        self.assertEqual(compute_seconds_of_day([]).tolist(), [])
+
+    def test_format_time_of_day_buckets(self):
+        self.assertEqual(
+            format_time_of_day_buckets([0, 1, 95]), ["00:00", "00:15", "23:45"]
+        )
+        self.assertEqual(format_time_of_day_buckets([7], "60min"), ["07:00"])
+
+    def test_compute_grouped_quantiles(self):
+        values = [5.2, 8, 3.1, 7, 9.5, 4.4, 6, 12.3, 2.2]
+        group_index = [0, 2, 0, 2, 2, 0, 2, 3, 0]
+        result = compute_grouped_quantiles(group_index, values, 4)
+        self.assertEqual(list(result), ["median", "q10", "q25", "q75", "q90"])
+        self.assertEqual(result["median"][0], 3.75)
+        self.assertEqual(result["median"][2], 7.5)
+        self.assertEqual(result["median"][3], 12.3)
+        # Matches pandas for every group, empty groups are NaN
+        for name, q in [("median", 0.5), ("q10", 0.1), ("q25", 0.25), ("q90", 0.9)]:
+            expected = pd.Series(values).groupby(group_index).quantile(q)
+            self.assertTrue(np.isnan(result[name][1]))
+            for group in [0, 2, 3]:
+                self.assertAlmostEqual(result[name][group], expected[group])
+
+    def test_merge_intervals(self):
+        self.assertEqual(merge_intervals([]), [])
+        self.assertEqual(
+            merge_intervals([(5, 8), (1, 3), (2, 4), (8, 9), (10, 11)]),
+            [(1, 4), (5, 9), (10, 11)],
+        )
+        # Contained intervals
+        self.assertEqual(merge_intervals([(1, 10), (2, 3)]), [(1, 10)])
+
+    def test_assign_to_intervals(self):
+        timestamps = [dt(2024, 1, 1, hour) for hour in range(6)]
+        interval_index, timestamp_index = assign_to_intervals(
+            timestamps,
+            [
+                dt(2024, 1, 1, 1),
+                dt(2024, 1, 1, 2, 30),
+                dt(2024, 1, 1, 0),
+                dt(2024, 2, 1),
+            ],
+            [
+                dt(2024, 1, 1, 3),
+                dt(2024, 1, 1, 2, 45),
+                dt(2024, 1, 1, 1),
+                dt(2024, 2, 2),
+            ],
+        )
+        # Bounds are inclusive, overlapping intervals each get the timestamps
+        self.assertEqual(interval_index.tolist(), [0, 0, 0, 2, 2])
+        self.assertEqual(timestamp_index.tolist(), [1, 2, 3, 0, 1])
+
+        interval_index, timestamp_index = assign_to_intervals([], [], [])
+        self.assertEqual(interval_index.tolist(), [])
+        self.assertEqual(timestamp_index.tolist(), [])
+
+    def test_compute_percentages_in_buckets(self):
+        with self.assertRaises(ValueError) as ex:
+            compute_percentages_in_buckets([], [], [0], high=4, low=4)
+        self.assertEqual(
+            str(ex.exception), "Cannot specify the high value 4 <= low value 4"
+        )
+
+        data = [
+            (dt(2024, 1, 1, 12, 0, 0).astimezone(timezone.utc), 5),
+            (dt(2024, 1, 1, 12, 4, 0).astimezone(timezone.utc), 5),
+            (dt(2024, 1, 1, 12, 6, 0).astimezone(timezone.utc), 11),
+            (dt(2024, 1, 1, 12, 9, 0).astimezone(timezone.utc), 12),
+            (dt(2024, 1, 1, 12, 10, 0).astimezone(timezone.utc), 7),
+            (dt(2024, 1, 1, 12, 14, 0).astimezone(timezone.utc), 3),
+            (dt(2024, 1, 1, 12, 16, 0).astimezone(timezone.utc), 3),
+            (dt(2024, 1, 1, 12, 18, 0).astimezone(timezone.utc), 11),
+            (dt(2024, 1, 1, 12, 20, 0).astimezone(timezone.utc), 3),
+            (dt(2024, 1, 1, 12, 40, 0).astimezone(timezone.utc), 2),
+        ]
+        timestamps, glucose = zip(*data)
+        # Buckets of 3, 0, 5, 1 and 1 readings
+        offsets = [0, 3, 3, 8, 9]
+        buckets = [data[0:3], [], data[3:8], data[8:9], data[9:10]]
+        self.assertEqual(
+            compute_percentages_in_buckets(
+                compute_epoch_array(timestamps),
+                glucose,
+                offsets,
+                interval_length_seconds=10 * 60,
+            ),
+            [
+                compute_percentages(bucket, interval_length_seconds=10 * 60)
+                for bucket in buckets
+            ],
+        )
+
+    def test_compute_bucket_offsets(self):
+        # Buckets are aligned to the start of the first day
+        epoch_seconds = compute_epoch_array(
+            [
+                dt(2024, 1, 1, 12, 5, 0),
+                dt(2024, 1, 1, 12, 10, 0),
+                dt(2024, 1, 1, 12, 50, 0),
+                dt(2024, 1, 1, 13, 0, 0),
+            ]
+        )
+        bucket_starts, bucket_offsets = compute_bucket_offsets(epoch_seconds, 15 * 60)
+        self.assertEqual(
+            bucket_starts.tolist(),
+            compute_epoch_array(
+                [
+                    dt(2024, 1, 1, 12, 0, 0),
+                    dt(2024, 1, 1, 12, 15, 0),
+                    dt(2024, 1, 1, 12, 30, 0),
+                    dt(2024, 1, 1, 12, 45, 0),
+                    dt(2024, 1, 1, 13, 0, 0),
+                ]
+            ).tolist(),
+        )
+        self.assertEqual(bucket_offsets.tolist(), [0, 2, 2, 2, 3])
+
+    def test_libre_extremes_in_buckets(self):
+        start = dt(2024, 1, 1, 12, 0, 0).astimezone(timezone.utc)
+        # Not a long enough time window
+        data = [
+            Glucose(timestamp=start, glucose=6),
+            Glucose(timestamp=start + timedelta(hours=11), glucose=6),
+        ]
+        self.assertEqual(
+            libre_extremes_in_buckets(data),
+            {
+                "percentageOfTimeInTarget": None,
+                "percentageOfTimeLow": None,
+                "percentageOfTimeHigh": None,
+                "numberOfHighs": None,
+                "numberOfLows": None,
+            },
+        )
+
+        # Rises from 6 to 12 over the first 20 minutes then stays high,
+        # crossing into high at 12:13:20
+        data = [
+            Glucose(timestamp=start + timedelta(minutes=minutes), glucose=glucose)
+            for minutes, glucose in [(0, 6), (20, 12), (12 * 60 + 5, 12)]
+        ]
+        records = libre_extremes_in_buckets(data, bucket="15min")
+        self.assertEqual(len(records), 12 * 4 + 1)
+        self.assertEqual(
+            records[:2] + records[-1:],
+            [
+                {
+                    "timeInterval": "2024-01-01 12:00:00",
+                    "timeIntervalData": {
+                        "numberOfHighs": 1,
+                        "numberOfLows": 0,
+                        "percentageOfTimeHigh": 11.1,
+                        "percentageOfTimeLow": 0.0,
+                        "percentageOfTimeInTarget": 88.9,
+                    },
+                },
+                {
+                    "timeInterval": "2024-01-01 12:15:00",
+                    "timeIntervalData": {
+                        "numberOfHighs": 1,
+                        "numberOfLows": 0,
+                        "percentageOfTimeHigh": 99.89,
+                        "percentageOfTimeLow": 0.0,
+                        "percentageOfTimeInTarget": 0.11,
+                    },
+                },
+                {
+                    "timeInterval": "2024-01-02 00:00:00",
+                    "timeIntervalData": {
+                        "numberOfHighs": 1,
+                        "numberOfLows": 0,
+                        "percentageOfTimeHigh": 33.33,
+                        "percentageOfTimeLow": 0.0,
+                        "percentageOfTimeInTarget": 66.67,
+                    },
+                },
+            ],
+        )
+
     def test_libre_hba1c(self):
         # No data
         self.assertEqual(libre_hba1c([]), {"hBA1C": None})
@@ -400,6 +646,36 @@ class TestUtils(unittest.TestCase):
         # 90 minutes
         # (10 * 6 + 20 * 7 + 10 * 10 + 30 * 7 + 20 * 3) / 90 = 6.33333333333
         self.assertEqual(libre_hba1c(data), {"hBA1C": 6.333333333333333})
+        # Same from the timestamp and glucose columns
+        self.assertEqual(
+            libre_hba1c(
+                pd.DataFrame(
+                    {
+                        "timestamp": [rec.timestamp for rec in data],
+                        "glucose": [rec.glucose for rec in data],
+                    }
+                )
+            ),
+            {"hBA1C": 6.333333333333333},
+        )
+
+    def test_libre_hba1c_matches_pandas(self):
+        readings = generate_readings(3)
+        # Irregular gaps, including repeated timestamps
+        readings = readings.sample(frac=0.5, random_state=1).sort_index()
+        readings = pd.concat([readings, readings[:10]]).sort_values("timestamp")
+        records = [
+            Glucose(timestamp=timestamp.to_pydatetime(), glucose=glucose)
+            for timestamp, glucose in readings.itertuples(index=False)
+        ]
+        for data in (readings, records, readings[:61], readings[:2]):
+            with self.subTest(rows=len(data)):
+                expected = libre_hba1c_pandas(data)["hBA1C"]
+                result = libre_hba1c(data)["hBA1C"]
+                if expected is None:
+                    self.assertIsNone(result)
+                else:
+                    self.assertAlmostEqual(result, expected)
 
     def test_get_seconds_from_pandas_interval(self):
         self.assertEqual(get_seconds_from_pandas_interval("10min"), 600)
@@ -430,20 +706,41 @@ class TestUtils(unittest.TestCase):
             Glucose(glucose=3, timestamp=dt(2000, 1, 2, 12, 40, 0)),
             Glucose(glucose=4, timestamp=dt(2000, 1, 2, 12, 44, 0)),
         ]
-        self.assertEqual(
-            glucose_quartile_data(data),
+        # Same from the timestamp and glucose columns
+        columns = pd.DataFrame(
             {
-                "intervals": ["12:00", "12:15", "12:30"],
-                "count": [6, 2, 6],
-                "maxValues": [15.0, 8.0, 6.0],
-                "minValues": [6.0, 7.0, 3.0],
-                "medianValues": [10.0, 7.5, 5.0],
-                "q10": [6.5, 7.1, 3.5],
-                "q25": [7.25, 7.25, 4.25],
-                "q75": [13.5, 7.75, 5.75],
-                "q90": [14.5, 7.9, 6.0],
-            },
+                "timestamp": [rec.timestamp for rec in data],
+                "glucose": [rec.glucose for rec in data],
+            }
         )
+        for test_data in (data, columns):
+            with self.subTest(test_data=type(test_data)):
+                self.assertEqual(
+                    glucose_quartile_data(test_data),
+                    {
+                        "intervals": ["12:00", "12:15", "12:30"],
+                        "count": [6, 2, 6],
+                        "maxValues": [15.0, 8.0, 6.0],
+                        "minValues": [6.0, 7.0, 3.0],
+                        "medianValues": [10.0, 7.5, 5.0],
+                        "q10": [6.5, 7.1, 3.5],
+                        "q25": [7.25, 7.25, 4.25],
+                        "q75": [13.5, 7.75, 5.75],
+                        "q90": [14.5, 7.9, 6.0],
+                    },
+                )
+
+    def test_to_utc_timestamp(self):
+        self.assertEqual(
+            to_utc_timestamp("2024-01-01 12:00:00"),
+            pd.Timestamp("2024-01-01 12:00:00", tz="UTC"),
+        )
+        self.assertEqual(
+            to_utc_timestamp("2024-01-01T12:00:00+01:00"),
+            pd.Timestamp("2024-01-01 11:00:00", tz="UTC"),
+        )
+        self.assertIsNone(to_utc_timestamp(None))
+        self.assertIsNone(to_utc_timestamp("not a time"))
 
     def test_populate_glucose_data(self):
         # Unequal lists
@@ -497,6 +794,39 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(expected_timestamp_data, res_timestamp_data)
         self.assertEqual(expected_glucose_data, res_glucose_data)
 
+        # Same data as arrays of epoch seconds and glucose
+        res_epoch_seconds, res_glucose_array = populate_glucose_data(
+            timestamp_data, glucose_data, interval_in_mins=15, as_array=True
+        )
+        self.assertEqual(
+            res_epoch_seconds.tolist(),
+            compute_epoch_array(expected_timestamp_data).tolist(),
+        )
+        self.assertEqual(res_glucose_array.tolist(), list(expected_glucose_data))
+
+        # A reading on a boundary needs no extra points,
+        # but the later boundaries are still populated
+        timestamp_data = [
+            dt(2024, 1, 1, 12, 5, 0).astimezone(timezone.utc),
+            dt(2024, 1, 1, 12, 15, 0).astimezone(timezone.utc),
+            dt(2024, 1, 1, 12, 35, 0).astimezone(timezone.utc),
+        ]
+        glucose_data = [6, 8, 12]
+        res_timestamp_data, res_glucose_data = populate_glucose_data(
+            timestamp_data, glucose_data, interval_in_mins=15
+        )
+        self.assertEqual(
+            res_timestamp_data,
+            (
+                dt(2024, 1, 1, 12, 5, 0).astimezone(timezone.utc),
+                dt(2024, 1, 1, 12, 15, 0).astimezone(timezone.utc),
+                dt(2024, 1, 1, 12, 29, 59).astimezone(timezone.utc),
+                dt(2024, 1, 1, 12, 30, 0).astimezone(timezone.utc),
+                dt(2024, 1, 1, 12, 35, 0).astimezone(timezone.utc),
+            ),
+        )
+        self.assertEqual(res_glucose_data, (6, 8, 11, 11, 12))
+
     def test_group_glucose_data_by_day(self):
         data = [
             # Day 2
@@ -512,35 +842,28 @@ class TestUtils(unittest.TestCase):
             Glucose(timestamp=dt(2024, 1, 3, 12, 15, 0), glucose=10),
             Glucose(timestamp=dt(2024, 1, 3, 13, 30, 0), glucose=12),
         ]
-        # Test unsorted, unsorted and string glucose data
-        for test_data, is_sorted in zip(
-            (
-                data,
-                sorted(data, key=lambda x: x.timestamp),
-            ),
-            [False, True],
-        ):
-            with self.subTest(is_sorted=is_sorted):
-                self.assertDictEqual(
-                    group_glucose_data_by_day(test_data),
-                    {
-                        "2024-01-01": [
-                            ("12:05:00", 9.0),
-                            ("12:15:00", 10.0),
-                            ("13:30:00", 11.0),
-                        ],
-                        "2024-01-02": [
-                            ("12:05:00", 10.0),
-                            ("12:15:00", 10.0),
-                            ("13:30:00", 11.0),
-                        ],
-                        "2024-01-03": [
-                            ("12:05:00", 9.0),
-                            ("12:15:00", 10.0),
-                            ("13:30:00", 12.0),
-                        ],
-                    },
-                )
+        # The records arrive from the database in time order
+        data = sorted(data, key=lambda x: x.timestamp)
+        self.assertDictEqual(
+            group_glucose_data_by_day(data),
+            {
+                "2024-01-01": [
+                    ("12:05:00", 9.0),
+                    ("12:15:00", 10.0),
+                    ("13:30:00", 11.0),
+                ],
+                "2024-01-02": [
+                    ("12:05:00", 10.0),
+                    ("12:15:00", 10.0),
+                    ("13:30:00", 11.0),
+                ],
+                "2024-01-03": [
+                    ("12:05:00", 9.0),
+                    ("12:15:00", 10.0),
+                    ("13:30:00", 12.0),
+                ],
+            },
+        )
 
     def test_run_sum_strava_data(self):
         data = [
@@ -649,6 +972,66 @@ class TestUtils(unittest.TestCase):
             },
         )
 
+    def test_run_sum_strava_data_matches_pandas(self):
+        data = generate_activities(30)
+        data[3].distance = None
+        expected = run_sum_strava_data_pandas(data)
+        self.assertEqual(run_sum_strava_data(data), expected)
+        # Same from the start_time, activity_type and distance columns
+        columns = pd.DataFrame(
+            [(x.start_time, x.activity_type, x.distance) for x in data],
+            columns=["start_time", "activity_type", "distance"],
+        )
+        self.assertEqual(run_sum_strava_data(columns), expected)
+        self.assertEqual(run_sum_strava_data([]), {})
+        # As read from the database, object columns when empty or all NULL
+        self.assertEqual(
+            run_sum_strava_data(
+                pd.DataFrame.from_records([], columns=list(columns.columns))
+            ),
+            {},
+        )
+        null_distances = pd.DataFrame.from_records(
+            [(x.start_time, x.activity_type, None) for x in data[:5]],
+            columns=list(columns.columns),
+        )
+        summary = run_sum_strava_data(null_distances)
+        self.assertEqual(sum(x["count"] for x in summary.values()), 5)
+        for activity in summary.values():
+            for row in activity["timestampData"]:
+                self.assertEqual((row["distance"], row["totalDistance"]), (0.0, 0.0))
+
+    def test_run_sum_strava_data_mixed_offsets(self):
+        # As read from the database either side of daylight saving
+        summer, winter = timezone(timedelta(hours=1)), timezone(timedelta(hours=0))
+        columns = pd.DataFrame.from_records(
+            [
+                (dt(2024, 11, 1, 9, tzinfo=winter), "RUN", 5.0),
+                (dt(2024, 10, 1, 9, tzinfo=summer), "RUN", 3.0),
+            ],
+            columns=["start_time", "activity_type", "distance"],
+        )
+        self.assertEqual(
+            run_sum_strava_data(columns),
+            {
+                "RUN": {
+                    "timestampData": [
+                        {
+                            "timestamp": dt(2024, 10, 1, 8, tzinfo=timezone.utc),
+                            "distance": 3.0,
+                            "totalDistance": 3.0,
+                        },
+                        {
+                            "timestamp": dt(2024, 11, 1, 9, tzinfo=timezone.utc),
+                            "distance": 5.0,
+                            "totalDistance": 8.0,
+                        },
+                    ],
+                    "count": 2,
+                }
+            },
+        )
+
     def test_glucose_raw_data(self):
         data = [
             Glucose(id=2, timestamp=dt(2024, 1, 2, 12, 5, 0), glucose=5),
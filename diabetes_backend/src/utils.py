@@ -1,6 +1,8 @@
 import os
 from datetime import datetime, timedelta, timezone
+from src.accumulator import TimeWeightedMean
 from src.constants import STRAVA_DATETIME, TIME_FMT
+import numpy as np
 import pandas as pd
 from itertools import groupby
 
@@ -13,6 +15,28 @@ def compute_epoch(ts):
     return int(ts.strftime("%s"))
 
 
+def compute_epoch_array(timestamps):
+    """
+    Convert the timestamps to an int64 array of epoch seconds.
+    Timezone aware timestamps are converted to UTC, naive ones are taken as UTC.
+    """
+    index = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).tz_localize(None)
+    return index.values.astype("datetime64[s]").astype(np.int64)
+
+
+def to_utc_timestamp(value):
+    """The time as a UTC timestamp, naive times are taken as UTC, None if invalid"""
+    try:
+        timestamp = pd.Timestamp(value)
+    except (TypeError, ValueError):
+        return None
+    if pd.isna(timestamp):
+        return None
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize("UTC")
+    return timestamp.tz_convert("UTC")
+
+
 def convert_str_to_ts(ts, fmt):
     return datetime.strptime(ts, fmt)
 
@@ -38,25 +62,116 @@ def load_strava_credentials_from_env():
     )
 
 
-# These have performance consequences
-# 10th Percentile
-def q10(x):
-    return x.quantile(0.1)
+# Percentiles reported alongside the median of each bucket
+PERCENTILES = {"q10": 0.1, "q25": 0.25, "q75": 0.75, "q90": 0.9}
 
 
-# 25th Percentile
-def q25(x):
-    return x.quantile(0.25)
+def compute_grouped_quantiles(group_index, values, n_groups, percentiles=PERCENTILES):
+    """
+    Compute the median and percentiles of every group with a single sort.
+    group_index gives the group (0 to n_groups - 1) of each value.
+    Interpolates linearly as numpy's (and pandas') quantile does,
+    empty groups are NaN.
+    """
+    group_index = np.asarray(group_index, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.lexsort((values, group_index))
+    sorted_values = np.append(values[order], np.nan)
+
+    counts = np.bincount(group_index, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    last = starts + counts - 1
+    # Empty groups point past the end of the values, at the NaN
+    empty = counts == 0
+    last[empty] = len(values)
+
+    result = {
+        "median": (
+            sorted_values[np.where(empty, last, starts + (counts - 1) // 2)]
+            + sorted_values[np.where(empty, last, starts + counts // 2)]
+        )
+        / 2
+    }
+    for name, q in percentiles.items():
+        virtual_index = (counts - 1) * q
+        previous_index = np.floor(virtual_index)
+        gamma = virtual_index - previous_index
+        lower = np.where(
+            empty, last, np.minimum(starts + previous_index.astype(np.int64), last)
+        )
+        upper = np.minimum(lower + 1, last)
+        below, above = sorted_values[lower], sorted_values[upper]
+        result[name] = np.where(
+            gamma >= 0.5,
+            above - (above - below) * (1 - gamma),
+            below + (above - below) * gamma,
+        )
+    return result
+
+
+def get_glucose_columns(data):
+    """
+    Extract the timestamps and float glucose values from either the Glucose records
+    or a DataFrame of the timestamp and glucose columns
+    """
+    if isinstance(data, pd.DataFrame):
+        return data["timestamp"].array, data["glucose"].to_numpy(dtype=np.float64)
+    return [x.timestamp for x in data], np.fromiter(
+        (x.glucose for x in data), dtype=np.float64, count=len(data)
+    )
 
 
-# 75th Percentile
-def q75(x):
-    return x.quantile(0.75)
+def compute_seconds_of_day(timestamps):
+    """
+    Fold the timestamps onto a single day, returning an int64 array of the
+    (wall clock) seconds since midnight of each timestamp.
+    """
+    try:
+        index = pd.DatetimeIndex(pd.to_datetime(timestamps))
+    except ValueError:
+        # Mixed UTC offsets (e.g. either side of daylight saving)
+        # shift each timestamp by its own offset
+        utc = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).tz_localize(None)
+        index = utc + pd.to_timedelta([t.utcoffset() for t in timestamps])
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.values.astype("datetime64[s]").astype(np.int64) % (24 * 60 * 60)
+
+
+def fold_glucose_data_by_time_of_day(data, bucket="15min"):
+    """
+    Bucket the glucose data by the time of day it was recorded.
+    Returns a frame of the bucket index and the raw glucose value of each record,
+    along with every bucket index between the first and last populated bucket.
+    """
+    bucket_seconds = get_seconds_from_pandas_interval(bucket)
+    timestamps, glucose = get_glucose_columns(data)
+    buckets = compute_seconds_of_day(timestamps) // bucket_seconds
+    df = pd.DataFrame({"bucket": buckets, "raw": glucose})
+    if df.empty:
+        return df, pd.RangeIndex(0)
+    return df, pd.RangeIndex(buckets.min(), buckets.max() + 1)
+
+
+def format_time_of_day_buckets(buckets, bucket="15min"):
+    """Label each bucket index with the time of day it starts, %H:%M"""
+    bucket_seconds = get_seconds_from_pandas_interval(bucket)
+    return [
+        f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}"
+        for seconds in (np.asarray(buckets) * bucket_seconds).tolist()
+    ]
 
 
-# 90th Percentile
-def q90(x):
-    return x.quantile(0.9)
+def aggregate_time_of_day_buckets(df, buckets, aggregations):
+    """
+    Aggregate the raw glucose of every bucket, along with its median and
+    percentiles. Buckets without data are 0 for the aggregations and NaN otherwise.
+    """
+    stats = df.groupby("bucket")["raw"].agg(aggregations).reindex(buckets, fill_value=0)
+    quantiles = compute_grouped_quantiles(
+        df["bucket"].to_numpy() - buckets.start, df["raw"].to_numpy(), len(buckets)
+    )
+    return stats.assign(**quantiles)
 
 
 def glucose_quartile_data(data):
@@ -68,27 +183,18 @@ def glucose_quartile_data(data):
     and analyse that.
     """
     logger.debug("glucose_quartile_data()")
-    timestamps = list(
-        map(lambda x: convert_time_to_str(x.timestamp, STRAVA_DATETIME), data)
-    )
-    glucose_list = list(map(lambda x: float(x.glucose), data))
+    df, buckets = fold_glucose_data_by_time_of_day(data)
 
-    df = pd.DataFrame({"time": timestamps, "raw": glucose_list})
-    # Convert to dt and replace all the yyy/mm/dd with the same as we only want hours
-    # may want to do pd series instead at some point
-    df["time"] = pd.to_datetime(df["time"]).apply(
-        lambda t: t.replace(day=31, year=2000, month=12)
-    )
+    df = aggregate_time_of_day_buckets(df, buckets, ["count", "max", "min"])
+    return format_quartile_data(df, buckets)
 
-    df = df.groupby([pd.Grouper(key="time", freq="15min")])["raw"].agg(
-        ["count", "median", "max", "min", q10, q25, q75, q90]
-    )
-    # Format the time column
-    df.index = df.index.strftime("%H:%M")
+
+def format_quartile_data(df, buckets):
+    """The quartile data response of the aggregated time of day buckets"""
     # Crude hack for NaN
     df = df.fillna(0)
     return {
-        "intervals": list(df.index.values),
+        "intervals": format_time_of_day_buckets(buckets),
         "medianValues": df["median"].to_list(),
         "count": df["count"].to_list(),
         "maxValues": df["max"].to_list(),
@@ -106,34 +212,32 @@ def aggregate_glucose_data(data, bucket="15min"):
     Compute the average
     Variance
     """
-    timestamps = list(
-        map(lambda x: convert_time_to_str(x.timestamp, STRAVA_DATETIME), data)
-    )
-    glucose_list = list(map(lambda x: float(x.glucose), data))
+    df, buckets = fold_glucose_data_by_time_of_day(data, bucket)
 
-    df = pd.DataFrame({"time": timestamps, "raw": glucose_list})
-    # COnvert to dt and replace all the yyy/mm/dd with the same as we only want hours
-    # may want to do pd series instead at some point
-    df["time"] = pd.to_datetime(df["time"]).apply(
-        lambda t: t.replace(day=31, year=2000, month=12)
-    )
+    # Split the raw values by bucket, keeping the original order within each
+    order = np.argsort(df["bucket"].to_numpy(), kind="stable")
+    offsets = np.searchsorted(df["bucket"].to_numpy()[order], buckets, side="left")
     raw_data = (
-        df.groupby([pd.Grouper(key="time", freq=bucket)])["raw"].apply(list).to_list()
+        [
+            values.tolist()
+            for values in np.split(df["raw"].to_numpy()[order], offsets[1:])
+        ]
+        if len(buckets)
+        else []
     )
-    # # Low levels,
-    # lows = (
-    #     df.groupby([pd.Grouper(key="time", freq=interval)])["raw"].agg()
-    # )
 
-    df = df.groupby([pd.Grouper(key="time", freq=bucket)])["raw"].agg(
-        ["mean", "median", "var", "count", "std", "max", "min", q10, q25, q75, q90]
+    df = aggregate_time_of_day_buckets(
+        df, buckets, ["mean", "var", "count", "std", "max", "min"]
     )
-    # Format the time column
-    df.index = df.index.strftime("%H:%M")
+    return format_aggregate_data(df, buckets, raw_data, bucket)
+
+
+def format_aggregate_data(df, buckets, raw_data, bucket="15min"):
+    """The aggregate data response of the aggregated time of day buckets"""
     # Crude hack for NaN
     df = df.fillna(0)
     return {
-        "intervals": list(df.index.values),
+        "intervals": format_time_of_day_buckets(buckets, bucket),
         "mean": df["mean"].to_list(),
         "count": df["count"].to_list(),
         "median": df["median"].to_list(),
@@ -184,202 +288,229 @@ def run_sum_strava_data(data):
 
     """
     logger.debug("run_sum_strava_data()")
-    ordered_data = sorted(data, key=lambda x: x.start_time)
-    timestamp_list = list(map(lambda x: x.start_time, ordered_data))
-    activity_list = list(map(lambda x: x.activity_type, ordered_data))
-    distance_list = list(map(lambda x: x.distance, ordered_data))
-
-    df = pd.DataFrame(
-        {
-            "timestamp": timestamp_list,
-            "activity": activity_list,
-            "distance": distance_list,
-        }
-    )
-    # Crude hack for NaN
+    if isinstance(data, pd.DataFrame):
+        df = data.rename(
+            columns={"start_time": "timestamp", "activity_type": "activity"}
+        )[["timestamp", "activity", "distance"]]
+    else:
+        df = pd.DataFrame(
+            {
+                "timestamp": [x.start_time for x in data],
+                "activity": [x.activity_type for x in data],
+                "distance": [x.distance for x in data],
+            }
+        )
+    if df.empty:
+        return {}
+    # Crude hack for NaN, the columns read from the database may be object dtype
     df = df.fillna(0)
-
-    # Compute running totals of the total_distance and activity count
-    df["total_distance"] = df[["activity", "distance"]].groupby(["activity"]).cumsum()
-    df["number_activities"] = (
-        df[["activity", "distance"]].groupby(["activity"]).cumcount() + 1
+    try:
+        timestamps = pd.to_datetime(df["timestamp"])
+    except ValueError:
+        # Mixed UTC offsets (e.g. either side of daylight saving), as UTC
+        timestamps = pd.to_datetime(df["timestamp"], utc=True)
+    df = df.assign(timestamp=timestamps, distance=df["distance"].astype(np.float64))
+
+    # Group the activities together, each in time order
+    df = (
+        df.sort_values("timestamp", kind="stable")
+        .sort_values("activity", kind="stable")
+        .reset_index(drop=True)
     )
-
-    # Sort the keys
-    sorted_keys = sorted(list(set(activity_list)))
+    df = df.assign(
+        timestamp=df["timestamp"].dt.to_pydatetime(),
+        totalDistance=df.groupby("activity", sort=False)["distance"].cumsum(),
+    )
+    counts = df.groupby("activity", sort=False).size()
+    records = df[["timestamp", "distance", "totalDistance"]].to_dict("records")
+    ends = np.cumsum(counts.to_numpy())
     return {
-        key: {
-            "timestampData": [
-                {
-                    "timestamp": row["timestamp"].to_pydatetime(),
-                    "distance": row["distance"],
-                    "totalDistance": row["total_distance"],
-                }
-                for _idx, row in df.loc[df["activity"] == key].iterrows()
-            ],
-            "count": max(df.loc[df["activity"] == key]["number_activities"].to_list()),
-        }
-        for key in sorted_keys
+        key: {"timestampData": records[end - count : end], "count": int(count)}
+        for key, count, end in zip(counts.index, counts, ends)
     }
 
 
 def libre_hba1c(data):
     """
-    Computing the HBA1C
+    Computing the HBA1C, the time weighted mean of the readings,
+    integrated with the trapezoidal rule over their epoch seconds
     """
     logger.debug("libre_hba1c()")
 
     if len(data) < 2:
         return {"hBA1C": None}
 
-    # Order (in time order) and extract the data
-    ordered_data = sorted(data, key=lambda x: x.timestamp)
-    timestamp_list = list(map(lambda x: x.timestamp, ordered_data))
-    glucose_list = list(map(lambda x: float(x.glucose), ordered_data))
-
-    # Running count for the seconds low/high
-    total_seconds = (timestamp_list[-1] - timestamp_list[0]).total_seconds()
+    # Extract the data, already in time order from the database
+    timestamp_list, glucose_list = get_glucose_columns(data)
+    epochs = compute_epoch_array(timestamp_list)
 
     # Check the date range spans an hour, else exit early
-    if total_seconds < 60 * 60:
+    if epochs[-1] - epochs[0] < 60 * 60:
         return {"hBA1C": None}
 
-    # create a sample DataFrame
-    df = pd.DataFrame({"timestamp": timestamp_list, "glucose": glucose_list})
-
-    # calculate the time difference between consecutive rows
-    df["time_diff"] = df["timestamp"].diff()
-    # replace missing values with a default value
-    df["time_diff"] = df["time_diff"].fillna(pd.Timedelta(seconds=0))
-    df["time_diff"] = list(map(lambda x: x.total_seconds(), df["time_diff"]))
-
-    df["glucose_diff"] = df["glucose"].rolling(2).mean()
-    df["rolling_mean"] = list(
-        map(
-            lambda x, y: 0 if x == 0 else abs(y) * (x / total_seconds),
-            df["time_diff"],
-            df["glucose_diff"],
-        )
-    )
-    mean = df["rolling_mean"].sum()
+    mean = TimeWeightedMean().update(epochs, glucose_list).mean
     logger.debug("Finished computing HBA1C")
     return {
         "hBA1C": mean,
     }
 
 
-def compute_percentages(  # noqa: C901
-    data, interval_length_seconds=3600, high=10, low=4
-):
+def compute_percentages(data, interval_length_seconds=3600, high=10, low=4):
     """
     Computing the percentage of time below/above a threshold
     Assumes the last record and the first record is the span of the window
     The data is a list of timestamp,glucose tuples
     """
+    timestamp_list, glucose_list = zip(*data) if data else ([], [])
+    return compute_percentages_in_buckets(
+        compute_epoch_array(timestamp_list),
+        glucose_list,
+        [0],
+        interval_length_seconds=interval_length_seconds,
+        high=high,
+        low=low,
+    )[0]
+
+
+def compute_percentages_in_buckets(
+    epoch_seconds, glucose, bucket_offsets, interval_length_seconds=3600, high=10, low=4
+):
+    """
+    Vectorised compute_percentages for consecutive buckets of readings in one pass.
+    The epoch_seconds (int64) and glucose (float64) arrays must be in time order,
+    bucket_offsets holds the index of the first reading of each bucket, so bucket i
+    spans [bucket_offsets[i], bucket_offsets[i + 1]) and an empty bucket repeats
+    the offset of the next one.
+    Returns the compute_percentages result of every bucket.
+    """
     if high <= low:
         raise ValueError(f"Cannot specify the high value {high} <= low value {low}")
 
-    # If there is no data or one record then exit early
-    if len(data) == 0:
-        return {
-            "percentageOfTimeInTarget": None,
-            "percentageOfTimeLow": None,
-            "percentageOfTimeHigh": None,
-            "numberOfHighs": None,
-            "numberOfLows": None,
-        }
-    elif len(data) == 1:
-        _, glucose = data[0]
-        is_low = glucose < low
-        is_high = glucose > high
-        return {
-            "percentageOfTimeInTarget": 100 if not is_low and not is_high else 0,
-            "percentageOfTimeLow": 100 if is_low else 0,
-            "percentageOfTimeHigh": 100 if is_high else 0,
-            "numberOfHighs": int(is_high),
-            "numberOfLows": int(is_low),
-        }
-
-    timestamp_list, glucose_list = zip(*data)
-
-    # Running count for the seconds low/high
-    total_high_seconds = 0
-    total_low_seconds = 0
-
-    last_glucose = glucose_list[0]
-    last_time = timestamp_list[0]
+    timestamps = np.asarray(epoch_seconds, dtype=np.int64)
+    glucose = np.asarray(glucose, dtype=np.float64)
+    starts = np.asarray(bucket_offsets, dtype=np.int64)
+    ends = np.append(starts[1:], len(timestamps))
+    sizes = ends - starts
+    number_of_buckets = len(starts)
+    bucket_ids = np.repeat(np.arange(number_of_buckets), sizes)
+
+    # Classify each consecutive pair of readings within a bucket,
+    # the precedence matches the original if/elif chain
+    last_glucose = glucose[:-1]
+    cur_glucose = glucose[1:]
+    same_bucket = bucket_ids[1:] == bucket_ids[:-1]
+    into_high = same_bucket & (cur_glucose >= high) & (last_glucose < high)
+    out_of_high = same_bucket & (cur_glucose < high) & (last_glucose >= high)
+    into_low = same_bucket & (cur_glucose <= low) & (last_glucose > low) & ~out_of_high
+    out_of_low = same_bucket & (cur_glucose > low) & (last_glucose <= low) & ~into_high
+
+    # Interpolate the time (in microseconds) each threshold is crossed
+    crossing_us = np.zeros(len(last_glucose), dtype=np.int64)
+    crossings = np.flatnonzero(into_high | out_of_high | into_low | out_of_low)
+    crossing_us[crossings] = compute_x_time_value_us(
+        timestamps[crossings],
+        glucose[crossings],
+        timestamps[crossings + 1],
+        glucose[crossings + 1],
+        np.where((into_high | out_of_high)[crossings], high, low),
+    )
 
-    # Set the last transition time
-    transition_into_extreme = last_time
+    # The transition into an extreme is reset at the start of each bucket
+    # and on every crossing into a high/low, carry it forward to each reading
+    timestamps_us = timestamps * 10**6
+    into_extreme = np.zeros(len(timestamps), dtype=bool)
+    into_extreme[1:] = into_high | into_low
+    transition_us = timestamps_us.copy()
+    transition_us[into_extreme] = crossing_us[into_extreme[1:]]
+    is_reset = into_extreme.copy()
+    is_reset[starts[sizes > 0]] = True
+    last_reset = np.maximum.accumulate(
+        np.where(is_reset, np.arange(len(timestamps)), 0)
+    )
+    transition_us = transition_us[last_reset]
 
-    # Running count of number of highs
+    total_high_seconds = np.bincount(
+        bucket_ids[1:][out_of_high],
+        weights=(crossing_us[out_of_high] - transition_us[1:][out_of_high]) / 10**6,
+        minlength=number_of_buckets,
+    )
+    total_low_seconds = np.bincount(
+        bucket_ids[1:][out_of_low],
+        weights=(crossing_us[out_of_low] - transition_us[1:][out_of_low]) / 10**6,
+        minlength=number_of_buckets,
+    )
     # Initial event must be counted if high/low
-    number_of_highs = 1 if last_glucose >= high else 0
-    number_of_lows = 1 if last_glucose <= low else 0
-
-    for cur_glucose, cur_time in zip(glucose_list[1:], timestamp_list[1:]):
-        if cur_glucose >= high and last_glucose < high:
-            # Changing into high region
-            transition_into_extreme = compute_x_time_value(
-                (last_time, last_glucose), (cur_time, cur_glucose), high
-            )
-            number_of_highs += 1
-        elif cur_glucose < high and last_glucose >= high:
-            # transitioning out of high region
-            transition_time = compute_x_time_value(
-                (last_time, last_glucose), (cur_time, cur_glucose), high
-            )
-            total_high_seconds += (
-                transition_time - transition_into_extreme
-            ).total_seconds()
-        elif cur_glucose <= low and last_glucose > low:
-            # Transitioning into low
-            transition_into_extreme = compute_x_time_value(
-                (last_time, last_glucose), (cur_time, cur_glucose), low
+    first_glucose = glucose[starts[sizes > 0]]
+    number_of_highs = np.bincount(
+        bucket_ids[1:][into_high], minlength=number_of_buckets
+    )
+    number_of_highs[sizes > 0] += first_glucose >= high
+    number_of_lows = np.bincount(bucket_ids[1:][into_low], minlength=number_of_buckets)
+    number_of_lows[sizes > 0] += first_glucose <= low
+
+    records = []
+    for bucket in range(number_of_buckets):
+        start, end = starts[bucket], ends[bucket]
+        if start == end:
+            records.append(
+                {
+                    "percentageOfTimeInTarget": None,
+                    "percentageOfTimeLow": None,
+                    "percentageOfTimeHigh": None,
+                    "numberOfHighs": None,
+                    "numberOfLows": None,
+                }
             )
-            number_of_lows += 1
-        elif cur_glucose > low and last_glucose <= low:
-            # Transitioning out
-            transition_time = compute_x_time_value(
-                (last_time, last_glucose), (cur_time, cur_glucose), low
+            continue
+        elif end - start == 1:
+            is_low = glucose[start] < low
+            is_high = glucose[start] > high
+            records.append(
+                {
+                    "percentageOfTimeInTarget": (
+                        100 if not is_low and not is_high else 0
+                    ),
+                    "percentageOfTimeLow": 100 if is_low else 0,
+                    "percentageOfTimeHigh": 100 if is_high else 0,
+                    "numberOfHighs": int(is_high),
+                    "numberOfLows": int(is_low),
+                }
             )
-            total_low_seconds += (
-                transition_time - transition_into_extreme
-            ).total_seconds()
-
-        # Update the last record processed
-        last_glucose = cur_glucose
-        last_time = cur_time
-
-    # Edge case at the the end
-    # If the last value is high/low need to include that in the statistics
-    if last_glucose >= high:
-        total_high_seconds += (
-            timestamp_list[-1] - transition_into_extreme
-        ).total_seconds()
-    elif last_glucose <= low:
-        total_low_seconds += (
-            timestamp_list[-1] - transition_into_extreme
-        ).total_seconds()
+            continue
+
+        # Edge case at the the end
+        # If the last value is high/low need to include that in the statistics
+        high_seconds = float(total_high_seconds[bucket])
+        low_seconds = float(total_low_seconds[bucket])
+        last_extreme_seconds = float(
+            (timestamps_us[end - 1] - transition_us[end - 1]) / 10**6
+        )
+        if glucose[end - 1] >= high:
+            high_seconds += last_extreme_seconds
+        elif glucose[end - 1] <= low:
+            low_seconds += last_extreme_seconds
 
-    return {
-        "numberOfHighs": number_of_highs,
-        "numberOfLows": number_of_lows,
-        "percentageOfTimeHigh": round(
-            (total_high_seconds / interval_length_seconds) * 100, 2
-        ),
-        "percentageOfTimeLow": round(
-            (total_low_seconds / interval_length_seconds) * 100, 2
-        ),
-        "percentageOfTimeInTarget": round(
-            (
-                (interval_length_seconds - total_low_seconds - total_high_seconds)
-                / interval_length_seconds
-            )
-            * 100,
-            2,
-        ),
-    }
+        records.append(
+            {
+                "numberOfHighs": int(number_of_highs[bucket]),
+                "numberOfLows": int(number_of_lows[bucket]),
+                "percentageOfTimeHigh": round(
+                    (high_seconds / interval_length_seconds) * 100, 2
+                ),
+                "percentageOfTimeLow": round(
+                    (low_seconds / interval_length_seconds) * 100, 2
+                ),
+                "percentageOfTimeInTarget": round(
+                    (
+                        (interval_length_seconds - low_seconds - high_seconds)
+                        / interval_length_seconds
+                    )
+                    * 100,
+                    2,
+                ),
+            }
+        )
+    return records
 
 
 def libre_extremes_in_buckets(data, high=10, low=4, bucket="15min"):
@@ -390,10 +521,8 @@ def libre_extremes_in_buckets(data, high=10, low=4, bucket="15min"):
         f"libre_extremes_in_buckets() with targets {high}-{low} and buckets: {bucket}"
     )
     logger.debug(f"Checking {len(data)} records")
-    # Order (in time order) and extract the data
-    ordered_data = sorted(data, key=lambda x: x.timestamp)
-    timestamp_list = list(map(lambda x: x.timestamp, ordered_data))
-    glucose_list = list(map(lambda x: float(x.glucose), ordered_data))
+    # Extract the data, already in time order from the database
+    timestamp_list, glucose_list = get_glucose_columns(data)
 
     # Find the total seconds being computed
     total_seconds = (timestamp_list[-1] - timestamp_list[0]).total_seconds()
@@ -410,39 +539,28 @@ def libre_extremes_in_buckets(data, high=10, low=4, bucket="15min"):
         }
 
     # Populate the data with the boundary points
-    enriched_timestamp_data, enriched_glucose_data = populate_glucose_data(
-        timestamp_list, glucose_list, get_seconds_from_pandas_interval(bucket)
+    bucket_seconds = get_seconds_from_pandas_interval(bucket)
+    epoch_seconds, enriched_glucose_data = populate_glucose_data(
+        timestamp_list, glucose_list, bucket_seconds // 60, as_array=True
     )
 
-    # Create a pandas df
-    df = pd.DataFrame(
-        {
-            "timestamp": enriched_timestamp_data,
-            "glucose": enriched_glucose_data,
-        }
+    # Split the data into buckets and compute them all at once
+    bucket_starts, bucket_offsets = compute_bucket_offsets(
+        epoch_seconds, bucket_seconds
     )
-
-    # Group the data into buckets and store as a list of tuple records
-    df3 = (
-        df.groupby([pd.Grouper(key="timestamp", freq=bucket)])
-        .apply(lambda x: [(t, g) for t, g in zip(x["timestamp"], x["glucose"])])
-        .apply(list)
+    bucket_percentages = compute_percentages_in_buckets(
+        epoch_seconds,
+        enriched_glucose_data,
+        bucket_offsets,
+        interval_length_seconds=bucket_seconds,
+        high=high,
+        low=low,
     )
-    records = []
-    for group, grouped_data in df3.items():
-        records.append(
-            {
-                "timeInterval": group.strftime(STRAVA_DATETIME),
-                "timeIntervalData": compute_percentages(
-                    grouped_data,
-                    interval_length_seconds=get_seconds_from_pandas_interval(bucket),
-                    high=high,
-                    low=low,
-                ),
-            }
-        )
-
-    return records
+    time_intervals = pd.to_datetime(bucket_starts, unit="s").strftime(STRAVA_DATETIME)
+    return [
+        {"timeInterval": time_interval, "timeIntervalData": percentages}
+        for time_interval, percentages in zip(time_intervals, bucket_percentages)
+    ]
 
 
 def libre_data_bucketed_day_overview(data, high=10, low=4, bucket="15min"):
@@ -490,6 +608,37 @@ def libre_data_bucketed_day_overview(data, high=10, low=4, bucket="15min"):
     return agg_data
 
 
+def merge_intervals(intervals):
+    """
+    Merge the (start, end) intervals into the sorted, non overlapping intervals
+    covering the same times
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def assign_to_intervals(timestamps, starts, ends):
+    """
+    Match the time ordered timestamps to every interval (bounds inclusive)
+    containing them, intervals may overlap.
+    Returns the interval index and timestamp index of each match,
+    in interval order then time order.
+    """
+    timestamps = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True))
+    lower = timestamps.searchsorted(pd.to_datetime(starts, utc=True), side="left")
+    upper = timestamps.searchsorted(pd.to_datetime(ends, utc=True), side="right")
+    counts = np.maximum(upper - lower, 0)
+    interval_index = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    timestamp_index = np.arange(counts.sum()) + np.repeat(lower - offsets, counts)
+    return interval_index, timestamp_index
+
+
 def get_seconds_from_pandas_interval(interval):
     if "min" in interval:
         return int(interval.replace("min", "")) * 60
@@ -497,9 +646,30 @@ def get_seconds_from_pandas_interval(interval):
         raise NotImplementedError
 
 
-def populate_glucose_data(timestamp_list, glucose_list, interval_in_mins=5):
+def compute_bucket_offsets(epoch_seconds, bucket_seconds):
+    """
+    Split time ordered epoch seconds into consecutive buckets of bucket_seconds,
+    aligned to the start of the first day (as pandas' Grouper does).
+    Returns the start of each bucket (epoch seconds) and the index of the first
+    reading within it, empty buckets are kept.
+    """
+    origin = epoch_seconds[0] - epoch_seconds[0] % (24 * 60 * 60)
+    first_bucket = (epoch_seconds[0] - origin) // bucket_seconds
+    last_bucket = (epoch_seconds[-1] - origin) // bucket_seconds
+    bucket_starts = origin + np.arange(first_bucket, last_bucket + 1) * bucket_seconds
+    return bucket_starts, np.searchsorted(epoch_seconds, bucket_starts, side="left")
+
+
+def populate_glucose_data(
+    timestamp_list, glucose_list, interval_in_mins=5, as_array=False
+):
     """
     Populate missing data using a linear assumption between consecutive points.
+    For every interval boundary falling between two (time ordered) readings a point
+    one second before and on the boundary are added, the new points are merged
+    in place so the result is already in time order.
+    Returns the timestamps and glucose as tuples, or as epoch seconds (int64)
+    and glucose (float64) arrays if as_array is set.
     """
     logger.debug(
         f"populate_glucose_data() with interval: {interval_in_mins} minute intervals"
@@ -511,58 +681,55 @@ def populate_glucose_data(timestamp_list, glucose_list, interval_in_mins=5):
     elif len(timestamp_list) < 2:
         raise ValueError(f"Not enough data: ({len(timestamp_list)})")
 
-    # If data is all within the same interval
-    # Find the intervals going to be defined
-    # Then populate the boundaries
-    intervals = [
-        d.to_pydatetime().astimezone(timezone.utc)
-        for d in pd.DataFrame(
-            {
-                "timestamp": [timestamp_list[0], timestamp_list[-1]],
-                "value": [0, 1],
-            }
-        )
-        .groupby([pd.Grouper(key="timestamp", freq=f"{interval_in_mins}min")])
-        .groups.keys()
+    epoch_seconds = compute_epoch_array(timestamp_list)
+    glucose = np.asarray(glucose_list, dtype=np.float64)
+
+    # Boundaries after the first interval and the index of the first reading at or
+    # after each, a reading on the boundary already marks it
+    bucket_starts, bucket_offsets = compute_bucket_offsets(
+        epoch_seconds, interval_in_mins * 60
+    )
+    boundaries = bucket_starts[1:]
+    next_index = bucket_offsets[1:]
+    is_between_readings = epoch_seconds[next_index] != boundaries
+    boundaries = boundaries[is_between_readings]
+    next_index = next_index[is_between_readings]
+
+    # Linear interpolation at the boundaries (handles gaps across many intervals)
+    x1, y1 = epoch_seconds[next_index - 1], glucose[next_index - 1]
+    x2, y2 = epoch_seconds[next_index], glucose[next_index]
+    boundary_glucose = np.where(
+        y1 == y2, y1, np.round(y1 + (y2 - y1) * ((boundaries - x1) / (x2 - x1)), 2)
+    )
+
+    # Merge, each boundary adds two points before its next reading
+    size = len(epoch_seconds) + 2 * len(boundaries)
+    reading_positions = np.arange(len(epoch_seconds)) + 2 * np.searchsorted(
+        next_index, np.arange(len(epoch_seconds)), side="right"
+    )
+    boundary_positions = next_index + 2 * np.arange(len(boundaries))
+    enriched_glucose = np.empty(size, dtype=np.float64)
+    enriched_glucose[reading_positions] = glucose
+    enriched_glucose[boundary_positions] = boundary_glucose
+    enriched_glucose[boundary_positions + 1] = boundary_glucose
+    if as_array:
+        enriched_epoch_seconds = np.empty(size, dtype=np.int64)
+        enriched_epoch_seconds[reading_positions] = epoch_seconds
+        enriched_epoch_seconds[boundary_positions] = boundaries - 1
+        enriched_epoch_seconds[boundary_positions + 1] = boundaries
+        return enriched_epoch_seconds, enriched_glucose
+
+    enriched_timestamps = np.empty(size, dtype=object)
+    enriched_timestamps[reading_positions] = list(timestamp_list)
+    enriched_timestamps[boundary_positions] = [
+        datetime.fromtimestamp(boundary - 1, timezone.utc)
+        for boundary in boundaries.tolist()
+    ]
+    enriched_timestamps[boundary_positions + 1] = [
+        datetime.fromtimestamp(boundary, timezone.utc)
+        for boundary in boundaries.tolist()
     ]
-    last_timestamp = timestamp_list[0]
-    last_glucose = glucose_list[0]
-    current_interval_index = 1
-    current_interval = intervals[current_interval_index]
-    enriched_data = list(zip(timestamp_list, glucose_list))
-    for timestamp, glucose in zip(timestamp_list[1:], glucose_list[1:]):
-        if (current_interval - last_timestamp).total_seconds() > 0 and (
-            timestamp - current_interval
-        ).total_seconds() > 0:
-            # Add the extra points if across boundary
-            # neither points are zero else they are boundary points
-
-            # Loop over the intervals to handle gaps
-            while (timestamp - current_interval).total_seconds() > 0:
-                _, new_y_data_point = compute_y_value_with_x_time(
-                    (last_timestamp, last_glucose),
-                    (timestamp, glucose),
-                    (current_interval - last_timestamp).total_seconds() / 60,
-                )
-                # Add new data points
-                enriched_data.append(
-                    (current_interval - timedelta(seconds=1), new_y_data_point)
-                )
-                enriched_data.append((current_interval, new_y_data_point))
-                # increment running values
-                current_interval_index += 1
-                if current_interval_index == len(intervals):
-                    # Exit everything has now fallen into the last bucket nothing else to process
-                    break
-                current_interval = intervals[current_interval_index]
-            last_timestamp = current_interval
-            last_glucose = glucose
-
-        # update records
-        last_glucose = glucose
-        last_timestamp = timestamp
-
-    return list(zip(*sorted(enriched_data, key=lambda x: x[0])))
+    return tuple(enriched_timestamps), tuple(enriched_glucose.tolist())
 
 
 def compute_y_value_with_x_time(pos1, pos2, target_x_value_mins=5):
@@ -602,10 +769,30 @@ def compute_x_time_value(pos1, pos2, target_y_value):
     return start_of_x2 + timedelta(seconds=time_in_seconds_since_day_start)
 
 
+def compute_x_time_value_us(x1, y1, x2, y2, target_y_value):
+    """
+    Vectorised compute_x_time_value for epoch second arrays, returning the
+    crossing times in epoch microseconds.
+    Mirrors the day start reference and microsecond rounding of the scalar version,
+    a jump between two readings at the same time crosses at that time.
+    """
+    start_of_x2 = x2 - x2 % (24 * 60 * 60)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        m = (y2 - y1) / (x2 - x1)
+        c = y2 - (m * (x2 - start_of_x2))
+        time_in_seconds_since_day_start = np.where(
+            x1 == x2, x2 - start_of_x2, (target_y_value - c) / m
+        )
+    whole_seconds = np.trunc(time_in_seconds_since_day_start)
+    microseconds = np.rint((time_in_seconds_since_day_start - whole_seconds) * 10**6)
+    return (
+        start_of_x2 + whole_seconds.astype(np.int64)
+    ) * 10**6 + microseconds.astype(np.int64)
+
+
 def group_glucose_data_by_day(data):
-    ordered_data = sorted(data, key=lambda x: x.timestamp)
-    timestamp_list = list(map(lambda x: x.timestamp, ordered_data))
-    glucose_list = list(map(lambda x: x.glucose, ordered_data))
+    timestamp_list = list(map(lambda x: x.timestamp, data))
+    glucose_list = list(map(lambda x: x.glucose, data))
 
     return {
         convert_ts_to_str(group, "%Y-%m-%d"): [
@@ -618,10 +805,7 @@ def group_glucose_data_by_day(data):
 
 
 def glucose_raw_data(data):
-    return sorted(
-        [rec.get_as_json_object() for rec in data],
-        key=lambda x: x.get("timestamp"),
-    )
+    return [rec.get_as_json_object() for rec in data]
 
 
 def strava_raw_data(data):
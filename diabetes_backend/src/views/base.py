@@ -2,7 +2,8 @@ import logging
 from flask import abort
 from flask.views import MethodView
 from datetime import datetime as dt
-from src.constants import DATETIME_FORMAT
+from src.constants import DATABASE_DATETIME, DATETIME_FORMAT
+from src.utils import convert_ts_to_str
 
 
 logger = logging.getLogger("app")
@@ -17,3 +18,13 @@ class BaseView(MethodView):
 
     def convert_to_datetime(self, date_str):
         return dt.strptime(date_str, DATETIME_FORMAT)
+
+    def get_time_interval(self, args):
+        """
+        The start and end time of the request.
+        If no end time is provided it defaults to now.
+        If no start time is provided it defaults to the earliest possible.
+        """
+        default_start_time = convert_ts_to_str(dt(1900, 1, 1), DATABASE_DATETIME)
+        default_end_time = convert_ts_to_str(dt.now(), DATABASE_DATETIME)
+        return args.get("start", default_start_time), args.get("end", default_end_time)
@@ -1,22 +1,140 @@
 import logging
-from datetime import datetime as dt
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
 from flask import request
-from src.constants import DATABASE_DATETIME
-from src.utils import convert_ts_to_str
+from src.utils import to_utc_timestamp
 from src.views.base import BaseView
 
 logger = logging.getLogger("app")
 
+# Windows longer than this are computed from the rollups, when the view has any
+ROLLUP_MIN_WINDOW = pd.Timedelta(days=1)
+
+
+class MetricCache:
+    """
+    LRU cache of the Metric results, expiring after ttl_seconds.
+    Each result keeps the window it was computed over and the tables it depends
+    on, it is invalidated when rows of those tables are saved within the window,
+    widened by the table's margin
+    """
+
+    def __init__(self, maxsize=256, ttl_seconds=300, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Bumped on each invalidation so a result computed meanwhile is not cached
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_or_compute(self, key, window, dependencies, compute):
+        """
+        The cached result of the key, otherwise the result of compute() cached
+        with its (start, end) window and {table: margin} dependencies
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["expires_at"] > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["result"]
+            self.misses += 1
+            version = self.version
+        result = compute()
+        start, end = window
+        with self._lock:
+            if version == self.version:
+                self.entries[key] = {
+                    "result": result,
+                    "start": to_utc_timestamp(start),
+                    "end": to_utc_timestamp(end),
+                    "dependencies": dict(dependencies),
+                    "expires_at": self.clock() + self.ttl_seconds,
+                }
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _overlaps(entry, table, first_time, last_time):
+        if table not in entry["dependencies"]:
+            return False
+        margin = pd.Timedelta(entry["dependencies"][table])
+        # Unknown times invalidate the whole table, missing bounds are unbounded
+        if first_time is not None and entry["end"] is not None:
+            if first_time - margin > entry["end"]:
+                return False
+        if last_time is not None and entry["start"] is not None:
+            if last_time + margin < entry["start"]:
+                return False
+        return True
+
+    def on_rows_saved(self, table, first_id, last_id, first_time=None, last_time=None):
+        """
+        Invalidate the results depending on the table whose window overlaps the
+        times of the saved rows, subscribed to the ROWS_SAVED events.
+        Returns the number of results invalidated
+        """
+        first_time = to_utc_timestamp(first_time)
+        last_time = to_utc_timestamp(last_time)
+        with self._lock:
+            self.version += 1
+            keys = [
+                key
+                for key, entry in self.entries.items()
+                if self._overlaps(entry, table, first_time, last_time)
+            ]
+            for key in keys:
+                del self.entries[key]
+            self.invalidations += len(keys)
+        logger.debug(f"Invalidated {len(keys)} cached metrics of {table}")
+        return len(keys)
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
 
 class Metric(BaseView):
     """
     Retrieve the data within a range and compute a metric
+    If columns are given only those are fetched, as a DataFrame, instead of records
+    With a cache the results are reused, per endpoint, window and parameters,
+    until rows of the model's invalidated_by tables are saved within the window
+    With a rollup, a (RollupModel, rollup_metric) pair, windows longer than a day
+    are computed from all the columns of the rollup model instead.
+    An approximate rollup is only used when the request sets approximate
     """
 
-    def __init__(self, Schema, RecordModel, metric):
+    def __init__(
+        self,
+        Schema,
+        RecordModel,
+        metric,
+        columns=None,
+        cache=None,
+        rollup=None,
+        approximate_rollup=False,
+    ):
         self.schema = Schema
         self.model = RecordModel
         self.metric = metric
+        self.columns = columns
+        self.cache = cache
+        self.rollup = rollup
+        self.approximate_rollup = approximate_rollup
 
     def get(self):
         """
@@ -27,22 +145,61 @@ class Metric(BaseView):
         """
         logger.debug("Getting average glucose level")
         self.validate_against_schema(self.schema, request.args)
-        default_start_time = convert_ts_to_str(dt(1900, 1, 1), DATABASE_DATETIME)
-        default_end_time = convert_ts_to_str(dt.now(), DATABASE_DATETIME)
-        start_time = request.args.get("start", default_start_time)
-        end_time = request.args.get("end", default_end_time)
+        start_time, end_time = self.get_time_interval(request.args)
         additional_request_args = create_additional_kwargs(
             request.args,
             list(self.schema.__dict__.get("declared_fields", {}).keys()),
-            excluded_keys=("start", "end"),
+            excluded_keys=("start", "end", "approximate"),
         )
+        # As validated, so any boolean the schema accepts, such as 1 or yes
+        approximate = self.schema.load(request.args).get("approximate", False)
         logger.debug(f"Getting average glucose level from {start_time} to {end_time}")
-        data = self.model.get_records_between_timestamp(start_time, end_time)
-        res = self.metric(data, **additional_request_args)
-        logger.debug(f"Found {self.metric} in time range {start_time} - {end_time}")
+        model, metric, columns = self.get_source(start_time, end_time, approximate)
+
+        def compute():
+            return self.compute(
+                model, metric, columns, start_time, end_time, additional_request_args
+            )
+
+        if self.cache is None:
+            res = compute()
+        else:
+            # The requested window, a missing bound is open ended
+            window = (request.args.get("start"), request.args.get("end"))
+            key = (
+                request.endpoint,
+                *window,
+                approximate,
+                tuple(sorted(additional_request_args.items())),
+            )
+            res = self.cache.get_or_compute(key, window, model.invalidated_by, compute)
         fmt_result = str(res) if isinstance(res, float) else res
         return fmt_result, 200
 
+    def get_source(self, start_time, end_time, approximate=False):
+        """The model, metric and columns to compute from, the rollup for long windows"""
+        if self.rollup is not None and (approximate or not self.approximate_rollup):
+            start, end = to_utc_timestamp(start_time), to_utc_timestamp(end_time)
+            if (
+                start is not None
+                and end is not None
+                and end - start > ROLLUP_MIN_WINDOW
+            ):
+                rollup_model, rollup_metric = self.rollup
+                return rollup_model, rollup_metric, rollup_model.columns
+        return self.model, self.metric, self.columns
+
+    @staticmethod
+    def compute(model, metric, columns, start_time, end_time, additional_request_args):
+        """Fetch the data within the time range and compute the metric"""
+        if columns:
+            data = model.get_columns_between_timestamp(start_time, end_time, columns)
+        else:
+            data = model.get_records_between_timestamp(start_time, end_time)
+        res = metric(data, **additional_request_args)
+        logger.debug(f"Found {metric} in time range {start_time} - {end_time}")
+        return res
+
 
 # TODO: Move to utils and test
 def create_additional_kwargs(value_dict, keys, excluded_keys=None):
@@ -0,0 +1,17 @@
+import logging
+from src.views.base import BaseView
+
+logger = logging.getLogger("app")
+
+
+class Monitoring(BaseView):
+    """
+    Report the metrics of a monitor, such as the database connection pool
+    """
+
+    def __init__(self, get_metrics):
+        self.get_metrics = get_metrics
+
+    def get(self):
+        logger.debug("Getting monitoring metrics")
+        return self.get_metrics(), 200
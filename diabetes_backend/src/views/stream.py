@@ -0,0 +1,45 @@
+import logging
+from flask import Response, current_app, request, stream_with_context
+from src.views.base import BaseView
+
+logger = logging.getLogger("app")
+
+
+class StreamRecords(BaseView):
+    """
+    Stream the raw records within a range as a JSON array,
+    one chunk of records at a time so memory does not grow with the range
+    """
+
+    def __init__(self, Schema, RecordModel, chunk_size=1000):
+        self.schema = Schema
+        self.model = RecordModel
+        self.chunk_size = chunk_size
+
+    def get(self):
+        """
+        Stream the records in time order.
+        It is validated against the corresponding schema in schema.py.
+        """
+        self.validate_against_schema(self.schema, request.args)
+        start_time, end_time = self.get_time_interval(request.args)
+        logger.debug(f"Streaming records from {start_time} to {end_time}")
+        chunks = self.model.stream_records_between_timestamp(
+            start_time, end_time, chunk_size=self.chunk_size
+        )
+        return Response(
+            stream_with_context(generate_json_array(chunks)),
+            mimetype="application/json",
+        )
+
+
+def generate_json_array(chunks):
+    """
+    Write the chunks of records as a single JSON array, a chunk at a time
+    """
+    separator = "["
+    for chunk in chunks:
+        if chunk:
+            yield separator + ",".join(current_app.json.dumps(rec) for rec in chunk)
+            separator = ","
+    yield "[]" if separator == "[" else "]"